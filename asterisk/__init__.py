@@ -5,8 +5,16 @@ asterisk with python:
 
 agi     - python wrapper for agi
 agitb   - a module to assist in agi debugging, like cgitb
+cli     - tabular output of asterisk CLI commands
 config  - a module for parsing asterisk config files
 manager - a module for interacting with the asterisk manager interface
+metrics - counters and latency histograms of the manager interface
+record  - recording and replay of the data received by the manager
+asyncmanager - the manager interface for programs using asyncio
+asyncagi - agi commands as coroutines and an asyncio fastagi server
+pool    - connections to the managers of many asterisk servers
+originate - mass origination of calls with rate limits
+state   - local copies of asterisk state kept up to date from manager events
 
 """
 
@@ -15,5 +23,7 @@ try:
 except ImportError:
     __version__ = '0+unknown'
 
-__all__ = ['agi', 'agitb', 'config', 'manager', '__version__']
+__all__ = ['agi', 'agitb', 'asyncagi', 'asyncmanager', 'cli', 'config',
+           'manager', 'metrics', 'originate', 'pool', 'record', 'state',
+           '__version__']
 
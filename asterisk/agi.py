@@ -5,6 +5,21 @@
 This module contains functions and classes to implment AGI scripts in python.
 pyvr
 
+AGI scripts are started by asterisk for each call and talk to it over
+stdin/stdout. A FastAGIServer instead accepts agi:// connections and
+runs a handler with an AGI instance bound to each connection, so the
+interpreter and the state of the application stay warm:
+
+    def handler(agi):
+        agi.answer()
+        agi.stream_file('demo-congrats')
+
+    server = FastAGIServer(handler, port=4573, threads=20)
+    server.serve_forever()
+
+With processes > 0 that many processes are forked, each running the
+given number of threads.
+
 {'agi_callerid' : 'mars.putland.int',
  'agi_channel'  : 'IAX[kputland@kputland]/119',
  'agi_context'  : 'default',
@@ -20,7 +35,11 @@ pyvr
 """
 
 import sys, pprint, re
+import os
 import signal
+import socket
+import threading
+import traceback
 
 DEFAULT_TIMEOUT = 2000 # 2sec timeout used as default for functions that take timeouts
 DEFAULT_RECORD  = 20000 # 20sec record time
@@ -47,6 +66,43 @@ class AGIDBError(AGIAppError): pass
 class AGIUsageError(AGIError): pass
 class AGIInvalidCommand(AGIError): pass
 
+def _format_command(command, args):
+    """Return the line sending a command with its arguments"""
+    command = command.strip()
+    command = '%s %s' % (command, ' '.join(map(str,args)))
+    command = command.strip()
+    if command[-1] != '\n':
+        command += '\n'
+    return command
+
+def _result_code(line):
+    """Split a result line into the code and the rest"""
+    code, response = re_code.search(line).groups()
+    return int(code or 0), response
+
+def _parse_result(code, response, stderr):
+    """Return the result dict of a response with code 200, raise
+    the exceptions for errors and hangups. Code 520 (usage) is
+    handled by the caller which has to read the usage lines."""
+    if code == 200:
+        result = {'result':('','')}
+        for key,value,data in re_kv.findall(response):
+            result[key] = (value, data)
+
+            # If user hangs up... we get 'hangup' in the data
+            if data == 'hangup':
+                raise AGIResultHangup("User hungup during execution")
+
+            if key == 'result' and value == '-1':
+                raise AGIAppError("Error executing application, or hangup")
+
+        stderr.write('    RESULT_DICT: %s\n' % pprint.pformat(result))
+        return result
+    elif code == 510:
+        raise AGIInvalidCommand(response)
+    else:
+        raise AGIUnknownError(code, 'Unhandled code or undefined response')
+
 class AGI:
     """
     This class encapsulates communication between Asterisk an a python script.
@@ -54,12 +110,16 @@ class AGI:
     Asterisk.
     """
 
-    def __init__(self,stdin=sys.stdin,stdout=sys.stdout,stderr=sys.stderr):
+    def __init__(self,stdin=sys.stdin,stdout=sys.stdout,stderr=sys.stderr,
+                 sighup=True):
         self.stdin=stdin
         self.stdout=stdout
         self.stderr=stderr
         self._got_sighup = False
-        signal.signal(signal.SIGHUP, self._handle_sighup)  # handle SIGHUP
+        # signal handlers can only be set in the main thread, with
+        # FastAGI the hangup is sent as a HANGUP line instead
+        if sighup and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, self._handle_sighup)  # handle SIGHUP
         self.stderr.write('ARGS: ')
         self.stderr.write(str(sys.argv))
         self.stderr.write('\n')
@@ -111,42 +171,24 @@ class AGI:
 
     def send_command(self, command, *args):
         """Send a command to Asterisk"""
-        command = command.strip()
-        command = '%s %s' % (command, ' '.join(map(str,args)))
-        command = command.strip()
-        if command[-1] != '\n':
-            command += '\n'
+        command = _format_command(command, args)
         self.stderr.write('    COMMAND: %s' % command)
         self.stdout.write(command)
         self.stdout.flush()
 
     def get_result(self):
         """Read the result of a command from Asterisk"""
-        code = 0
-        result = {'result':('','')}
-        line = self.stdin.readline().strip()
+        line = self.stdin.readline()
+        if not line:
+            raise AGIResultHangup("Connection closed by asterisk")
+        line = line.strip()
+        # FastAGI tells about a hangup before the result
+        while line == 'HANGUP':
+            self._got_sighup = True
+            line = self.stdin.readline().strip()
         self.stderr.write('    RESULT_LINE: %s\n' % line)
-        m = re_code.search(line)
-        if m:
-            code, response = m.groups()
-            code = int(code)
-
-        if code == 200:
-            for key,value,data in re_kv.findall(response):
-                result[key] = (value, data)
-
-                # If user hangs up... we get 'hangup' in the data
-                if data == 'hangup':
-                    raise AGIResultHangup("User hungup during execution")
-
-                if key == 'result' and value == '-1':
-                    raise AGIAppError("Error executing application, or hangup")
-
-            self.stderr.write('    RESULT_DICT: %s\n' % pprint.pformat(result))
-            return result
-        elif code == 510:
-            raise AGIInvalidCommand(response)
-        elif code == 520:
+        code, response = _result_code(line)
+        if code == 520:
             usage = [line]
             line = self.stdin.readline().strip()
             while line[:3] != '520':
@@ -155,8 +197,7 @@ class AGI:
             usage.append(line)
             usage = '%s\n' % '\n'.join(usage)
             raise AGIUsageError(usage)
-        else:
-            raise AGIUnknownError(code, 'Unhandled code or undefined response')
+        return _parse_result(code, response, self.stderr)
 
     def _process_digit_list(self, digits):
         if type(digits) == type([]):
@@ -616,6 +657,127 @@ class AGI:
         """
         self.execute('NOOP')
 
+class FastAGIServer:
+    """
+    FastAGI (agi://) server: Accepts connections from asterisk, reads
+    the AGI environment and calls handler with an AGI instance for the
+    connection. The connection is closed when the handler returns. The
+    script part of the agi:// URL is in agi.env['agi_network_script'].
+
+    Connections are served by a pool of threads accepting on the same
+    socket; with processes > 0 that many processes are forked, each with
+    the given number of threads, and restarted when they exit. The
+    debug output of AGI and tracebacks of failing handlers go to stderr
+    (default: discarded).
+    """
+
+    def __init__(self, handler, host='', port=4573, threads=10, processes=0,
+                 backlog=128, stderr=None):
+        self.handler = handler
+        self.threads = threads
+        self.processes = processes
+        self.stderr = stderr or open(os.devnull, 'w')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(backlog)
+        # wake up accept now and then to check for shutdown
+        self.socket.settimeout(0.5)
+        self.host, self.port = self.socket.getsockname()[:2]
+        self.children = []
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        """
+        Serve connections until shutdown is called.
+        """
+        if self.processes:
+            self._prefork()
+        else:
+            self._serve_threads()
+
+    def shutdown(self):
+        """
+        Stop serving: Threads finish their running handler, forked
+        processes are terminated.
+        """
+        self._stopped.set()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _prefork(self):
+        while len(self.children) < self.processes:
+            self._fork()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                break
+            if pid in self.children:
+                self.children.remove(pid)
+            if not self._stopped.is_set():
+                self._fork()
+        self.socket.close()
+
+    def _fork(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.children = []
+                self._serve_threads()
+            finally:
+                os._exit(0)
+        self.children.append(pid)
+
+    def _serve_threads(self):
+        workers = [threading.Thread(target=self._accept)
+                   for n in range(self.threads)]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.socket.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopped.is_set():
+                    break
+                continue
+            try:
+                self.handle(conn)
+            finally:
+                conn.close()
+
+    def handle(self, conn):
+        """
+        Run the handler for a connection.
+        """
+        stdin = conn.makefile('r')
+        stdout = conn.makefile('w')
+        try:
+            agi = AGI(stdin, stdout, self.stderr, sighup=False)
+            self.handler(agi)
+        except AGIHangup:
+            pass
+        except Exception:
+            traceback.print_exc(file=self.stderr)
+        finally:
+            try:
+                stdout.close()
+            except (IOError, OSError):
+                pass
+            stdin.close()
+
 if __name__=='__main__':
     agi = AGI()
     #agi.appexec('festival','Welcome to Klass Technologies.  Thank you for calling.')
@@ -2,9 +2,10 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from __future__ import print_function
 import socket
+import threading
+import time
 from   signal import SIGTERM
 from   os import fork, kill, waitpid
-from   time import sleep
 from   asterisk.compat import string_types
 
 class Event(dict):
@@ -45,10 +46,16 @@ class Event(dict):
         return self.sort_order.get(x[0], 10000)
 
     def as_string(self, id):
+        """ Responses get the ActionID of the action, so do events of
+            a list producing action, these are marked by an
+            ActionID key (with arbitrary content).
+        """
         ret = []
-        if 'Response' in self:
-            self ['ActionID'] = [id]
-        for k,v in sorted(self.items(), key=self.sort):
+        items = self
+        if 'Response' in self or 'ActionID' in self:
+            # the event may be sent to several clients concurrently
+            items = dict(self, ActionID = [id])
+        for k,v in sorted(items.items(), key=self.sort):
             if k == 'CONTENT':
                 ret.append(v)
             else :
@@ -69,6 +76,127 @@ class Event(dict):
     def headers(self):
         return self
 
+class EventListAnswer(object):
+    """ Answer of a list producing action for a chatscript: A success
+        response, count events with the given name and headers and the
+        completing event (by default the name with 'Complete'
+        appended). In header values %(n)d is replaced by the number of
+        the event, e.g.
+        EventListAnswer('Status', 10000, Channel = 'SIP/%(n)d')
+    """
+
+    def __init__(self, event, count, complete = None, **headers):
+        self.event    = event
+        self.count    = count
+        self.complete = complete or event + 'Complete'
+        self.headers  = headers
+
+    def __iter__(self):
+        yield Event \
+            ( Response  = ('Success',)
+            , EventList = ('start',)
+            , Message   = ('Events will follow',)
+            )
+        for n in range(self.count):
+            e = Event(Event = (self.event,), ActionID = ('',))
+            for k, v in self.headers.items():
+                e[k] = (v % dict(n = n) if '%' in v else v,)
+            yield e
+        yield Event \
+            ( Event     = (self.complete,)
+            , EventList = ('Complete',)
+            , ListItems = (str(self.count),)
+            , ActionID  = ('',)
+            )
+
+class CallGenerator(object):
+    """ Synthetic event stream of calls for load tests: Each call has a
+        Newchannel, two Newstate (Ringing, Up) and a Hangup event, the
+        events of up to concurrent calls are interleaved. Events are
+        sent at rate events per second (0 is as fast as possible),
+        after the response to the action named start, to every
+        client. With a count the stream ends after count events.
+    """
+
+    steps = \
+        ( ( 'Event: Newchannel\r\nChannel: %(channel)s\r\n'
+            'ChannelState: 0\r\nChannelStateDesc: Down\r\n'
+            'CallerIDNum: %(caller)s\r\nExten: %(exten)s\r\n'
+            'Context: default\r\nUniqueid: %(uniqueid)s\r\n\r\n'
+          )
+        , ( 'Event: Newstate\r\nChannel: %(channel)s\r\n'
+            'ChannelState: 5\r\nChannelStateDesc: Ringing\r\n'
+            'CallerIDNum: %(caller)s\r\nUniqueid: %(uniqueid)s\r\n\r\n'
+          )
+        , ( 'Event: Newstate\r\nChannel: %(channel)s\r\n'
+            'ChannelState: 6\r\nChannelStateDesc: Up\r\n'
+            'CallerIDNum: %(caller)s\r\nUniqueid: %(uniqueid)s\r\n\r\n'
+          )
+        , ( 'Event: Hangup\r\nChannel: %(channel)s\r\n'
+            'Uniqueid: %(uniqueid)s\r\nCause: 16\r\n'
+            'Cause-txt: Normal Clearing\r\n\r\n'
+          )
+        )
+
+    def __init__(self, rate = 1000, count = None, concurrent = 100,
+                 start = 'Login'):
+        self.rate       = rate
+        self.count      = count
+        self.concurrent = concurrent
+        self.start      = start
+
+    def events(self):
+        """ Generate the encoded events.
+        """
+        calls = [None] * self.concurrent
+        ncalls = 0
+        n = 0
+        while self.count is None or n < self.count:
+            slot = n % self.concurrent
+            call = calls[slot]
+            if call is None:
+                ncalls += 1
+                call = calls[slot] = \
+                    [ 0
+                    , dict
+                        ( channel  = 'SIP/%04d-%08x' % (slot, ncalls)
+                        , caller   = str(1000 + slot)
+                        , exten    = str(2000 + ncalls % 1000)
+                        , uniqueid = '1500000000.%d' % ncalls
+                        )
+                    ]
+            yield (self.steps[call[0]] % call[1]).encode('utf-8')
+            call[0] += 1
+            if call[0] == len(self.steps):
+                calls[slot] = None
+            n += 1
+
+    def stream(self, write):
+        """ Write the events with write, paced to the rate.
+            Ends when write fails.
+        """
+        events = self.events()
+        begin = time.time()
+        sent = 0
+        while True:
+            if self.rate:
+                due = int((time.time() - begin) * self.rate) - sent
+                if due <= 0:
+                    time.sleep(0.01)
+                    continue
+            else:
+                due = 1000
+            chunk = []
+            for e in events:
+                chunk.append(e)
+                if len(chunk) >= due:
+                    break
+            if not chunk:
+                return
+            if not write(b''.join(chunk)):
+                return
+            sent += len(chunk)
+
 class AsteriskEmu(object):
     """ Emulator for asterisk management interface.
         Used for unittests of asterisk.manager.
@@ -76,6 +204,9 @@ class AsteriskEmu(object):
         unittests of programs that build on pyst's asterisk.manager.
         By default let the operating system decide the port number to
         bind to, resulting port is stored in self.port.
+        Each client connection is served by a thread, so many clients
+        can be connected at a time. With a CallGenerator as generator
+        each client receives a synthetic event stream.
     """
 
     default_events = dict \
@@ -95,10 +226,12 @@ class AsteriskEmu(object):
             )
         )
 
-    def __init__(self, chatscript, port = 0):
+    def __init__(self, chatscript, port = 0, generator = None, backlog = 128):
         s = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('localhost', port))
-        s.listen(1)
+        s.listen(backlog)
+        self.generator = generator
         pid = fork()
         if not pid:
             # won't return
@@ -111,34 +244,61 @@ class AsteriskEmu(object):
         """ Emulate asterisk management interface on a socket.
             Chatscript is a dict of command names to event list mapping.
             The event list contains events to send when the given
-            command is recognized.
+            command is recognized. A None in the event list drops the
+            connection, this happens only once, on the next connection
+            the remaining events are sent.
         """
         while True:
             conn, addr = sock.accept()
-            f = conn.makefile('rwb')
-            conn.close()
-            f.write('Asterisk Call Manager/1.1\r\n'.encode('utf-8'))
-            f.flush()
-            cmd = lastid = ''
-            try:
-                for l in f:
-                    l = l.decode('utf-8')
-                    if l.startswith ('ActionID:'):
-                        lastid = l.split(':', 1)[1].strip()
-                    elif l.startswith ('Action:'):
-                        cmd = l.split(':', 1)[1].strip()
-                    elif not l.strip():
-                        for d in chatscript, self.default_events:
-                            if cmd in d:
-                                for event in d[cmd]:
-                                    f.write(event.as_string(id = lastid))
-                                    f.flush()
-                                    if cmd == 'Logoff':
+            t = threading.Thread(target=self.serve, args=(conn, chatscript))
+            t.setDaemon(True)
+            t.start()
+            # accept the next connection, we are killed when done
+
+    def serve(self, conn, chatscript):
+        """ Serve one client connection.
+        """
+        f = conn.makefile('rwb')
+        conn.close()
+        lock = threading.Lock()
+        def write(data):
+            with lock:
+                try:
+                    f.write(data)
+                    f.flush()
+                except (IOError, ValueError):
+                    return False
+            return True
+        write('Asterisk Call Manager/1.1\r\n'.encode('utf-8'))
+        cmd = lastid = ''
+        try:
+            for l in f:
+                l = l.decode('utf-8')
+                if l.startswith ('ActionID:'):
+                    lastid = l.split(':', 1)[1].strip()
+                elif l.startswith ('Action:'):
+                    cmd = l.split(':', 1)[1].strip()
+                elif not l.strip():
+                    for d in chatscript, self.default_events:
+                        if cmd in d:
+                            for event in d[cmd]:
+                                if event is None:
+                                    d[cmd] = [e for e in d[cmd] if e is not None]
+                                    with lock:
+                                        f.close()
+                                    break
+                                write(event.as_string(id = lastid))
+                                if cmd == 'Logoff':
+                                    with lock:
                                         f.close()
-                                break
-            except:
-                pass
-            sleep(10000) # wait for being killed
+                            break
+                    if self.generator and cmd == self.generator.start:
+                        t = threading.Thread \
+                            (target=self.generator.stream, args=(write,))
+                        t.setDaemon(True)
+                        t.start()
+        except:
+            pass
 
     def close(self):
         if self.childpid:
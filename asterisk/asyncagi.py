@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Asyncio Interface for FastAGI
+
+This module provides the API of asterisk.agi for programs using asyncio:
+An AsyncFastAGIServer accepts agi:// connections and runs a coroutine
+for each with an AsyncAGI, whose commands are coroutines. A call script
+waiting for playback or DTMF needs no thread, one process can serve
+thousands of calls.
+
+   import asyncio
+   from asterisk.asyncagi import AsyncFastAGIServer
+
+   async def handler(agi):
+       await agi.answer()
+       digits = await agi.get_data('enter-number', timeout = 5000)
+       await agi.say_digits(digits)
+       await agi.hangup()
+
+   async def main():
+       server = AsyncFastAGIServer(handler, port = 4573)
+       await server.serve_forever()
+
+   asyncio.run(main())
+
+The commands of AsyncAGI are those of asterisk.agi.AGI with the same
+arguments, results and exceptions.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import traceback
+
+from asterisk.agi import AGI, AGIException, AGIHangup, AGIResultHangup
+from asterisk.agi import AGISIGHUPHangup, AGISIGPIPEHangup, AGIUsageError
+from asterisk.agi import _format_command, _parse_result, _result_code
+
+class _Suspend(BaseException):
+    """
+    Raised by _Step.execute for a command without a result yet, not an
+    Exception so that it passes the error handling of the commands.
+    """
+    def __init__(self, command, args):
+        BaseException.__init__(self, command)
+        self.command = command
+        self.args = args
+
+class _Step(AGI):
+    """
+    Runs a command method of AGI with the results (or exceptions) of
+    the commands executed so far, suspends at the next one.
+    """
+    def __init__(self, session, results):
+        self.env = session.env
+        self.stderr = session.stderr
+        self._results = results
+        self._n = 0
+
+    def execute(self, command, *args):
+        if self._n == len(self._results):
+            raise _Suspend(command, args)
+        result, exception = self._results[self._n]
+        self._n += 1
+        if exception is not None:
+            raise exception
+        return result
+
+def _async_command(method):
+    """
+    Coroutine running a command method of AGI: The method is run until
+    it executes a command, the command is sent and the method is run
+    again with its result, until it returns.
+    """
+    @functools.wraps(method)
+    async def command(self, *args, **kwargs):
+        results = []
+        while True:
+            try:
+                return method(_Step(self, results), *args, **kwargs)
+            except _Suspend as suspend:
+                try:
+                    result = await self.execute \
+                        (suspend.command, *suspend.args)
+                except AGIException as exc:
+                    # the method may handle it
+                    results.append((None, exc))
+                else:
+                    results.append((result, None))
+    return command
+
+class AsyncAGI(object):
+    """
+    An AGI session over a StreamReader/StreamWriter pair. Call
+    read_env first (AsyncFastAGIServer does).
+    """
+    def __init__(self, reader, writer, stderr=None):
+        self.reader = reader
+        self.writer = writer
+        self.stderr = stderr or open(os.devnull, 'w')
+        self.env = {}
+        self._got_sighup = False
+
+    async def _readline(self):
+        line = await self.reader.readline()
+        return line.decode('utf-8')
+
+    async def read_env(self):
+        """Read the AGI environment sent by asterisk"""
+        while True:
+            line = (await self._readline()).strip()
+            if line == '':
+                break
+            key, sep, data = line.partition(':')
+            key = key.strip()
+            if key != '':
+                self.env[key] = data.strip()
+
+    def test_hangup(self):
+        """This function throws AGIHangup if asterisk sent HANGUP"""
+        if self._got_sighup:
+            raise AGISIGHUPHangup("Received SIGHUP from Asterisk")
+
+    async def execute(self, command, *args):
+        self.test_hangup()
+        try:
+            await self.send_command(command, *args)
+        except (ConnectionError, OSError):
+            raise AGISIGPIPEHangup("Received SIGPIPE")
+        return await self.get_result()
+
+    async def send_command(self, command, *args):
+        """Send a command to Asterisk"""
+        command = _format_command(command, args)
+        self.stderr.write('    COMMAND: %s' % command)
+        self.writer.write(command.encode('utf-8'))
+        await self.writer.drain()
+
+    async def get_result(self):
+        """Read the result of a command from Asterisk"""
+        line = await self._readline()
+        if not line:
+            raise AGIResultHangup("Connection closed by asterisk")
+        line = line.strip()
+        while line == 'HANGUP':
+            self._got_sighup = True
+            line = (await self._readline()).strip()
+        self.stderr.write('    RESULT_LINE: %s\n' % line)
+        code, response = _result_code(line)
+        if code == 520:
+            usage = [line]
+            line = (await self._readline()).strip()
+            while line[:3] != '520':
+                usage.append(line)
+                line = (await self._readline()).strip()
+            usage.append(line)
+            raise AGIUsageError('%s\n' % '\n'.join(usage))
+        return _parse_result(code, response, self.stderr)
+
+# The commands are shared with AGI
+for _name, _method in list(vars(AGI).items()):
+    if ( not _name.startswith('_') and inspect.isfunction(_method)
+       and not hasattr(AsyncAGI, _name)
+       ):
+        setattr(AsyncAGI, _name, _async_command(_method))
+
+class AsyncFastAGIServer(object):
+    """
+    FastAGI (agi://) server running handler, a coroutine function,
+    with an AsyncAGI for each connection. The connection is closed
+    when the handler returns. Tracebacks of failing handlers go to
+    stderr (default: discarded).
+    """
+    def __init__(self, handler, host='', port=4573, stderr=None):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.stderr = stderr or open(os.devnull, 'w')
+        self.server = None
+
+    async def start(self):
+        """
+        Start listening, the port is known afterwards.
+        """
+        self.server = await asyncio.start_server \
+            (self.handle, self.host or None, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        """
+        Run the handler for a connection.
+        """
+        try:
+            agi = AsyncAGI(reader, writer, self.stderr)
+            await agi.read_env()
+            await self.handler(agi)
+        except AGIHangup:
+            pass
+        except Exception:
+            traceback.print_exc(file=self.stderr)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
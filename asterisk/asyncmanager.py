@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Asyncio Interface for Asterisk Manager
+
+This module provides the API of asterisk.manager for programs using
+asyncio. All connections and their events are handled by the event
+loop, no threads are used. Actions are coroutines, event callbacks may
+be plain functions or coroutine functions.
+
+   import asyncio
+   from asterisk.asyncmanager import AsyncManager
+
+   async def handle_event(event, manager):
+      print ("Received event: %s" % event.name)
+
+   async def main():
+      manager = AsyncManager()
+      await manager.connect('host')
+      try:
+          await manager.login('user', 'secret')
+          manager.register_event('*', handle_event)
+          response = await manager.status()
+      finally:
+          await manager.close()
+
+   asyncio.run(main())
+
+Event callbacks run in order of arrival in a single dispatch task, as
+with the threaded Manager a callback returning True stops the dispatch
+of that event to further callbacks. Callbacks may themselves await
+actions of the manager.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import socket
+
+from asterisk.manager import Manager, ManagerMsg, Event, _Framer
+from asterisk.manager import EventStream, _EventCollector, _StreamCollector
+from asterisk.manager import _format_action
+from asterisk.manager import _EventFilter, _EventTable, _unsubscribed
+from asterisk.manager import ManagerException, ManagerSocketException
+from asterisk.manager import ManagerAuthException, ManagerTimeoutException
+
+class AsyncManager(object):
+    def __init__(self, timeout=None, event_filter=False):
+        self.host = None      # set by connect
+        self.title = None     # set by received greeting
+        self.version = None
+        self._reader = None
+        self._writer = None
+        self._connected = False
+
+        # default number of seconds to wait for the response to an
+        # action, None waits forever
+        self.timeout = timeout
+
+        # see Manager
+        self.event_filter = event_filter
+        self._filter = None
+
+        # our hostname
+        self.hostname = socket.gethostname()
+        # pid -- used for unique naming of ActionID
+        self.pid      = os.getpid ()
+        self._seq = 0
+
+        # callbacks for events
+        self._events = _EventTable()
+
+        # Futures of actions waiting for a response indexed by ActionID
+        self._pending = {}
+        # _EventCollector of list producing actions indexed by ActionID
+        self._collectors = {}
+
+        self._event_queue = None
+        self._message_task = None
+        self._dispatch_task = None
+
+    def connected(self):
+        """
+        Check if we are connected or not.
+        """
+        return self._connected
+
+    def next_seq(self):
+        """Return the next number in the sequence, this is used for ActionID"""
+        seq = self._seq
+        self._seq += 1
+        return seq
+
+    async def connect(self, host, port=5038):
+        """Connect to the manager interface"""
+
+        if self._connected:
+            raise ManagerException('Already connected to manager')
+
+        try:
+            self._reader, self._writer = await asyncio.open_connection \
+                (host, int(port))
+        except OSError as err:
+            raise ManagerSocketException(err.errno, err.strerror)
+        self.host = host
+        self._connected = True
+        self._filter = None
+
+        # the greeting has no ActionID, it is the first response
+        greeting = self._register(None)
+        self._event_queue = asyncio.Queue()
+        self._message_task = asyncio.ensure_future(self.message_loop())
+        self._dispatch_task = asyncio.ensure_future(self.event_dispatch())
+
+        # get our initial connection response
+        return await self._wait(greeting, None)
+
+    async def close(self):
+        """Shutdown the connection to the manager"""
+
+        if self._connected:
+            try:
+                await self.logoff()
+            except ManagerException:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._message_task is not None:
+            await asyncio.gather(self._message_task, return_exceptions=True)
+            self._message_task = None
+        if self._dispatch_task is not None:
+            # don't wait for ourselves when closed from a callback
+            if self._dispatch_task is not asyncio.current_task():
+                await asyncio.gather \
+                    (self._dispatch_task, return_exceptions=True)
+            self._dispatch_task = None
+
+    def _register(self, action_id, collector=None):
+        future = asyncio.get_event_loop().create_future()
+        future.action_id = action_id
+        self._pending[action_id] = future
+        if collector is not None:
+            self._collectors[action_id] = collector
+        future.add_done_callback(self._cancelled)
+        return future
+
+    def _cancelled(self, future):
+        if future.cancelled():
+            self._pending.pop(future.action_id, None)
+            self._collectors.pop(future.action_id, None)
+
+    async def _wait(self, future, action_id, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise ManagerTimeoutException \
+                ('Timeout waiting for response to %s' % action_id)
+
+    async def send_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send a command to the manager and return the response.
+
+        Arguments are the same as for Manager.send_action. Any number
+        of actions may be awaited concurrently on one connection.
+        """
+        future = self.send_action_nowait(cdict, **kwargs)
+        await self._writer.drain()
+        return await self._wait(future, future.action_id, timeout)
+
+    def send_action_nowait(self, cdict={}, **kwargs):
+        """
+        Write the action immediately and return an asyncio future that
+        is resolved with the response. Use this for pipelining many
+        actions without awaiting each of them.
+        """
+        return self._send(cdict, kwargs)
+
+    async def send_list_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send a list producing action and return the events sent in
+        reply as an EventList, see Manager.send_list_action.
+        """
+        future = self.send_list_action_nowait(cdict, **kwargs)
+        await self._writer.drain()
+        return await self._wait(future, future.action_id, timeout)
+
+    def send_list_action_nowait(self, cdict={}, **kwargs):
+        """
+        Like send_list_action but return a future for the EventList.
+        """
+        return self._send(cdict, kwargs, _EventCollector())
+
+    def iter_list_action(self, cdict={}, timeout=None, maxsize=100, **kwargs):
+        """
+        Send a list producing action and return an AsyncEventStream
+        for iterating over the events sent in reply as they arrive:
+
+        async for event in manager.iter_list_action({'Action':'Status'}):
+            print (event['Channel'])
+
+        See Manager.iter_list_action for the parameters.
+        """
+        stream = AsyncEventStream(maxsize)
+        stream.timeout = self.timeout if timeout is None else timeout
+        stream.action_id = \
+            self._send(cdict, kwargs, stream._collector).action_id
+        return stream
+
+    def _send(self, cdict, kwargs, collector=None):
+        if not self._connected:
+            raise ManagerException("Not connected")
+
+        # fill in our args, don't modify the dict of the caller
+        cdict = dict(cdict, **kwargs)
+
+        # set the action id
+        if 'ActionID' not in cdict:
+            cdict['ActionID'] = '%s-%04s-%08x' % (self.hostname,
+                self.pid, self.next_seq())
+        future = self._register(cdict['ActionID'], collector)
+        self._writer.write(_format_action(cdict))
+        return future
+
+    def register_event(self, event, function, predicate=None):
+        """
+        Register a callback for the specfied event.
+        The callback may be a coroutine function.
+        If a callback function returns True, no more callbacks for that
+        event will be executed.
+        Patterns, predicates and filtering of events are described at
+        Manager.register_event.
+        """
+        self._events.register(event, function, predicate)
+        self._update_filter()
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        self._events.unregister(event, function)
+
+    def _update_filter(self):
+        if self._filter is None:
+            return
+        for cdict in self._filter.update(self._events.patterns()):
+            self.send_action_nowait(cdict)
+
+    async def message_loop(self):
+        """
+        Read messages from the manager. Responses are handed to the
+        waiting actions, events are queued for the dispatch task.
+        """
+        framer = _Framer()
+        try:
+            while True:
+                data = await self._reader.read(Manager.bufsize)
+                if not data:
+                    break
+                for frame in framer.feed(data):
+                    if framer.title and not self.title:
+                        self.title = framer.title
+                        self.version = framer.version
+                    if not _unsubscribed \
+                        (frame, self._events, self._collectors):
+                        await self._process(frame)
+        except OSError:
+            pass
+        finally:
+            self._connected = False
+            self._event_queue.put_nowait(None)
+            pending, self._pending = self._pending, {}
+            collectors, self._collectors = self._collectors, {}
+            exc = ManagerSocketException(0, 'Connection Terminated')
+            for collector in collectors.values():
+                collector.abort(exc)
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+
+    async def _process(self, frame):
+        """
+        Hand a message to the waiting action or queue it as an event.
+        """
+        # parse the data
+        message = ManagerMsg(frame)
+
+        # check if this is an event message
+        if message.is_event():
+            event = Event(message, self.host)
+            collector = None
+            if self._collectors:
+                collector = self._collect(event)
+            if collector is None:
+                self._event_queue.put_nowait(event)
+            elif isinstance(collector, _AsyncStreamCollector):
+                # wait for a slow consumer of the stream
+                await collector.wait_writable()
+        # check if this is a response
+        elif message.has_header('Response'):
+            self._resolve(message)
+
+    def _resolve(self, message):
+        """
+        Hand a response to the action waiting for it.
+        """
+        action_id = message.get_header('ActionID')
+        collector = self._collectors.get(action_id)
+        if collector is not None:
+            if not collector.add_response(message):
+                # the events of the list will follow
+                return
+            del self._collectors[action_id]
+            message = collector.result()
+        future = self._pending.pop(action_id, None)
+        # Some responses carry no ActionID (the greeting or
+        # misbehaving commands), these go to the oldest waiter
+        if future is None and action_id is None and self._pending:
+            future = self._pending.pop(next(iter(self._pending)))
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    def _collect(self, event):
+        """
+        Hand an event to the list producing action it belongs to and
+        return its collector, returns None if there is none.
+        """
+        action_id = event.get_header('ActionID')
+        collector = self._collectors.get(action_id)
+        if collector is None:
+            return None
+        if collector.add_event(event):
+            del self._collectors[action_id]
+            future = self._pending.pop(action_id, None)
+            if future is not None and not future.done():
+                future.set_result(collector.result())
+        return collector
+
+    async def event_dispatch(self):
+        """This task is responsible for dispatching events"""
+
+        while True:
+            ev = await self._event_queue.get()
+
+            # if we got None as an event, we are finished
+            if not ev:
+                break
+
+            for callback, predicate in self._events.lookup(ev.name):
+                if predicate is not None and not predicate(ev):
+                    continue
+                result = callback(ev, self)
+                if inspect.isawaitable(result):
+                    result = await result
+                if result:
+                    break
+
+# Manager actions
+
+    async def login(self, username, secret):
+        """Login to the manager, throws ManagerAuthException when login falis"""
+
+        cdict = {'Action':'Login'}
+        cdict['Username'] = username
+        cdict['Secret'] = secret
+        response = await self.send_action(cdict)
+
+        if response.get_header('Response') == 'Error':
+           raise ManagerAuthException(response.get_header('Message'))
+
+        if self.event_filter:
+            self._filter = _EventFilter()
+            self._update_filter()
+
+        return response
+
+class _AsyncStreamCollector(_StreamCollector):
+    """
+    Passes the events of a list producing action to an
+    AsyncEventStream, the reader waits in wait_writable while maxsize
+    events are queued.
+    """
+    def __init__(self, maxsize):
+        self.response = None
+        self.complete = None
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue()
+        self.space = asyncio.Event()
+        self.closed = False
+
+    def _put(self, item):
+        # events of an abandoned stream are discarded
+        if not self.closed:
+            self.queue.put_nowait(item)
+
+    async def wait_writable(self):
+        while self.queue.qsize() >= self.maxsize and not self.closed:
+            self.space.clear()
+            await self.space.wait()
+
+    def close(self):
+        if not self.closed:
+            # the collector stays registered until the end of the list
+            # so that the remaining events are discarded
+            self.closed = True
+            self.space.set()
+
+class AsyncEventStream(EventStream):
+    """
+    Asynchronous iterator over the events of a list producing action,
+    returned by AsyncManager.iter_list_action. While maxsize events are
+    waiting for the consumer the manager stops reading from the
+    connection: Do not await actions inside the loop, with more than
+    maxsize events they time out. A stream left early must be closed,
+    use it in a with statement. An abandoned stream is closed when it
+    is garbage collected.
+    """
+    _collector_class = _AsyncStreamCollector
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+        collector = self._collector
+        try:
+            item = await asyncio.wait_for(collector.queue.get(), self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise ManagerTimeoutException \
+                ('Timeout waiting for events of %s' % self.action_id)
+        collector.space.set()
+        if item is None:
+            self._done = True
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        return item
+
+def _coroutine_action(build, sender):
+    @functools.wraps(build)
+    async def action(self, *args, **kwargs):
+        return await getattr(self, sender)(build(self, *args, **kwargs))
+    return action
+
+# The remaining action helpers are shared with the threaded Manager
+for _name, _method in list(vars(Manager).items()):
+    _build = getattr(_method, 'build_action', None)
+    if _build is not None and not hasattr(AsyncManager, _name):
+        setattr(AsyncManager, _name, _coroutine_action(_build, _method.sender))
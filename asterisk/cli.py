@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Tabular Output of Asterisk CLI Commands
+
+Many CLI commands (e.g. 'core show channels' or 'sip show peers') print
+a table: A header line naming the columns, one line per row and a few
+summary lines. run_commands sends a list of commands over one manager
+connection at once and parses the output of each into a CommandTable,
+a list of dicts mapping column names to values.
+
+   import asterisk.manager
+   from asterisk.cli import run_commands
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   channels, peers = run_commands \\
+       (manager, ['core show channels', 'sip show peers'])
+   for row in peers:
+       print (row['Name/username'], row['Status'])
+   print (channels.footer)
+
+The columns are found at the start of the words of the header line,
+the layout is cached for each command and computed again only when
+the header line changes. A value too wide for its column moves the
+start of the next column.
+"""
+
+import re
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from asterisk.manager import ManagerTimeoutException
+
+# summary lines like '3 active channels' or '12 sip peers [...]'
+_footer = re.compile(r'\d+ [A-Za-z]')
+
+_header_word = re.compile(r'\S+')
+
+class CommandTable(list):
+    """
+    The rows of the output of a CLI command, each a dict mapping the
+    column names to the values. The column names are kept in columns,
+    lines after the table in footer, the response to the Command
+    action in response. If the command failed the table is empty.
+    """
+    def __init__(self, command, response=None):
+        list.__init__(self)
+        self.command = command
+        self.response = response
+        self.columns = []
+        self.footer = []
+
+class _Layout(object):
+    """
+    Column layout of a header line: The names and start offsets of the
+    columns.
+    """
+    __slots__ = ('header', 'columns', 'starts')
+
+    def __init__(self, header):
+        self.header = header
+        self.columns = []
+        self.starts = []
+        for m in _header_word.finditer(header):
+            self.columns.append(m.group(0))
+            self.starts.append(m.start())
+
+    def split(self, line):
+        """
+        Split a row into the values of the columns.
+        """
+        end = len(line)
+        bounds = [0]
+        for start in self.starts[1:]:
+            start = max(start, bounds[-1])
+            # an overflowing value of the previous column
+            while 0 < start < end and line[start - 1] != ' ' \
+                and line[start] != ' ':
+                start += 1
+            bounds.append(start)
+        bounds.append(end)
+        return [line[bounds[n]:bounds[n + 1]].strip()
+                for n in range(len(self.columns))]
+
+# layout by command
+_layouts = {}
+_layout_lock = threading.Lock()
+
+def _layout(command, header):
+    layout = _layouts.get(command)
+    if layout is None or layout.header != header:
+        layout = _Layout(header)
+        with _layout_lock:
+            _layouts[command] = layout
+    return layout
+
+def output_lines(response):
+    """
+    The lines of the output of a command, without the --END COMMAND--
+    marker of older asterisk versions.
+    """
+    lines = response.data.replace('\r\n', '\n').split('\n')
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if lines and lines[-1].strip() == '--END COMMAND--':
+        lines.pop()
+    return lines
+
+def parse_table(command, response, footer=_footer):
+    """
+    Parse the response to a Command action into a CommandTable. The
+    first non-empty line is the header. Rows end at an empty line or
+    at the first line matching the footer regex, the remaining
+    non-empty lines are the footer.
+    """
+    table = CommandTable(command, response)
+    if response.get_header('Response') == 'Error':
+        return table
+    lines = output_lines(response)
+    n = 0
+    while n < len(lines) and not lines[n].strip():
+        n += 1
+    if n == len(lines):
+        return table
+    layout = _layout(command, lines[n].rstrip())
+    table.columns = layout.columns
+    for n in range(n + 1, len(lines)):
+        line = lines[n].rstrip()
+        if not line or footer.match(line):
+            break
+        table.append(dict(zip(layout.columns, layout.split(line))))
+    else:
+        return table
+    table.footer = [l.strip() for l in lines[n:] if l.strip()]
+    return table
+
+def run_commands(manager, commands, timeout=None, footer=_footer):
+    """
+    Send the CLI commands over the manager at once and return a
+    CommandTable for each, in the same order. The timeout (default is
+    the timeout of the manager) applies to all commands together.
+    """
+    with manager.batch():
+        futures = [manager.command_async(c) for c in commands]
+    if timeout is None:
+        timeout = manager.timeout
+    end = None if timeout is None else time.time() + timeout
+    tables = []
+    for command, future in zip(commands, futures):
+        try:
+            response = future.result \
+                (None if end is None else max(0, end - time.time()))
+        except FutureTimeout:
+            for f in futures:
+                f.cancel()
+            raise ManagerTimeoutException \
+                ('Timeout waiting for output of %s' % command)
+        tables.append(parse_table(command, response, footer))
+    return tables
@@ -12,9 +12,9 @@ PY2 = sys.version_info[0] == 2
 
 # Queue in python3 has moved:
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
 
 # String types, stolen from Armin Ronacher above
 if not PY2:
@@ -59,15 +59,22 @@ and submit patches.
 
 import sys,os
 import socket
+import functools
 import threading
+from contextlib import contextmanager
 import re
+from collections import deque
+from fnmatch import fnmatchcase
 from io import StringIO
-from time import sleep
-from asterisk.compat import Queue, string_types
+from time import sleep, time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from asterisk.compat import Queue, Empty, string_types
 
 EOL = '\r\n'
 
 class _Msg(object):
+    __slots__ = ()
+
     def has_header(self, hname):
         """Check for a header"""
         return hname in self.headers
@@ -85,16 +92,67 @@ class _Msg(object):
 
 
 class ManagerMsg(_Msg):
-    """A manager interface message"""
+    """A manager interface message, response is the decoded text of
+       the message as split by _Framer (a list of lines is accepted, too)
+    """
+    # Headers are parsed on first access, messages that are never
+    # looked at (e.g. events nobody is interested in) cost little.
+    __slots__ = ('response', '_headers', '_multiheaders', '_data')
+
     def __init__(self, response):
         # the raw response, straight from the horse's mouth:
+        if not isinstance(response, string_types):
+            response = ''.join(response)
         self.response = response
-        self.data = ''
-        self.headers = {}
-        self.multiheaders = {}
+        self._headers = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._parse()
+        return self._headers
+
+    @property
+    def multiheaders(self):
+        if self._headers is None:
+            self._parse()
+        return self._multiheaders
+
+    @property
+    def data(self):
+        if self._headers is None:
+            self._parse()
+        return self._data
+
+    def first_header(self):
+        """
+        Return name and value of the first header without parsing the
+        whole message.
+        """
+        eol = self.response.find('\r\n')
+        if eol < 0:
+            eol = len(self.response)
+        k, sep, v = self.response[:eol].partition(':')
+        return k.strip(), v.strip()
+
+    def is_event(self):
+        """
+        Check if this is an event, usually the first header tells.
+        """
+        k = self.first_header()[0]
+        if k == 'Event':
+            return True
+        if k == 'Response':
+            return False
+        return self.has_header('Event')
+
+    def _parse(self):
+        self._headers = {}
+        self._multiheaders = {}
+        self._data = ''
 
         # parse the response
-        self.parse(response)
+        self.parse(self.response)
 
         # This is an unknown message, may happen if a command (notably
         # 'dialplan show something') contains a \n\r\n sequence in the
@@ -107,59 +165,101 @@ class ManagerMsg(_Msg):
         # commands sent and their expected return syntax. In that case
         # we could wait for --END COMMAND-- for 'command'.
         # B0rken in asterisk. This should be parseable without context.
-        if 'Event' not in self.headers and 'Response' not in self.headers:
+        if 'Event' not in self._headers and 'Response' not in self._headers:
             # there are commands that return the ActionID but not
             # 'Response', e.g., IAXpeers in Asterisk 1.4.X
-            if self.has_header('ActionID'):
-                self.headers['Response'] = 'Generated Header'
-                self.multiheaders ['Response'] = ['Generated Header']
-            elif '--END COMMAND--' in self.data:
-                self.headers['Event'] = 'NoClue'
-                self.multiheaders ['Event'] = ['NoClue']
+            if 'ActionID' in self._headers:
+                self._headers['Response'] = 'Generated Header'
+                self._multiheaders ['Response'] = ['Generated Header']
+            elif '--END COMMAND--' in self._data:
+                self._headers['Event'] = 'NoClue'
+                self._multiheaders ['Event'] = ['NoClue']
             else:
-                self.headers['Response'] = 'Generated Header'
-                self.multiheaders ['Response'] = ['Generated Header']
+                self._headers['Response'] = 'Generated Header'
+                self._multiheaders ['Response'] = ['Generated Header']
 
     def parse(self, response):
         """Parse a manager message"""
 
-        data = []
-        for n, line in enumerate (response):
-            # all valid header lines end in \r\n
-            if not line.endswith ('\r\n'):
-                data.extend(response[n:])
-                break
-            try:
-                k, v = (x.strip() for x in line.split(':',1))
-                if k not in self.multiheaders:
-                    self.multiheaders[k]=[]
-                self.headers[k] = v
-                self.multiheaders[k].append(v)
-            except ValueError:
+        headers = self._headers
+        multiheaders = self._multiheaders
+        # all valid header lines end in \r\n, without a lone \n in the
+        # message we can simply split it into lines
+        if response.count('\n') == response.count('\r\n'):
+            lines = response.split('\r\n')
+            last = len(lines) - 1
+            n = 0
+            for n, line in enumerate(lines):
+                k, sep, v = line.partition(':')
                 # invalid header, start of multi-line data response
-                data.extend(response[n:])
-                break
-        self.data = ''.join(data)
-        if not data and 'Output' in self.multiheaders:
-            self.data = '\n'.join(self.multiheaders['Output'])
+                if not sep or n == last:
+                    break
+                k = k.strip()
+                v = v.strip()
+                headers[k] = v
+                if k in multiheaders:
+                    multiheaders[k].append(v)
+                else:
+                    multiheaders[k] = [v]
+            data = '\r\n'.join(lines[n:])
+        else:
+            pos = 0
+            end = len(response)
+            while pos < end:
+                eol = response.find('\n', pos)
+                if eol <= pos or response[eol - 1] != '\r':
+                    break
+                colon = response.find(':', pos, eol)
+                if colon < 0:
+                    # invalid header, start of multi-line data response
+                    break
+                k = response[pos:colon].strip()
+                v = response[colon + 1:eol].strip()
+                headers[k] = v
+                if k in multiheaders:
+                    multiheaders[k].append(v)
+                else:
+                    multiheaders[k] = [v]
+                pos = eol + 1
+            data = response[pos:]
+        if not data and 'Output' in multiheaders:
+            data = '\n'.join(multiheaders['Output'])
+        self._data = data
 
 
 class Event(_Msg):
-    """Manager interface Events, __init__ expects and 'Event' message"""
-    def __init__(self, message):
+    """Manager interface Events, __init__ expects and 'Event' message,
+       host is the asterisk server that sent the event
+    """
+    __slots__ = ('message', 'name', 'host', 'received')
+
+    def __init__(self, message, host=None):
 
         # store all of the event data
         self.message = message
-        self.data = message.data
-        self.headers = message.headers
-        self.multiheaders = message.multiheaders
+        self.host = host
 
+        # get the event name, usually without parsing the message
+        k, v = message.first_header()
+        if k == 'Event':
+            self.name = v
         # if this is not an event message we have a problem
-        if not message.has_header('Event'):
+        elif not message.has_header('Event'):
             raise ManagerException('Trying to create event from non event message')
+        else:
+            self.name = message.get_header('Event')
 
-        # get the event name
-        self.name = message.get_header('Event')
+    @property
+    def headers(self):
+        return self.message.headers
+
+    @property
+    def multiheaders(self):
+        return self.message.multiheaders
+
+    @property
+    def data(self):
+        return self.message.data
 
     def __repr__(self):
         return self.headers['Event']
@@ -167,9 +267,718 @@ class Event(_Msg):
     def get_action_id(self):
         return self.headers.get('ActionID',0000)
 
-class Manager(object):
+class EventList(list):
+    """
+    The events sent in reply to a list producing action like Status or
+    Sippeers. The response to the action is kept in response, the final
+    event (e.g. StatusComplete) in complete. If the action failed the
+    list is empty and error is the message of the Error response.
+    """
+    def __init__(self, response=None):
+        list.__init__(self)
+        self.response = response
+        self.complete = None
+
+    @property
+    def error(self):
+        """
+        The message of an Error response, None if the action succeeded.
+        """
+        response = self.response
+        if response is None or response.get_header('Response') != 'Error':
+            return None
+        return response.get_header('Message', '')
+
+class _EventCollector(object):
+    """
+    Collects the events of a list producing action into an EventList.
+    """
+    def __init__(self):
+        self.events = EventList()
+
+    def add_response(self, message):
+        """
+        Record the response, returns True if no events will follow.
+        """
+        self.events.response = message
+        return message.get_header('Response') == 'Error'
+
+    def add_event(self, event):
+        """
+        Record an event, returns True if this completes the list.
+        """
+        if ( event.get_header('EventList') == 'Complete'
+           or event.name.endswith('Complete')
+           ):
+            self.events.complete = event
+            return True
+        self.events.append(event)
+        return False
+
+    def abort(self, exc):
+        """
+        The connection terminated, the future reports this.
+        """
+        pass
+
+    def restart(self):
+        """
+        The action is sent again after a reconnect.
+        """
+        self.events = EventList()
+
+    def result(self):
+        return self.events
+
+class _StreamCollector(_EventCollector):
+    """
+    Passes the events of a list producing action to an EventStream
+    through a queue of at most maxsize events. The manager references
+    only the collector, so an abandoned stream can be garbage collected
+    and closes the collector then.
+    """
+    def __init__(self, maxsize):
+        self.response = None
+        self.complete = None
+        self.queue = Queue(maxsize)
+        self.closed = False
+
+    def add_response(self, message):
+        self.response = message
+        if message.get_header('Response') == 'Error':
+            self._put(None)
+            return True
+        return False
+
+    def add_event(self, event):
+        if ( event.get_header('EventList') == 'Complete'
+           or event.name.endswith('Complete')
+           ):
+            self.complete = event
+            self._put(None)
+            return True
+        self._put(event)
+        return False
+
+    def abort(self, exc):
+        self._put(exc)
+
+    def result(self):
+        return self
+
+    def _put(self, item):
+        # events of an abandoned stream are discarded
+        if not self.closed:
+            self.queue.put(item)
+
+    def close(self):
+        if not self.closed:
+            # the collector stays registered until the end of the list
+            # so that the remaining events are discarded
+            self.closed = True
+            # unblock the message thread if it waits for the stream
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+class EventStream(object):
+    """
+    Iterator over the events of a list producing action, returned by
+    Manager.iter_list_action. Each event is yielded as soon as it is
+    parsed by the message thread. At most maxsize events are buffered,
+    if the consumer is slower the message thread waits for it, so a
+    large list does not fill up memory. After the end of the iteration
+    response and complete hold the response and the completion event
+    of the action.
+
+    While the message thread waits no responses to other actions are
+    received: Do not wait for the response to an action inside the
+    loop, with more than maxsize events this blocks until the timeout
+    of the action. Collect what is needed and send the actions after
+    the loop. A stream left early must be closed, use it as a context
+    manager:
+
+    with manager.iter_list_action({'Action' : 'Status'}) as stream:
+        for event in stream:
+            ...
+
+    An abandoned stream is closed when it is garbage collected.
+    """
+    _collector_class = _StreamCollector
+
+    def __init__(self, maxsize=100):
+        self.action_id = None
+        self.timeout = None
+        self._collector = self._collector_class(maxsize)
+        self._done = False
+
+    @property
+    def response(self):
+        return self._collector.response
+
+    @property
+    def complete(self):
+        return self._collector.complete
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            item = self._collector.queue.get(timeout=self.timeout)
+        except Empty:
+            self.close()
+            raise ManagerTimeoutException \
+                ('Timeout waiting for events of %s' % self.action_id)
+        if item is None:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        return item
+    next = __next__
+
+    def close(self):
+        """
+        Stop the iteration, remaining events are discarded.
+        """
+        self._done = True
+        self._collector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        collector = getattr(self, '_collector', None)
+        if collector is not None:
+            collector.close()
+
+def _format_action(cdict):
+    """
+    Return the action in cdict encoded for sending to the manager.
+    """
+    clist = []
+
+    # generate the command
+    for key, value in cdict.items():
+        if isinstance(value, list):
+           for item in value:
+              item = tuple([key, item])
+              clist.append('%s: %s' % item)
+        else:
+           item = tuple([key, value])
+           clist.append('%s: %s' % item)
+    clist.append(EOL)
+    return EOL.join(clist).encode('utf-8')
+
+class _Framer(object):
+    """
+    Splits the byte stream received from the manager into messages.
+    Messages end with an empty line, i.e., at the first \\n\\r\\n.
+    Some commands are broken and contain a \\n\\r\\n sequence, for a
+    "Response: Follows" we therefore wait for the end marker
+    --END COMMAND-- first. The greeting line that starts the stream is
+    turned into a message with a generated Response header.
+    """
+    def __init__(self):
+        self.title = None
+        self.version = None
+        self.greeting = True
+        self.buffer = b''
+
+    def feed(self, data):
+        """
+        Add received data, returns the list of completed messages,
+        each decoded into a string.
+        """
+        buf = self.buffer + data if self.buffer else data
+        frames = []
+        pos = 0
+        while True:
+            # ignore empty lines at start
+            while buf.startswith(b'\r\n', pos):
+                pos += 2
+            if self.greeting:
+                eol = buf.find(b'\n', pos)
+                if eol < 0:
+                    break
+                self.greeting = False
+                line = buf[pos:eol + 1].decode('utf-8')
+                if '/' in line and ':' not in line:
+                    # store title and version of the manager
+                    self.title, self.version = \
+                        (x.strip() for x in line.split('/', 1))
+                    # fake message header
+                    frames.append('Response: Generated Header\r\n' + line)
+                    pos = eol + 1
+                    continue
+            if buf.startswith(b'Response: Follows\r\n', pos):
+                marker = buf.find(b'--END COMMAND--', pos)
+                if marker < 0:
+                    break
+                end = buf.find(b'\n\r\n', marker)
+            else:
+                end = buf.find(b'\n\r\n', pos)
+            if end < 0:
+                break
+            frames.append(buf[pos:end + 1].decode('utf-8'))
+            pos = end + 3
+        self.buffer = buf[pos:]
+        return frames
+
+def _is_glob(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+class _EventTable(object):
+    """
+    The callbacks registered for events. An event pattern is an event
+    name, '*' for all events or a shell style pattern like 'Queue*'.
+    A callback may have a predicate, either a function called with the
+    event or a dict of header values the event must have.
+
+    The dispatching thread looks up the callbacks of an event name in
+    a dict of tuples that is filled on first use of a name.
+    Registrations replace the dict instead of modifying it (copy on
+    write), so lookups need no lock and a dispatch in progress is not
+    affected by a concurrent registration.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (pattern, function, predicate) in order of registration
+        self._entries = ()
+        self._table = {}
+
+    def register(self, pattern, function, predicate=None):
+        if isinstance(predicate, dict):
+            headers = predicate
+            predicate = lambda event: all \
+                (event.get_header(k) == v for k, v in headers.items())
+        with self._lock:
+            self._entries = self._entries + ((pattern, function, predicate),)
+            self._table = {}
+
+    def unregister(self, pattern, function):
+        with self._lock:
+            entries = list(self._entries)
+            for n, entry in enumerate(entries):
+                if entry[0] == pattern and entry[1] == function:
+                    del entries[n]
+                    break
+            else:
+                raise ValueError('Callback is not registered for %s' % pattern)
+            self._entries = tuple(entries)
+            self._table = {}
+
+    def patterns(self):
+        """
+        Return the set of registered event patterns.
+        """
+        return set(entry[0] for entry in self._entries)
+
+    def lookup(self, name):
+        """
+        Return the tuple of (function, predicate) pairs for an event
+        name. Callbacks for '*' come after the others.
+        """
+        table = self._table
+        try:
+            return table[name]
+        except KeyError:
+            pass
+        entries = self._entries
+        callbacks = tuple \
+            ( (function, predicate)
+              for pattern, function, predicate in entries
+              if pattern == name
+              or (pattern != '*' and _is_glob(pattern)
+                  and fnmatchcase(name, pattern))
+            ) + tuple \
+            ( (function, predicate)
+              for pattern, function, predicate in entries
+              if pattern == '*'
+            )
+        # a registration may have replaced the table meanwhile, then
+        # this entry goes to the old one and is discarded with it
+        table[name] = callbacks
+        return callbacks
+
+def _unsubscribed(frame, events, collectors):
+    """
+    Check if frame is an event nobody is interested in, these are
+    dropped before parsing. The event name is peeked from the first
+    line. While list producing actions are outstanding all events are
+    kept, they may belong to the list.
+    """
+    if collectors or not frame.startswith('Event:'):
+        return False
+    eol = frame.find('\r\n')
+    name = frame[6:eol].strip() if eol >= 0 else frame[6:].strip()
+    return not events.lookup(name)
+
+def _filter_pattern(name):
+    """
+    Regular expression for the Filter action selecting the events
+    matched by an event pattern. The manager matches it anywhere in
+    the event, so a trailing * needs no translation.
+    """
+    prefix = name.rstrip('*')
+    if not prefix or _is_glob(prefix):
+        return '.*'
+    return 'Event: ' + prefix
+
+class _EventFilter(object):
+    """
+    Server side filtering of events, used with event_filter=True.
+    Asterisk only sends the events of a session matching one of the
+    filters added with the Filter action, filters can not be removed.
+    While no callback is registered events are turned off with the
+    Events action. The update method returns the actions needed for
+    the given set of subscribed event patterns.
+    """
     def __init__(self):
+        self.added = set()
+        self.events = True
+
+    def update(self, names):
+        actions = []
+        if not names:
+            if self.events and not self.added:
+                self.events = False
+                actions.append({'Action':'Events', 'EventMask':'off'})
+            return actions
+        if not self.events:
+            self.events = True
+            actions.append({'Action':'Events', 'EventMask':'on'})
+        if '.*' in self.added:
+            return actions
+        patterns = set(_filter_pattern(name) for name in names)
+        if '.*' in patterns:
+            patterns = set(['.*'])
+        for pattern in sorted(patterns - self.added):
+            self.added.add(pattern)
+            cdict = {'Action':'Filter', 'Operation':'Add'}
+            cdict['Filter'] = pattern
+            actions.append(cdict)
+        return actions
+
+def _channel_key(event):
+    """
+    Default shard key of dispatch workers: Events of the same channel
+    are dispatched in order by the same worker.
+    """
+    return event.get_header('Uniqueid') or event.get_header('Channel')
+
+def _state_key(event):
+    """
+    Events with the same name and state key describe the state of the
+    same object, a later one makes the earlier one obsolete.
+    """
+    for header in 'Uniqueid', 'Channel', 'Exten', 'Device', 'Peer', 'Interface':
+        value = event.get_header(header)
+        if value:
+            return value
+    return None
+
+# marks an entry of an _EventQueue dropped by the drop_priority policy
+_DROPPED = object()
+
+class _EventQueue(object):
+    """
+    Queue of events waiting for dispatch. With maxsize > 0 the overload
+    policy decides what happens when an event arrives at a full queue:
+
+    block         -- the message thread waits for the dispatch, this
+                     stops reading from the socket. Callbacks must not
+                     wait for responses to actions then.
+    drop_oldest   -- the oldest queued event is dropped
+    drop_priority -- the oldest event with the lowest priority is
+                     dropped, priority maps event names to numbers
+                     (default 0). An arriving event with a lower
+                     priority than all queued events is dropped.
+    coalesce      -- a state event (see coalesce_events) replaces the
+                     last queued event of the same name and channel
+                     (or extension, device, peer) in place. Other
+                     events drop the oldest event.
+
+    The number of dropped and coalesced events and the maximum number
+    of queued events are counted. The None marking the end is always
+    queued.
+
+    The queue holds entries, one element lists of the event, so that
+    the policies find queued events in constant time: coalesce by an
+    index of the last entry of each name and state key, drop_priority
+    by a deque of entries per priority. An entry dropped from the
+    middle of the queue is marked and skipped by get.
+    """
+    policies = ('block', 'drop_oldest', 'drop_priority', 'coalesce')
+    coalesce_events = frozenset \
+        (( 'Newstate'
+         , 'ExtensionStatus'
+         , 'DeviceStateChange'
+         , 'PeerStatus'
+         , 'QueueMemberStatus'
+        ))
+
+    def __init__(self, maxsize=0, policy='block', priority=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown overload policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priority = priority or {}
+        self.queue = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_queued = 0
+        # indexes kept only when the policy needs them
+        self._indexed = maxsize and policy in ('coalesce', 'drop_priority')
+        # (name, state key) -> last queued entry
+        self._latest = {}
+        # priority -> deque of queued entries
+        self._by_priority = {}
+
+    def put(self, event):
+        with self.lock:
+            if ( event is not None and self.maxsize
+               and self.size >= self.maxsize
+               ):
+                if self.policy == 'block':
+                    while self.size >= self.maxsize:
+                        self.not_full.wait()
+                elif not self._make_room(event):
+                    return
+            entry = [event]
+            self.queue.append(entry)
+            self.size += 1
+            if self._indexed and event is not None:
+                self._index(entry)
+            if self.size > self.max_queued:
+                self.max_queued = self.size
+            self.not_empty.notify()
+
+    def get(self):
+        with self.lock:
+            while not self.size:
+                self.not_empty.wait()
+            entry = self.queue.popleft()
+            while entry[0] is _DROPPED:
+                entry = self.queue.popleft()
+            self.size -= 1
+            if self._indexed and entry[0] is not None:
+                self._unindex(entry)
+            self.not_full.notify()
+            return entry[0]
+
+    def qsize(self):
+        return self.size
+
+    def events(self):
+        """
+        The queued events, oldest first.
+        """
+        with self.lock:
+            return [e[0] for e in self.queue if e[0] is not _DROPPED]
+
+    def stats(self):
+        return dict \
+            ( queued     = self.size
+            , max_queued = self.max_queued
+            , dropped    = self.dropped
+            , coalesced  = self.coalesced
+            )
+
+    def _key(self, event):
+        if event.name not in self.coalesce_events:
+            return None
+        key = _state_key(event)
+        if key is None:
+            return None
+        return event.name, key
+
+    def _index(self, entry):
+        event = entry[0]
+        if self.policy == 'coalesce':
+            key = self._key(event)
+            if key is not None:
+                self._latest[key] = entry
+        else:
+            prio = self.priority.get(event.name, 0)
+            entries = self._by_priority.get(prio)
+            if entries is None:
+                entries = self._by_priority[prio] = deque()
+            entries.append(entry)
+
+    def _unindex(self, entry):
+        """
+        Remove the entry of the oldest queued event from the indexes.
+        """
+        event = entry[0]
+        if self.policy == 'coalesce':
+            key = self._key(event)
+            if key is not None and self._latest.get(key) is entry:
+                del self._latest[key]
+        else:
+            prio = self.priority.get(event.name, 0)
+            entries = self._by_priority[prio]
+            entries.popleft()
+            if not entries:
+                del self._by_priority[prio]
+
+    def _make_room(self, event):
+        """
+        Called with a full queue, returns False if the new event is not
+        appended: It was dropped or it replaced a queued event.
+        """
+        if self.policy == 'coalesce':
+            key = self._key(event)
+            entry = self._latest.get(key) if key is not None else None
+            if entry is not None:
+                entry[0] = event
+                self.coalesced += 1
+                return False
+        elif self.policy == 'drop_priority':
+            return self._drop_lowest(event)
+        entry = self.queue.popleft()
+        self.size -= 1
+        if self._indexed and entry[0] is not None:
+            self._unindex(entry)
+        self.dropped += 1
+        return True
+
+    def _drop_lowest(self, event):
+        self.dropped += 1
+        if not self._by_priority:
+            return False
+        lowest = min(self._by_priority)
+        if self.priority.get(event.name, 0) < lowest:
+            return False
+        entries = self._by_priority[lowest]
+        entry = entries.popleft()
+        if not entries:
+            del self._by_priority[lowest]
+        entry[0] = _DROPPED
+        self.size -= 1
+        if len(self.queue) > 2 * self.maxsize:
+            # remove the marked entries of a queue not served
+            self.queue = deque(e for e in self.queue if e[0] is not _DROPPED)
+        return True
+
+class _DispatchWorker(object):
+    """
+    Thread dispatching the events of one shard, used with
+    Manager(dispatch_workers=n). Counts the dispatched events.
+    """
+    def __init__(self, manager, n, queue):
+        self.manager = manager
+        self.queue = queue
+        self.dispatched = 0
+        self.thread = threading.Thread \
+            (target=self.run, name='event-dispatch-%d' % n)
+        self.thread.setDaemon(True)
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def run(self):
+        while True:
+            ev = self.queue.get()
+            if not ev:
+                break
+            self.manager._dispatch(ev)
+            self.dispatched += 1
+
+    def stats(self):
+        stats = self.queue.stats()
+        stats['dispatched'] = self.dispatched
+        return stats
+
+# put into the message queue by the receiving thread when the
+# connection is lost in reconnect mode
+_DISCONNECTED = object()
+
+def _action(build, sender='send_action'):
+    """
+    Decorator for the action helpers of Manager. The decorated method
+    only builds the dictionary of the action, the resulting method
+    sends it with the method named by sender and waits for the
+    response. The original method is kept as build_action,
+    _with_async_actions uses it for the variant with an _async suffix
+    which returns a future instead.
+    """
+    @functools.wraps(build)
+    def action(self, *args, **kwargs):
+        return getattr(self, sender)(build(self, *args, **kwargs))
+    action.build_action = build
+    action.sender = sender
+    return action
+
+def _list_action(build):
+    """
+    Decorator for action helpers returning an EventList.
+    """
+    return _action(build, 'send_list_action')
+
+def _async_action(build, sender):
+    sender = sender + '_async'
+    @functools.wraps(build)
+    def action_async(self, *args, **kwargs):
+        return getattr(self, sender)(build(self, *args, **kwargs))
+    action_async.__name__ = build.__name__ + '_async'
+    action_async.__doc__ = ( (build.__doc__ or '')
+                           + '\n\n        Returns a future, see %s' % sender
+                           )
+    return action_async
+
+def _with_async_actions(cls):
+    """
+    Class decorator adding an _async variant for each _action helper.
+    """
+    for name, method in list(vars(cls).items()):
+        build = getattr(method, 'build_action', None)
+        if build is not None:
+            setattr(cls, name + '_async', _async_action(build, method.sender))
+    return cls
+
+@_with_async_actions
+class Manager(object):
+    # size of chunks read from the socket
+    bufsize = 65536
+
+    # actions that are sent again when the connection is reestablished
+    # in reconnect mode, other actions fail when the connection is lost
+    idempotent_actions = frozenset \
+        (( 'Ping'
+         , 'Status'
+         , 'CoreStatus'
+         , 'CoreSettings'
+         , 'CoreShowChannels'
+         , 'Sippeers'
+         , 'SIPshowpeer'
+         , 'ExtensionState'
+         , 'MailboxStatus'
+         , 'MailboxCount'
+         , 'Getvar'
+         , 'QueueStatus'
+         , 'QueueSummary'
+        ))
+
+    def __init__(self, timeout=None, event_filter=False,
+                 dispatch_workers=0, shard_key=_channel_key,
+                 max_queued=0, overload='block', event_priority=None,
+                 reconnect=False, reconnect_delay=1, reconnect_max_delay=60,
+                 write_delay=0, write_budget=65536, metrics=None,
+                 recorder=None):
         self._sock = None     # our socket
+        self.host = None      # set by connect
+        self.port = None
         self.title = None     # set by received greeting
         self._connected = threading.Event()
         self._running = threading.Event()
@@ -179,15 +988,73 @@ class Manager(object):
         # pid -- used for unique naming of ActionID
         self.pid      = os.getpid ()
 
-        # our queues
-        self._message_queue = Queue()
-        self._response_queue = Queue()
-        self._event_queue = Queue()
+        # default number of seconds to wait for the response to an
+        # action, None waits forever
+        self.timeout = timeout
+
+        # with event_filter asterisk is asked to send only the events
+        # we have callbacks for, the _EventFilter is created on login
+        self.event_filter = event_filter
+        self._filter = None
+
+        # In reconnect mode a lost connection is reestablished, waiting
+        # reconnect_delay seconds after the first failed attempt,
+        # doubling up to reconnect_max_delay. We login again with the
+        # credentials of the last login and send the actions in
+        # idempotent_actions that were still waiting for a response.
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self._backoff = 0
+        self._credentials = None
+        self._replayed = []
+        self._reconnect_hooks = []
+        self._closing = threading.Event()
+        # set by the message thread when the actions of the lost
+        # connection were failed or kept for replay
+        self._aborted = threading.Event()
+        # the thread resuming the session after a reconnect
+        self._resumer = None
+
+        # our queues, with max_queued > 0 they are bounded: When the
+        # event queue is full the overload policy applies, see
+        # _EventQueue. Received messages wait in a queue of the same
+        # size, when it is full we stop reading from the socket.
+        self._message_queue = Queue(max_queued)
+        self._new_event_queue = functools.partial \
+            (_EventQueue, max_queued, overload, event_priority)
+        self._event_queue = self._new_event_queue()
 
         # callbacks for events
-        self._event_callbacks = {}
-
-        self._reswaiting = []  # who is waiting for a response
+        self._events = _EventTable()
+
+        # Futures of actions waiting for a response indexed by ActionID
+        self._pending = {}
+        # _EventCollector of list producing actions indexed by ActionID
+        self._collectors = {}
+        self._pending_lock = threading.Lock()
+        # Actions may be sent when the session is ready: After connect
+        # and after a reconnect when the resumer has logged in again
+        # and sent the replayed actions. Guarded by _pending_lock.
+        self._ready = False
+        self._session = threading.Condition(self._pending_lock)
+        # serializes writes of concurrent actions to the socket
+        self._sendlock = threading.Lock()
+
+        # Actions are coalesced into one write: Those sent by a thread
+        # inside a batch (kept in _batch which is thread local) and
+        # with write_delay > 0 all others for write_delay seconds
+        # (kept in _wbuf). A buffer is written when it reaches
+        # write_budget bytes. Buffered actions belong to the connection
+        # they were sent on: the generation counts the lost connections,
+        # actions of an earlier one are never written to the next.
+        self.write_delay = write_delay
+        self.write_budget = write_budget
+        self._batch = threading.local()
+        self._wbuf = []
+        self._wsize = 0
+        self._timer = None
+        self._generation = 0
 
         # sequence stuff
         self._seqlock = threading.Lock()
@@ -200,6 +1067,29 @@ class Manager(object):
         self.message_thread.setDaemon(True)
         self.event_dispatch_thread.setDaemon(True)
 
+        # With dispatch_workers > 0 callbacks run in that many worker
+        # threads, the event_dispatch_thread only hands each event to
+        # the worker selected by shard_key(event). Events with the same
+        # key (by default of the same channel) keep their order, a slow
+        # callback only delays the events of its shard.
+        self.shard_key = shard_key
+        self._workers = [_DispatchWorker(self, n, self._new_event_queue())
+                         for n in range(dispatch_workers)]
+
+        # optional asterisk.record.Recorder writing all received data
+        self.recorder = recorder
+
+        # optional asterisk.metrics.Metrics, every hook checks for None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.gauge('event_queue_depth',
+                lambda: self._event_queue.stats()['queued'])
+            metrics.gauge('message_queue_depth', self._message_queue.qsize)
+            metrics.gauge('pending_actions', lambda: len(self._pending))
+            metrics.counter('events_dropped_total', lambda: sum
+                (q.stats()['dropped'] for q in
+                 [self._event_queue] + [w.queue for w in self._workers]))
+
 
     def __del__(self):
         self.close()
@@ -219,7 +1109,11 @@ class Manager(object):
             self._seq += 1
             self._seqlock.release()
 
-    def send_action(self, cdict={}, **kwargs):
+    def next_action_id(self):
+        """Return a new ActionID, for actions that need it before sending"""
+        return '%s-%04s-%08x' % (self.hostname, self.pid, self.next_seq())
+
+    def send_action(self, cdict={}, timeout=None, **kwargs):
         """
         Send a command to the manager
 
@@ -235,136 +1129,539 @@ class Manager(object):
         Action: Originate
         Variable: var1=value
         Variable: var2=value
+
+        The response is matched to the action by its ActionID, so any
+        number of threads may have actions outstanding on the same
+        connection. If no response arrives within timeout seconds
+        (default is the timeout given to the constructor) a
+        ManagerTimeoutException is raised.
+        """
+        future = self.send_action_async(cdict, **kwargs)
+        return self._wait(future, future.action_id, timeout)
+
+    def send_action_async(self, cdict={}, **kwargs):
         """
+        Send a command to the manager without waiting for the response.
 
+        Arguments are the same as for send_action. The action is
+        written immediately, the return value is a
+        concurrent.futures.Future that is resolved with the response
+        by the message thread. This allows pipelining many actions
+        over one connection, e.g.
+
+        futures = [manager.hangup_async(c) for c in channels]
+        concurrent.futures.wait(futures)
+
+        The ActionID of the action is available as future.action_id.
+        Cancelling the future discards the response. If the connection
+        terminates the future raises ManagerSocketException.
+        """
+        return self._send(cdict, kwargs)
+
+    def send_list_action(self, cdict={}, timeout=None, **kwargs):
+        """
+        Send a list producing action (e.g. Status, Sippeers or
+        CoreShowChannels) and return all events sent in reply as an
+        EventList. The events are collected by their ActionID until the
+        completion event arrives, they are not passed to the event
+        callbacks. The timeout applies to the whole list. A failed
+        action returns an empty EventList: Check its error (or
+        response) to tell it from an empty list, e.g.
+
+        channels = manager.status_list()
+        if channels.error is not None:
+            raise ManagerException(channels.error)
+        """
+        future = self.send_list_action_async(cdict, **kwargs)
+        return self._wait(future, future.action_id, timeout)
+
+    def send_list_action_async(self, cdict={}, **kwargs):
+        """
+        Like send_list_action but return a future for the EventList.
+        """
+        return self._send(cdict, kwargs, _EventCollector())
+
+    def iter_list_action(self, cdict={}, timeout=None, maxsize=100, **kwargs):
+        """
+        Send a list producing action and return an EventStream
+        iterating over the events sent in reply as they arrive, e.g.
+
+        for event in manager.iter_list_action({'Action' : 'Status'}):
+            print (event['Channel'])
+
+        At most maxsize events are buffered for a slow consumer, the
+        timeout applies to the wait for each event. Call close on the
+        stream (or use it in a with statement) when stopping the
+        iteration early. Do not wait for responses to actions inside
+        the loop, see EventStream.
+        """
+        stream = EventStream(maxsize)
+        stream.timeout = self.timeout if timeout is None else timeout
+        stream.action_id = \
+            self._send(cdict, kwargs, stream._collector).action_id
+        self.flush()
+        return stream
+
+    def _send(self, cdict, kwargs, collector=None):
+        """
+        Write the action and return the future for its result.
+        """
         if not self._connected.isSet():
             raise ManagerException("Not connected")
 
-        # fill in our args
-        cdict.update(kwargs)
+        # fill in our args, don't modify the dict of the caller
+        cdict = dict(cdict, **kwargs)
 
         # set the action id
         if 'ActionID' not in cdict:
-            cdict['ActionID'] = '%s-%04s-%08x' % (self.hostname,
-                self.pid, self.next_seq())
-        clist = []
-
-        # generate the command
-        for key, value in cdict.items():
-            if isinstance(value, list):
-               for item in value:
-                  item = tuple([key, item])
-                  clist.append('%s: %s' % item)
-            else:
-               item = tuple([key, value])
-               clist.append('%s: %s' % item)
-        clist.append(EOL)
-        command = EOL.join(clist)
+            cdict['ActionID'] = self.next_action_id()
+        action_id = cdict['ActionID']
+        command = _format_action(cdict)
+
+        # register before sending, the response may be faster than we are
+        future = Future()
+        future.action_id = action_id
+        future.command = command
+        future.replay = cdict.get('Action') in self.idempotent_actions
+        with self._pending_lock:
+            if threading.currentThread() is not self._resumer:
+                self._wait_ready()
+            if not self._connected.isSet():
+                raise ManagerException("Not connected")
+            generation = self._generation
+            self._pending[action_id] = future
+            if collector is not None:
+                self._collectors[action_id] = collector
+        future.add_done_callback(self._cancelled)
+        if self.metrics is not None:
+            self._measure(future, cdict.get('Action'), len(command))
+
+        batch = self._batch
+        if getattr(batch, 'depth', 0):
+            if batch.generation != generation:
+                # the actions of a lost connection are not written
+                batch.buffer = []
+                batch.size = 0
+                batch.generation = generation
+            batch.buffer.append(command)
+            batch.size += len(command)
+            if batch.size >= self.write_budget:
+                self.flush()
+            return future
 
         # lock the socket and send our command
         try:
-            self._sock.write(command.encode('utf-8'))
-            self._sock.flush()
+            with self._sendlock:
+                if generation != self._generation:
+                    # the connection was lost meanwhile, the message
+                    # thread fails or replays the action
+                    pass
+                elif self.write_delay:
+                    self._delay(command)
+                else:
+                    self._sock.sendall(command)
         except socket.error as err:
-            errno, reason = err
-            raise ManagerSocketException(errno, reason)
+            self._forget(action_id)
+            raise ManagerSocketException(err.errno, err.strerror)
 
-        self._reswaiting.insert(0,1)
-        response = self._response_queue.get()
-        self._reswaiting.pop(0)
+        return future
 
-        if not response:
-            raise ManagerSocketException(0, 'Connection Terminated')
+    def _wait_ready(self):
+        """
+        Wait while the session is resumed after a reconnect, called
+        with _pending_lock held.
+        """
+        end = None if self.timeout is None else time() + self.timeout
+        while not self._ready and self._connected.isSet():
+            wait = None if end is None else end - time()
+            if wait is not None and wait <= 0:
+                raise ManagerTimeoutException \
+                    ('Timeout waiting for the session to be resumed')
+            self._session.wait(wait)
+
+    def _measure(self, future, action, size):
+        """
+        Count an action and record its round trip time when the future
+        is resolved.
+        """
+        metrics = self.metrics
+        metrics.inc('actions_total', action)
+        metrics.inc('bytes_sent_total', None, size)
+        start = time()
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                metrics.inc('action_errors_total', action)
+            else:
+                metrics.observe('action_rtt_seconds', action, time() - start)
+        future.add_done_callback(done)
 
-        return response
+    def _delay(self, command):
+        """
+        Buffer a command for write_delay seconds, called with _sendlock.
+        """
+        self._wbuf.append(command)
+        self._wsize += len(command)
+        if self._wsize >= self.write_budget:
+            self._write_locked()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.write_delay, self._expired)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def _expired(self):
+        try:
+            self._write()
+        except ManagerSocketException:
+            # the receiving thread fails the pending actions
+            pass
+
+    def _write_locked(self, data=b''):
+        """
+        Write the delayed commands followed by data in one call, called
+        with _sendlock.
+        """
+        if self._wbuf:
+            data = b''.join(self._wbuf) + data
+            self._wbuf = []
+            self._wsize = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if data:
+            self._sock.sendall(data)
+
+    def _write(self, data=b'', generation=None):
+        """
+        Write the delayed commands followed by data, data is dropped if
+        it was buffered for a connection (generation) that is lost.
+        """
+        try:
+            with self._sendlock:
+                if generation is not None and generation != self._generation:
+                    data = b''
+                self._write_locked(data)
+        except socket.error as err:
+            # make the receiving thread fail the pending actions
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            raise ManagerSocketException(err.errno, err.strerror)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager for sending many actions with few writes: The
+        actions sent by the calling thread inside the with statement
+        are buffered and written at its end (or when write_budget
+        bytes are buffered), e.g.
+
+        with manager.batch():
+            futures = [manager.hangup_async(c) for c in channels]
+
+        Waiting for a response inside the batch (e.g. with send_action)
+        writes the buffered actions first. Batches may be nested.
+        """
+        batch = self._batch
+        if not getattr(batch, 'depth', 0):
+            batch.depth = 0
+            batch.buffer = []
+            batch.size = 0
+            batch.generation = self._generation
+        batch.depth += 1
+        try:
+            yield self
+        finally:
+            batch.depth -= 1
+            if not batch.depth:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the actions buffered by a batch of the calling thread
+        and those delayed by write_delay.
+        """
+        data = b''
+        generation = None
+        batch = self._batch
+        if getattr(batch, 'buffer', None):
+            data = b''.join(batch.buffer)
+            generation = batch.generation
+            batch.buffer = []
+            batch.size = 0
+        if data or self._wbuf:
+            self._write(data, generation)
+
+    def _wait(self, future, action_id, timeout=None):
+        """
+        Wait for the response future of the given ActionID.
+        """
+        # the action may still be buffered
+        self.flush()
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise ManagerTimeoutException \
+                ('Timeout waiting for response to %s' % action_id)
+
+    def _forget(self, action_id):
+        """
+        Stop waiting for a response, a late response is discarded.
+        """
+        with self._pending_lock:
+            self._pending.pop(action_id, None)
+            self._collectors.pop(action_id, None)
+
+    def _cancelled(self, future):
+        if future.cancelled():
+            self._forget(future.action_id)
+
+    def _resolve(self, message):
+        """
+        Hand a response to the action waiting for it.
+        """
+        action_id = message.get_header('ActionID')
+        # collectors are only used by the message thread, no need to
+        # hold the lock while feeding them
+        collector = self._collectors.get(action_id)
+        if collector is not None:
+            if collector.add_response(message):
+                self._finish(action_id, collector)
+            # otherwise the events of the list will follow
+            return
+        with self._pending_lock:
+            future = self._pending.pop(action_id, None)
+            # Some responses carry no ActionID (the greeting or
+            # misbehaving commands), these go to the oldest waiter
+            if future is None and action_id is None and self._pending:
+                future = self._pending.pop(next(iter(self._pending)))
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_result(message)
+
+    def _collect(self, event):
+        """
+        Hand an event to the list producing action it belongs to,
+        returns False if there is none.
+        """
+        action_id = event.get_header('ActionID')
+        collector = self._collectors.get(action_id)
+        if collector is None:
+            return False
+        if collector.add_event(event):
+            self._finish(action_id, collector)
+        return True
+
+    def _finish(self, action_id, collector):
+        with self._pending_lock:
+            self._collectors.pop(action_id, None)
+            future = self._pending.pop(action_id, None)
+        if future is not None and future.set_running_or_notify_cancel():
+            future.set_result(collector.result())
+
+    def _abort_pending(self, replay=False):
+        """
+        Fail all actions still waiting for a response. With replay the
+        idempotent actions are kept to be sent again after reconnect,
+        except for streams that have already yielded events.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            collectors, self._collectors = self._collectors, {}
+            self._replayed = []
+            for action_id, future in list(pending.items()):
+                collector = collectors.get(action_id)
+                if replay and action_id is None:
+                    # the greeting of the new connection
+                    self._pending[None] = pending.pop(None)
+                    continue
+                if ( not replay or not getattr(future, 'replay', False)
+                   or isinstance(collector, _StreamCollector)
+                   ):
+                    continue
+                self._pending[action_id] = pending.pop(action_id)
+                if collector is not None:
+                    collector.restart()
+                    self._collectors[action_id] = collectors.pop(action_id)
+                self._replayed.append(future)
+        exc = ManagerSocketException(0, 'Connection Terminated')
+        for collector in collectors.values():
+            collector.abort(exc)
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exc)
 
     def _receive_data(self):
         """
-        Read the response from a command.
+        Read data from the manager in large chunks and queue the
+        messages contained in it. In reconnect mode a lost connection
+        is reestablished.
         """
 
-        multiline = False
-        wait_for_marker = False
-        eolcount = 0
-        # loop while we are sill running and connected
-        while self._running.isSet() and self._connected.isSet():
-            try:
-                lines = []
-                for line in self._sock :
-                    line = line.decode('utf-8')
-                    # check to see if this is the greeting line
-                    if not self.title and '/' in line and not ':' in line:
-                        # store the title of the manager we are connecting to:
-                        self.title = line.split('/')[0].strip()
-                        # store the version of the manager we are connecting to:
-                        self.version = line.split('/')[1].strip()
-                        # fake message header
-                        lines.append ('Response: Generated Header\r\n')
-                        lines.append (line)
-                        break
-                    # If the line is EOL marker we have a complete message.
-                    # Some commands are broken and contain a \n\r\n
-                    # sequence, in the case wait_for_marker is set, we
-                    # have such a command where the data ends with the
-                    # marker --END COMMAND--, so we ignore embedded
-                    # newlines until we see that marker
-                    if line == EOL and not wait_for_marker :
-                        multiline = False
-                        if lines or not self._connected.isSet():
-                            break
-                        # ignore empty lines at start
-                        continue
-                    lines.append(line)
-                    # line not ending in \r\n or without ':' isn't a
-                    # valid header and starts multiline response
-                    if not line.endswith('\r\n') or ':' not in line:
-                        multiline = True
-                    # Response: Follows indicates we should wait for end
-                    # marker --END COMMAND--
-                    if not multiline and line.startswith('Response') and \
-                        line.split(':', 1)[1].strip() == 'Follows':
-                        wait_for_marker = True
-                    # same when seeing end of multiline response
-                    if multiline and line.startswith('--END COMMAND--'):
-                        wait_for_marker = False
-                        multiline = False
-                    if not self._connected.isSet():
-                        break
-                else:
+        while True:
+            self._read_messages()
+            if not self.reconnect or self._closing.isSet():
+                break
+            # the message thread fails actions that are not replayed
+            self._aborted.clear()
+            self._message_queue.put(_DISCONNECTED)
+            if not self._reopen():
+                break
+        self._message_queue.put(None)
+
+    def _read_messages(self):
+        framer = _Framer()
+        if self.recorder is not None:
+            self.recorder.connected()
+        try:
+            # loop while we are sill running and connected
+            while self._running.isSet() and self._connected.isSet():
+                data = self._sock.recv(self.bufsize)
+                if not data:
                     # EOF during reading
-                    self._sock.close()
-                    self._connected.clear()
-                # if we have a message append it to our queue
-                if lines and self._connected.isSet():
-                    self._message_queue.put(lines)
-                else:
-                    self._message_queue.put(None)
+                    break
+                if self.recorder is not None:
+                    self.recorder.write(data)
+                if self.metrics is not None:
+                    self.metrics.inc('bytes_received_total', None, len(data))
+                for frame in framer.feed(data):
+                    if not _unsubscribed \
+                        (frame, self._events, self._collectors):
+                        self._message_queue.put(frame)
+                if framer.title and not self.title:
+                    # store the title and version of the manager we
+                    # are connecting to
+                    self.title = framer.title
+                    self.version = framer.version
+        except socket.error:
+            pass
+        self._sock.close()
+        with self._session:
+            self._connected.clear()
+            self._ready = False
+            self._generation += 1
+            self._session.notify_all()
+        with self._sendlock:
+            # the message thread fails (or replays) the delayed actions
+            self._wbuf = []
+            self._wsize = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _reopen(self):
+        """
+        Connect again with exponential backoff, the session is resumed
+        by a separate thread while we receive its responses. Returns
+        False if the manager was closed meanwhile.
+        """
+        while not self._closing.wait(self._backoff):
+            self._backoff = min \
+                ( max(2 * self._backoff, self.reconnect_delay)
+                , self.reconnect_max_delay
+                )
+            try:
+                sock = self._open(self.host, self.port)
+            except ManagerSocketException:
+                continue
+            greeting = self._expect_greeting()
+            self._sock = sock
+            self._connected.set()
+            t = threading.Thread(target=self._resume, args=(greeting,))
+            t.setDaemon(True)
+            self._resumer = t
+            t.start()
+            return True
+        return False
+
+    def _resume(self, greeting):
+        """
+        Login again and send the actions still waiting for a response.
+        Other threads wait in _send until this is done.
+        """
+        # the actions of the lost connection must be sorted out before
+        # we register new ones
+        self._aborted.wait()
+        try:
+            self._wait(greeting, None)
+            if self._credentials:
+                self.login(*self._credentials)
+            with self._pending_lock:
+                replayed = [f for f in self._replayed
+                            if f.action_id in self._pending]
+                self._replayed = []
+            with self._sendlock:
+                for future in replayed:
+                    self._sock.sendall(future.command)
+        except (ManagerException, socket.error):
+            # make the receiving thread try again
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
             except socket.error:
-                self._sock.close()
-                self._connected.clear()
-                self._message_queue.put(None)
+                pass
+            return
+        self._backoff = 0
+        with self._session:
+            self._ready = True
+            self._session.notify_all()
+        for function in list(self._reconnect_hooks):
+            function(self)
+
+    def register_reconnect(self, function):
+        """
+        Register a function called with the manager after the
+        connection was reestablished in reconnect mode, i.e., after
+        login and sending the pending idempotent actions again. Events
+        may have been lost meanwhile, use this to resync state, e.g.
+        with status_list.
+        """
+        self._reconnect_hooks.append(function)
 
+    def unregister_reconnect(self, function):
+        """
+        Unregister a function registered with register_reconnect.
+        """
+        self._reconnect_hooks.remove(function)
 
-    def register_event(self, event, function):
+    def register_event(self, event, function, predicate=None):
         """
         Register a callback for the specfied event.
         If a callback function returns True, no more callbacks for that
         event will be executed.
+        The event may be given as '*' for all events or as a shell
+        style pattern, e.g. 'Queue*' or 'Agent[CD]*'. Callbacks for '*'
+        are called after the others. With a predicate the callback is
+        only called for events it accepts: Either a function called
+        with the event returning True for wanted events or a dict of
+        header values, e.g.
+
+        manager.register_event('Hangup', on_hangup, {'Context':'from-pstn'})
+
+        Registering is thread safe and may be done from callbacks.
+        Events without a callback are dropped before they are parsed.
+        When the manager was created with event_filter=True a Filter
+        action for the event is sent to asterisk, too.
         """
-
-        # get the current value, or an empty list
-        # then add our new callback
-        current_callbacks = self._event_callbacks.get(event, [])
-        current_callbacks.append(function)
-        self._event_callbacks[event] = current_callbacks
+        self._events.register(event, function, predicate)
+        self._update_filter()
 
     def unregister_event(self, event, function):
         """
         Unregister a callback for the specified event.
         """
-        current_callbacks = self._event_callbacks.get(event, [])
-        current_callbacks.remove(function)
-        self._event_callbacks[event] = current_callbacks
+        self._events.unregister(event, function)
+
+    def _update_filter(self):
+        """
+        Send the actions for server side filtering of events.
+        """
+        if self._filter is None:
+            return
+        for cdict in self._filter.update(self._events.patterns()):
+            # nobody is interested in the response
+            self.send_action_async(cdict)
 
     def message_loop(self):
         """
@@ -384,26 +1681,41 @@ class Manager(object):
                 # get/wait for messages
                 data = self._message_queue.get()
 
+                # the connection is lost and will be reestablished
+                if data is _DISCONNECTED:
+                    self._abort_pending(replay=True)
+                    self._aborted.set()
+                    continue
+
                 # if we got None as our message we are done
                 if not data:
-                    # notify the other queues
+                    # notify the event queue and everybody waiting
                     self._event_queue.put(None)
-                    for waiter in self._reswaiting:
-                        self._response_queue.put(None)
+                    self._abort_pending()
+                    self._aborted.set()
                     break
 
+                if self.metrics is not None:
+                    start = time()
+
                 # parse the data
                 message = ManagerMsg(data)
 
                 # check if this is an event message
-                if message.has_header('Event'):
-                    self._event_queue.put(Event(message))
+                if message.is_event():
+                    event = Event(message, self.host)
+                    if self.metrics is not None:
+                        event.received = start
+                    if not self._collectors or not self._collect(event):
+                        self._event_queue.put(event)
                 # check if this is a response
                 elif message.has_header('Response'):
-                    self._response_queue.put(message)
+                    self._resolve(message)
                 else:
-                    self._response_queue.put(None)
                     print ('No clue what we got\n%s' % message.data)
+
+                if self.metrics is not None:
+                    self.metrics.observe('parse_seconds', None, time() - start)
         finally:
             # wait for our data receiving thread to exit
             t.join()
@@ -419,18 +1731,54 @@ class Manager(object):
 
             # if we got None as an event, we are finished
             if not ev:
+                for worker in self._workers:
+                    worker.put(None)
                 break
 
-            # dispatch our events
+            if self._workers:
+                key = self.shard_key(ev)
+                self._workers[hash(key) % len(self._workers)].put(ev)
+            else:
+                self._dispatch(ev)
+
+    def queue_stats(self):
+        """
+        Return a dict with the number of events queued for dispatch,
+        the maximum number queued so far, the number of events dropped
+        and coalesced by the overload policy and the number of received
+        messages waiting for the message thread.
+        """
+        stats = self._event_queue.stats()
+        stats['messages'] = self._message_queue.qsize()
+        return stats
 
-            # first build a list of the functions to execute
-            callbacks = (self._event_callbacks.get(ev.name, [])
-                      +  self._event_callbacks.get('*', []))
+    def dispatch_stats(self):
+        """
+        Return a list with the event queue statistics (as returned by
+        queue_stats) of each dispatch worker and its number of
+        dispatched events. Without workers the list is
+        empty.
+        """
+        return [worker.stats() for worker in self._workers]
 
-            # now execute the functions
-            for callback in callbacks:
-               if callback(ev, self):
-                  break
+    def _dispatch(self, ev):
+        """
+        Call the callbacks registered for the event.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time()
+            metrics.inc('events_total', ev.name)
+            received = getattr(ev, 'received', None)
+            if received is not None:
+                metrics.observe('event_queue_seconds', ev.name, start - received)
+        for callback, predicate in self._events.lookup(ev.name):
+            if predicate is not None and not predicate(ev):
+                continue
+            if callback(ev, self):
+                break
+        if metrics is not None:
+            metrics.observe('callback_seconds', ev.name, time() - start)
 
     def connect(self, host, port=5038):
         """Connect to the manager interface"""
@@ -443,22 +1791,34 @@ class Manager(object):
 
         port = int(port)  # make sure port is an int
 
-        # create our socket and connect
-        try:
-            if host.find(":") >= 0:
-                _sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                _sock.connect((host,port,0,0))
-            else:
-                _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                _sock.connect((host,port))
-            self._sock = _sock.makefile(mode='rwb')
-            _sock.close()
-        except socket.error as err:
-            errno, reason = err
-            raise ManagerSocketException(errno, reason)
+        return self._start(self._open(host, port), host, port)
+
+    def replay(self, source):
+        """
+        Receive the byte stream of a recording instead of connecting to
+        a manager, source is an asterisk.record.Replay. Events are
+        dispatched to the registered callbacks as if they were received
+        from asterisk, the end of the recording closes the connection.
+        Actions get an error response.
+        """
+        if self._connected.isSet():
+            raise ManagerException('Already connected to manager')
+        return self._start(source, source.host, None)
+
+    def _start(self, sock, host, port):
+        """
+        Start the threads for a new connection, returns the greeting.
+        """
+        self._sock = sock
+        self.host = host
+        self.port = port
+        self._closing.clear()
+        greeting = self._expect_greeting()
 
         # we are connected and running
-        self._connected.set()
+        with self._session:
+            self._connected.set()
+            self._ready = True
         self._running.set()
 
         # start the event thread
@@ -466,13 +1826,47 @@ class Manager(object):
 
         # start the event dispatching thread
         self.event_dispatch_thread.start()
+        for worker in self._workers:
+            worker.thread.start()
 
         # get our initial connection response
-        return self._response_queue.get()
+        return self._wait(greeting, None)
+
+    def _open(self, host, port):
+        """
+        Create our socket and connect.
+        """
+        try:
+            if host.find(":") >= 0:
+                _sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                _sock.connect((host,port,0,0))
+            else:
+                _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                _sock.connect((host,port))
+        except socket.error as err:
+            raise ManagerSocketException(err.errno, err.strerror)
+        return _sock
+
+    def _expect_greeting(self):
+        """
+        Return the future for the greeting of a new connection.
+        """
+        # filters are per session
+        self._filter = None
+
+        # the greeting has no ActionID, it is the first response
+        greeting = Future()
+        greeting.action_id = None
+        with self._pending_lock:
+            self._pending[None] = greeting
+        return greeting
 
     def close(self):
         """Shutdown the connection to the manager"""
 
+        # no reconnect after logoff
+        self._closing.set()
+
         # if we are still running, logout
         if self._running.isSet() and self._connected.isSet():
             self.logoff()
@@ -485,9 +1879,11 @@ class Manager(object):
             self.message_thread.join()
 
             # make sure we do not join our self (when close is called from event handlers)
-            if threading.currentThread() != self.event_dispatch_thread:
-                # wait for the dispatch thread to exit
-                self.event_dispatch_thread.join()
+            for thread in [self.event_dispatch_thread] + \
+                [worker.thread for worker in self._workers]:
+                if threading.currentThread() != thread:
+                    # wait for the dispatch thread to exit
+                    thread.join()
 
         self._running.clear()
 
@@ -504,40 +1900,45 @@ class Manager(object):
         if response.get_header('Response') == 'Error':
            raise ManagerAuthException(response.get_header('Message'))
 
+        # for login after reconnect
+        self._credentials = (username, secret)
+
+        if self.event_filter:
+            self._filter = _EventFilter()
+            self._update_filter()
+
         return response
 
+    @_action
     def ping(self):
         """Send a ping action to the manager"""
         cdict = {'Action':'Ping'}
-        response = self.send_action(cdict)
-        return response
+        return cdict
 
+    @_action
     def logoff(self):
         """Logoff from the manager"""
 
         cdict = {'Action':'Logoff'}
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def hangup(self, channel):
         """Hangup the specified channel"""
 
         cdict = {'Action':'Hangup'}
         cdict['Channel'] = channel
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def status(self, channel = ''):
         """Get a status message from asterisk"""
 
         cdict = {'Action':'Status'}
         cdict['Channel'] = channel
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def redirect(self, channel, exten, priority='1', extra_channel='', context=''):
         """Redirect a channel"""
 
@@ -547,10 +1948,9 @@ class Manager(object):
         cdict['Priority'] = priority
         if context:   cdict['Context']  = context
         if extra_channel: cdict['ExtraChannel'] = extra_channel
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def originate(self, channel, exten, context='', priority='', timeout='', caller_id='', run_async=False, account='', variables={}):
         """Originate a call"""
 
@@ -565,77 +1965,90 @@ class Manager(object):
         if account:   cdict['Account']  = account
         if variables: cdict['Variable'] = ['='.join((str(key), str(value))) for key, value in variables.items()]
 
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def mailbox_status(self, mailbox):
         """Get the status of the specfied mailbox"""
 
         cdict = {'Action':'MailboxStatus'}
         cdict['Mailbox'] = mailbox
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def command(self, command):
         """Execute a command"""
 
         cdict = {'Action':'Command'}
         cdict['Command'] = command
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def extension_state(self, exten, context):
         """Get the state of an extension"""
 
         cdict = {'Action':'ExtensionState'}
         cdict['Exten'] = exten
         cdict['Context'] = context
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def playdtmf (self, channel, digit) :
         """Plays a dtmf digit on the specified channel"""
         cdict = {'Action':'PlayDTMF'}
         cdict['Channel'] = channel
         cdict['Digit'] = digit
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def absolute_timeout(self, channel, timeout):
         """Set an absolute timeout on a channel"""
 
         cdict = {'Action':'AbsoluteTimeout'}
         cdict['Channel'] = channel
         cdict['Timeout'] = timeout
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def mailbox_count(self, mailbox):
         cdict = {'Action':'MailboxCount'}
         cdict['Mailbox'] = mailbox
-        response = self.send_action(cdict)
-
-        return response
+        return cdict
 
+    @_action
     def sippeers(self):
         cdict = {'Action' : 'Sippeers'}
-        response = self.send_action(cdict)
-        return response
+        return cdict
 
+    @_action
     def sipshowpeer(self, peer):
         cdict = {'Action' : 'SIPshowpeer'}
         cdict['Peer'] = peer
-        response = self.send_action(cdict)
-        return response
+        return cdict
+
+    @_list_action
+    def status_list(self, channel = ''):
+        """Get the Status events of all (or the given) channels"""
+
+        cdict = {'Action':'Status'}
+        if channel: cdict['Channel'] = channel
+        return cdict
+
+    @_list_action
+    def sippeers_list(self):
+        """Get the PeerEntry events of all SIP peers"""
+        cdict = {'Action' : 'Sippeers'}
+        return cdict
+
+    @_list_action
+    def core_show_channels(self):
+        """Get the CoreShowChannel events of all active channels"""
+        cdict = {'Action' : 'CoreShowChannels'}
+        return cdict
 
 
 class ManagerException(Exception): pass
 class ManagerSocketException(ManagerException): pass
 class ManagerAuthException(ManagerException): pass
+class ManagerTimeoutException(ManagerException): pass
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Instrumentation of the Manager Interface
+
+A Metrics object passed to the Manager counts actions, events and bytes
+and records latencies in histograms: The round trip time of each
+action, the time events wait in the event queue, the time spent in the
+callbacks of an event and the time to process each received message.
+Gauges report the queue depths when exported, counters kept elsewhere
+(e.g. the events dropped by the event queue) are read on export, too.
+Without metrics the manager only pays for a check of manager.metrics.
+
+   import asterisk.manager
+   from asterisk.metrics import Metrics
+
+   metrics = Metrics()
+   manager = asterisk.manager.Manager(metrics = metrics)
+   manager.connect('host')
+   manager.login('user', 'secret')
+   ...
+   print (metrics.as_dict()['histograms']['action_rtt_seconds'])
+   # e.g. served by a http handler for prometheus
+   text = metrics.prometheus()
+
+Metrics are labelled by the action or event name. Gauges and counter
+functions are registered by the manager, use one Metrics object per manager.
+"""
+
+import bisect
+import threading
+
+# upper bounds of the buckets of latency histograms in seconds
+latency_buckets = \
+    ( 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025
+    , 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+# name of the label of each metric and its description
+_metrics = dict \
+    ( actions_total        = ('action', 'Actions sent')
+    , action_errors_total  = ('action', 'Actions failed without response')
+    , action_rtt_seconds   = ('action', 'Round trip time of actions')
+    , events_total         = ('event',  'Events dispatched')
+    , event_queue_seconds  = ('event',  'Time of events in the event queue')
+    , callback_seconds     = ('event',  'Time in the callbacks of an event')
+    , parse_seconds        = (None,     'Time to process a received message')
+    , bytes_sent_total     = (None,     'Bytes of actions sent')
+    , bytes_received_total = (None,     'Bytes received')
+    , event_queue_depth    = (None,     'Events waiting for dispatch')
+    , message_queue_depth  = (None,     'Received messages not processed')
+    , pending_actions      = (None,     'Actions waiting for a response')
+    , events_dropped_total = (None,     'Events dropped by the overload policy')
+    )
+
+class Histogram(object):
+    """
+    Counts of observed values in buckets given by their upper bounds,
+    the sum and count of all values.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=latency_buckets):
+        self.bounds = bounds
+        # the last bucket is for values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return (bound, count of values <= bound) pairs, the last bound
+        is infinity.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return dict \
+            ( count   = self.count
+            , sum     = self.sum
+            , buckets = self.cumulative()
+            )
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metrics(object):
+    """
+    Counters, histograms and gauges of a manager. Counters and
+    histograms are kept per label value (e.g. the action name), None
+    for metrics without label. Gauges and counter functions (counters
+    not counted by inc) are functions called on export. Updates are
+    thread safe.
+    """
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.counter_functions = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, label=None, value=1):
+        """
+        Add value to a counter.
+        """
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[label] = counter.get(label, 0) + value
+
+    def observe(self, name, label, value):
+        """
+        Record a value (usually a duration in seconds) in a histogram.
+        """
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(label)
+            if histogram is None:
+                histogram = histograms[label] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, function):
+        """
+        Register a function returning the current value of a gauge.
+        """
+        self.gauges[name] = function
+
+    def counter(self, name, function):
+        """
+        Register a function returning the current value of a counter
+        kept elsewhere, it is exported with the counters.
+        """
+        self.counter_functions[name] = function
+
+    def _counters(self):
+        """
+        The counters with the values of the counter functions, called
+        with the lock held.
+        """
+        counters = dict(self.counters)
+        for name, function in self.counter_functions.items():
+            counters[name] = {None : function()}
+        return counters
+
+    def as_dict(self):
+        """
+        Export all metrics as a dict with the keys counters, histograms
+        and gauges, each mapping metric names to values. Labelled
+        metrics map the label values to the values, a histogram is a
+        dict of count, sum and cumulative buckets.
+        """
+        def values(metric, convert):
+            if list(metric) == [None]:
+                return convert(metric[None])
+            return dict((k, convert(v)) for k, v in metric.items())
+        with self._lock:
+            counters = dict \
+                ( (n, values(m, lambda v: v))
+                  for n, m in self._counters().items()
+                )
+            histograms = dict \
+                ( (n, values(m, lambda h: h.as_dict()))
+                  for n, m in self.histograms.items()
+                )
+        gauges = dict((n, f()) for n, f in self.gauges.items())
+        return dict(counters=counters, histograms=histograms, gauges=gauges)
+
+    def prometheus(self, prefix='asterisk_manager'):
+        """
+        Export all metrics in the text format of prometheus.
+        """
+        lines = []
+        def header(name, kind):
+            label, text = _metrics.get(name, (None, name))
+            lines.append('# HELP %s_%s %s' % (prefix, name, text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            return label or 'label'
+        def labels(label, value, extra=''):
+            pairs = []
+            if value is not None:
+                pairs.append('%s="%s"' % (label, _escape(value)))
+            if extra:
+                pairs.append(extra)
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join(pairs)
+        with self._lock:
+            counters = self._counters()
+            for name in sorted(counters):
+                label = header(name, 'counter')
+                for value, count in sorted \
+                    (counters[name].items(), key=lambda x: str(x[0])):
+                    lines.append('%s_%s%s %s' % (prefix, name,
+                        labels(label, value), count))
+            for name in sorted(self.histograms):
+                label = header(name, 'histogram')
+                for value, histogram in sorted \
+                    (self.histograms[name].items(), key=lambda x: str(x[0])):
+                    for bound, count in histogram.cumulative():
+                        le = 'le="%s"' % _format_float(bound)
+                        lines.append('%s_%s_bucket%s %s' % (prefix, name,
+                            labels(label, value, le), count))
+                    lines.append('%s_%s_sum%s %s' % (prefix, name,
+                        labels(label, value), _format_float(histogram.sum)))
+                    lines.append('%s_%s_count%s %s' % (prefix, name,
+                        labels(label, value), histogram.count))
+        for name in sorted(self.gauges):
+            header(name, 'gauge')
+            lines.append('%s_%s %s' % (prefix, name, self.gauges[name]()))
+        return '\n'.join(lines) + '\n'
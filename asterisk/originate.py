@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Mass Origination of Calls
+
+The OriginateEngine sends Originate actions for many jobs over one
+Manager. At most max_in_flight calls are originated at a time and each
+trunk is limited to a number of new calls per second. Calls are
+originated asynchronously, the outcome of each job is taken from the
+OriginateResponse event with the ActionID of its Originate action.
+
+   import asterisk.manager
+   from asterisk.originate import OriginateEngine
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   engine = OriginateEngine(manager, max_in_flight = 20, rate = 5,
+                            rates = {'SIP/provider2': 1})
+   try:
+       jobs = [engine.submit('SIP/provider1/%s' % number, 's', 'campaign')
+               for number in numbers]
+       engine.wait()
+       for job in jobs:
+           print (job.channel, job.status, job.reason)
+       print (engine.stats())
+   finally:
+       engine.close()
+
+Each job has a concurrent.futures.Future (job.future) that is resolved
+with the job when it is finished, whatever the outcome.
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+from asterisk.manager import Manager, ManagerException
+
+def _channel_trunk(channel):
+    """
+    The trunk of a dial string: 'SIP/provider/0123' and
+    'PJSIP/0123@provider' are both sent over the trunk named after the
+    technology and the peer, 'SIP/provider' and 'PJSIP/provider'.
+    """
+    technology, sep, rest = channel.partition('/')
+    if '@' in rest:
+        return technology + '/' + rest.rsplit('@', 1)[1]
+    return technology + '/' + rest.split('/', 1)[0]
+
+class OriginateJob(object):
+    """
+    One call to originate. The status is 'queued' until the action is
+    sent, 'sent' until the outcome is known and then one of 'success',
+    'failure' (the call failed, see reason) or 'error' (the action
+    failed, the exception is kept in error). The times are those of
+    submission, of sending the action and of the outcome, event is the
+    OriginateResponse.
+    """
+    __slots__ = ( 'cdict', 'trunk', 'action_id', 'status', 'reason', 'event'
+                , 'error', 'submitted', 'sent', 'finished', 'future'
+                )
+
+    def __init__(self, cdict, trunk):
+        self.cdict = cdict
+        self.trunk = trunk
+        self.action_id = None
+        self.status = 'queued'
+        self.reason = None
+        self.event = None
+        self.error = None
+        self.submitted = time.time()
+        self.sent = None
+        self.finished = None
+        self.future = Future()
+
+    @property
+    def channel(self):
+        return self.cdict.get('Channel')
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def __repr__(self):
+        return '<OriginateJob %s %s>' % (self.channel, self.status)
+
+class OriginateEngine(object):
+    """
+    Originate calls with a Manager. At most max_in_flight jobs wait for
+    their outcome at a time. rate limits the new calls per second of
+    each trunk, rates maps trunk names to a different limit, None is
+    no limit. The trunk of a job is computed from its channel by the
+    trunk function unless given to submit. Jobs of different trunks are
+    sent in turn. A job still without outcome after timeout seconds
+    (default: the Timeout of the Originate plus 30 seconds, or 60) is
+    finished with status 'error'.
+    """
+    def __init__(self, manager, max_in_flight=10, rate=None, rates=None,
+                 trunk=_channel_trunk, timeout=None):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self.manager = manager
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.trunk = trunk
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        # queued jobs by trunk, the trunks are served round robin
+        self._queued = collections.OrderedDict()
+        # jobs waiting for their outcome by ActionID
+        self._in_flight = {}
+        # earliest time for the next call of a trunk
+        self._next_call = {}
+        self._counts = collections.Counter()
+        self._trunk_counts = {}
+        self._started = None
+        self._closing = False
+        # finished jobs whose futures are resolved outside the lock,
+        # the number of futures being resolved
+        self._finished = []
+        self._resolving = 0
+        manager.register_event('OriginateResponse', self._originate_response)
+        self._thread = threading.Thread \
+            (target=self._run, name='originate-engine')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def submit(self, channel, exten, context='', priority='', timeout='',
+               caller_id='', account='', variables={}, trunk=None):
+        """
+        Queue a call to originate, the arguments are those of
+        Manager.originate. Returns the OriginateJob.
+        """
+        cdict = Manager.originate.build_action \
+            ( self.manager, channel, exten, context, priority, timeout
+            , caller_id, True, account, variables
+            )
+        return self.submit_action(cdict, trunk)
+
+    def submit_action(self, cdict, trunk=None):
+        """
+        Queue an Originate action given as a dict, Async is set.
+        Returns the OriginateJob.
+        """
+        cdict = dict(cdict, Async='yes')
+        cdict.pop('ActionID', None)
+        if trunk is None:
+            trunk = self.trunk(cdict['Channel'])
+        job = OriginateJob(cdict, trunk)
+        with self._cond:
+            if self._closing:
+                raise ManagerException('Originate engine is closed')
+            if self._started is None:
+                self._started = job.submitted
+            self._queued.setdefault(trunk, collections.deque()).append(job)
+            self._counts['submitted'] += 1
+            self._cond.notify_all()
+        return job
+
+    def wait(self, timeout=None):
+        """
+        Wait until all submitted jobs are finished, returns False if
+        this did not happen within timeout seconds.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while ( self._queued or self._in_flight or self._finished
+                  or self._resolving
+                  ):
+                if end is None:
+                    self._cond.wait()
+                else:
+                    now = time.time()
+                    if now >= end:
+                        return False
+                    self._cond.wait(end - now)
+        return True
+
+    def stats(self):
+        """
+        Counts of the jobs: submitted, queued, in_flight and finished
+        with each status, the calls per second since the first
+        submission (throughput) and the counts of each trunk.
+        """
+        with self._cond:
+            stats = dict((k, 0) for k in ('success', 'failure', 'error'))
+            stats.update(self._counts)
+            stats['queued'] = sum(len(q) for q in self._queued.values())
+            stats['in_flight'] = len(self._in_flight)
+            finished = stats['success'] + stats['failure'] + stats['error']
+            elapsed = 0
+            if self._started is not None:
+                elapsed = time.time() - self._started
+            stats['throughput'] = finished / elapsed if elapsed else 0.0
+            stats['trunks'] = dict \
+                ((t, dict(c)) for t, c in self._trunk_counts.items())
+        return stats
+
+    def close(self):
+        """
+        Stop the engine: Jobs still queued or in flight are finished
+        with status 'error'.
+        """
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        if threading.currentThread() != self._thread:
+            self._thread.join()
+        self.manager.unregister_event \
+            ('OriginateResponse', self._originate_response)
+        with self._cond:
+            jobs = [j for q in self._queued.values() for j in q]
+            jobs.extend(self._in_flight.values())
+            for job in jobs:
+                self._finish \
+                    (job, 'error', ManagerException('Originate engine closed'))
+        self._resolve()
+
+    def _limit(self, trunk):
+        return self.rates.get(trunk, self.rate)
+
+    def _job_timeout(self, job):
+        if self.timeout is not None:
+            return self.timeout
+        try:
+            return int(job.cdict['Timeout']) / 1000.0 + 30
+        except (KeyError, ValueError):
+            return 60
+
+    def _next_job(self, now):
+        """
+        Take the next job of a trunk allowed to call, called with the
+        lock. Returns the job or the time to wait for a trunk.
+        """
+        wait = None
+        for trunk in list(self._queued):
+            next_call = self._next_call.get(trunk, 0)
+            if next_call > now:
+                if wait is None or next_call - now < wait:
+                    wait = next_call - now
+                continue
+            jobs = self._queued.pop(trunk)
+            job = jobs.popleft()
+            # serve the other trunks first next time
+            if jobs:
+                self._queued[trunk] = jobs
+            limit = self._limit(trunk)
+            if limit:
+                self._next_call[trunk] = max(next_call, now) + 1.0 / limit
+            return job
+        return wait
+
+    def _run(self):
+        """
+        Send the jobs, the lock is released while sending: callbacks of
+        the manager threads take it.
+        """
+        while True:
+            job = None
+            with self._cond:
+                while not self._closing and not self._finished:
+                    now = time.time()
+                    wait = self._expire(now)
+                    if ( self._queued
+                       and len(self._in_flight) < self.max_in_flight
+                       ):
+                        job = self._next_job(now)
+                        if isinstance(job, OriginateJob):
+                            self._start(job)
+                            break
+                        if job is not None and (wait is None or job < wait):
+                            wait = job
+                        job = None
+                    if not self._finished:
+                        self._cond.wait(wait)
+                closing = self._closing
+            self._resolve()
+            if job is not None:
+                self._send(job)
+            elif closing:
+                return
+
+    def _expire(self, now):
+        """
+        Finish jobs without outcome in time, returns the time until the
+        next job expires.
+        """
+        wait = None
+        for job in list(self._in_flight.values()):
+            left = job.sent + self._job_timeout(job) - now
+            if left <= 0:
+                err = ManagerException \
+                    ('No OriginateResponse for %s' % job.channel)
+                self._finish(job, 'error', err)
+            elif wait is None or left < wait:
+                wait = left
+        return wait
+
+    def _start(self, job):
+        """
+        Mark the job as sent, called with the lock. The job is in
+        flight before the action is sent: its OriginateResponse may be
+        dispatched before send_action_async returns.
+        """
+        job.action_id = self.manager.next_action_id()
+        job.cdict['ActionID'] = job.action_id
+        job.sent = time.time()
+        job.status = 'sent'
+        self._trunk_counts.setdefault(job.trunk, collections.Counter()) \
+            ['sent'] += 1
+        self._in_flight[job.action_id] = job
+
+    def _send(self, job):
+        """
+        Send the action of the job, called without the lock.
+        """
+        try:
+            future = self.manager.send_action_async(job.cdict)
+        except ManagerException as err:
+            with self._cond:
+                self._finish(job, 'error', err)
+            self._resolve()
+            return
+        future.add_done_callback \
+            (lambda future: self._action_response(job, future))
+
+    def _action_response(self, job, future):
+        """
+        Response to the Originate: Only an error finishes the job.
+        """
+        with self._cond:
+            if job.done:
+                return
+            err = None
+            if future.cancelled():
+                err = ManagerException('Cancelled')
+            elif future.exception() is not None:
+                err = future.exception()
+            if err is not None:
+                self._finish(job, 'error', err)
+            elif future.result().get_header('Response') == 'Error':
+                job.reason = future.result().get_header('Message')
+                self._finish(job, 'error', ManagerException(job.reason))
+        self._resolve()
+
+    def _originate_response(self, event, manager):
+        with self._cond:
+            job = self._in_flight.get(event.get_header('ActionID'))
+            if job is None:
+                return
+            job.event = event
+            job.reason = event.get_header('Reason')
+            if event.get_header('Response') == 'Success':
+                self._finish(job, 'success')
+            else:
+                self._finish(job, 'failure')
+        self._resolve()
+
+    def _finish(self, job, status, error=None):
+        """
+        Record the outcome of a job, called with the lock. The future of
+        the job is resolved by _resolve after releasing the lock.
+        """
+        if job.done:
+            return
+        self._in_flight.pop(job.action_id, None)
+        jobs = self._queued.get(job.trunk)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._queued[job.trunk]
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        self._counts[status] += 1
+        self._trunk_counts.setdefault(job.trunk, collections.Counter()) \
+            [status] += 1
+        self._cond.notify_all()
+        self._finished.append(job)
+
+    def _resolve(self):
+        """
+        Resolve the futures of the finished jobs, called without the
+        lock: callbacks of the futures may use the engine.
+        """
+        with self._cond:
+            jobs, self._finished = self._finished, []
+            self._resolving += len(jobs)
+        if not jobs:
+            return
+        try:
+            for job in jobs:
+                job.future.set_result(job)
+        finally:
+            with self._cond:
+                self._resolving -= len(jobs)
+                self._cond.notify_all()
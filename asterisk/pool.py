@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Connections to many Asterisk Managers
+
+A ManagerPool owns the manager connections to several asterisk
+servers. All connections are served by a single thread running an
+asyncio event loop (see asterisk.asyncmanager), events of all servers
+are dispatched by one dispatcher thread. The host that sent an event is
+available as event.host.
+
+   from asterisk.pool import ManagerPool
+
+   def handle_hangup(event, pool):
+      print ("Hangup of %s on %s" % (event['Channel'], event.host))
+
+   pool = ManagerPool(route = {'SIP/node1-': 'node1', 'SIP/node2-': 'node2'})
+   try:
+       pool.register_event('Hangup', handle_hangup)
+       for host in 'node1', 'node2':
+           pool.connect(host, 'user', 'secret')
+
+       # actions are sent to a host or routed by a key, here a channel
+       pool['SIP/node1-00000001'].hangup('SIP/node1-00000001')
+       future = pool['node2'].status_async()
+
+       # send an action to all hosts in parallel
+       for host, r in pool.broadcast('command', 'core show channels count').items():
+           print (host, r.data)
+   finally:
+       pool.close()
+
+The manager of a host returned by pool[key] offers the same action
+helpers as asterisk.manager.Manager, the _async variants return a
+concurrent.futures.Future. Callbacks are registered with the pool.
+"""
+
+import asyncio
+import functools
+import inspect
+import threading
+
+from asterisk.asyncmanager import AsyncManager
+from asterisk.manager import ManagerException, _EventTable, _EventQueue
+
+class _PoolManager(AsyncManager):
+    """
+    AsyncManager of a ManagerPool: The callbacks are those of the pool,
+    events are handed to the dispatcher thread of the pool.
+    """
+    def __init__(self, pool, **kwargs):
+        AsyncManager.__init__(self, **kwargs)
+        self._events = pool._events
+        self._pool_queue = pool._event_queue
+
+    async def event_dispatch(self):
+        while True:
+            ev = await self._event_queue.get()
+            if not ev:
+                break
+            self._pool_queue.put(ev)
+
+class _SyncManager(object):
+    """
+    Synchronous interface to the _PoolManager of one host. Coroutine
+    methods are run in the event loop of the pool and waited for, with
+    an _async suffix they return a concurrent.futures.Future instead.
+    Other methods of the AsyncManager (e.g. send_action_nowait or
+    iter_list_action) must run in the event loop, they are not
+    offered. Public attributes like host or title can be read.
+    """
+    def __init__(self, pool, manager):
+        self._pool = pool
+        self._manager = manager
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        wait = True
+        method = getattr(self._manager, name, None)
+        if method is None and name.endswith('_async'):
+            wait = False
+            method = getattr(self._manager, name[:-len('_async')], None)
+            if not inspect.iscoroutinefunction(method):
+                method = None
+        if method is None:
+            raise AttributeError(name)
+        if not callable(method):
+            return method
+        if not inspect.iscoroutinefunction(method):
+            # not safe outside the event loop
+            raise AttributeError \
+                ('%s can only be used in the event loop of the pool' % name)
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            future = self._pool._run(method(*args, **kwargs))
+            if wait:
+                return future.result()
+            return future
+        return call
+
+class ManagerPool(object):
+    """
+    Manager connections to many asterisk servers.
+
+    Actions are routed by host name or by a key using route: Either a
+    function returning the host for a key or a dict mapping prefixes
+    of keys (e.g. of channel names) to hosts, the longest matching
+    prefix wins. Events of all hosts are dispatched in one thread,
+    callbacks are called with the event and the pool. The event queue
+    of the dispatcher is an _EventQueue with the given max_queued,
+    overload and event_priority, the 'block' policy would stall all
+    connections and is not supported. Other keyword arguments (e.g.
+    timeout or event_filter) are passed to each AsyncManager.
+    """
+    def __init__(self, route=None, max_queued=0, overload='drop_oldest',
+                 event_priority=None, **kwargs):
+        if max_queued and overload == 'block':
+            raise ValueError('Overload policy block is not supported')
+        self.route = route
+        self.kwargs = kwargs
+        # managers indexed by host, in order of connection
+        self.managers = {}
+        self._events = _EventTable()
+        self._event_queue = _EventQueue(max_queued, overload, event_priority)
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread \
+            (target=self._loop.run_forever, name='manager-pool')
+        self._loop_thread.setDaemon(True)
+        self._loop_thread.start()
+        self.event_dispatch_thread = threading.Thread \
+            (target=self.event_dispatch, name='manager-pool-dispatch')
+        self.event_dispatch_thread.setDaemon(True)
+        self.event_dispatch_thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def connect(self, host, username, secret, port=5038, name=None):
+        """
+        Connect and login to the manager of host, name (default is the
+        host) is used for routing and as event.host. Returns the
+        manager of the host, see __getitem__.
+        """
+        name = name or host
+        if name in self.managers:
+            raise ManagerException('Already connected to %s' % name)
+        manager = _PoolManager(self, **self.kwargs)
+        async def login():
+            await manager.connect(host, port)
+            manager.host = name
+            try:
+                await manager.login(username, secret)
+            except Exception:
+                await manager.close()
+                raise
+        self._run(login()).result()
+        self.managers[name] = manager
+        return self[name]
+
+    def host_for(self, key):
+        """
+        Return the host responsible for key: A host name or a key
+        looked up with route.
+        """
+        if key in self.managers:
+            return key
+        host = None
+        if callable(self.route):
+            host = self.route(key)
+        elif self.route:
+            prefixes = [p for p in self.route if key.startswith(p)]
+            if prefixes:
+                host = self.route[max(prefixes, key=len)]
+        if host not in self.managers:
+            raise ManagerException('No manager for %s' % key)
+        return host
+
+    def __getitem__(self, key):
+        """
+        Return the manager of the host responsible for key.
+        """
+        return _SyncManager(self, self.managers[self.host_for(key)])
+
+    def send_action(self, key, cdict={}, timeout=None, **kwargs):
+        """
+        Send an action to the host responsible for key and return the
+        response.
+        """
+        return self[key].send_action(cdict, timeout, **kwargs)
+
+    def send_action_async(self, key, cdict={}, timeout=None, **kwargs):
+        """
+        Like send_action but return a concurrent.futures.Future.
+        """
+        return self[key].send_action_async(cdict, timeout, **kwargs)
+
+    def broadcast(self, action, *args, **kwargs):
+        """
+        Send an action to all hosts in parallel. The action is a dict
+        as passed to send_action or the name of an action helper with
+        its arguments. Returns a dict of the response of each host, if
+        an action fails the exception is returned instead.
+        """
+        managers = list(self.managers.items())
+        async def gather():
+            calls = []
+            for host, manager in managers:
+                if isinstance(action, dict):
+                    calls.append(manager.send_action(action, *args, **kwargs))
+                else:
+                    calls.append(getattr(manager, action)(*args, **kwargs))
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            return dict((m[0], r) for m, r in zip(managers, results))
+        return self._run(gather()).result()
+
+    def register_event(self, event, function, predicate=None):
+        """
+        Register a callback for events of all hosts, see
+        Manager.register_event. The callback is called with the event
+        and the pool.
+        """
+        self._events.register(event, function, predicate)
+        for manager in self.managers.values():
+            self._loop.call_soon_threadsafe(manager._update_filter)
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        self._events.unregister(event, function)
+
+    def event_dispatch(self):
+        """This thread is responsible for dispatching events"""
+
+        while True:
+            ev = self._event_queue.get()
+            if not ev:
+                break
+            for callback, predicate in self._events.lookup(ev.name):
+                if predicate is not None and not predicate(ev):
+                    continue
+                if callback(ev, self):
+                    break
+
+    def queue_stats(self):
+        """
+        Statistics of the event queue, see Manager.queue_stats.
+        """
+        return self._event_queue.stats()
+
+    def close(self):
+        """Logoff and close all connections, stop the threads"""
+
+        if not self._loop_thread.is_alive():
+            return
+        managers = list(self.managers.values())
+        self.managers = {}
+        async def close():
+            await asyncio.gather \
+                (*(m.close() for m in managers), return_exceptions=True)
+        self._run(close()).result()
+        self._event_queue.put(None)
+        if threading.currentThread() != self.event_dispatch_thread:
+            self.event_dispatch_thread.join()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
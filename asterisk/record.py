@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Recording and Replay of the Manager Byte Stream
+
+A Recorder passed to the Manager writes all data received from asterisk
+with the time of reception to a file. A Replay reads such a recording
+and feeds it to a Manager as if it came from asterisk, either at the
+original pace (speed=1), faster or slower, or as fast as possible
+(speed=None). This allows testing callbacks and benchmarking the parser
+with real traffic offline:
+
+   import asterisk.manager
+   from asterisk.record import Recorder, Replay
+
+   # record
+   manager = asterisk.manager.Manager(recorder = Recorder('ami.rec'))
+   manager.connect('host')
+   manager.login('user', 'secret')
+   ...
+   manager.close()
+   manager.recorder.close()
+
+   # replay
+   manager = asterisk.manager.Manager()
+   manager.register_event('*', handle_event)
+   manager.replay(Replay('ami.rec', speed = 1))
+
+The events of a recording can be iterated without a Manager, too:
+
+   for event in Replay('ami.rec').events():
+       print (event.name)
+
+The file starts with a magic string, followed by records of the time
+of reception (a double), the length (32 bit) and the data received.
+An empty record marks a new connection. The recording is mapped into
+memory, large recordings are not read into memory at once. Closing the
+Replay (the manager does at the end of the replay) unmaps it.
+"""
+
+import mmap
+import re
+import struct
+import threading
+import time
+
+from asterisk.compat import string_types
+from asterisk.manager import Event, ManagerMsg, _Framer
+
+magic = b'PYSTAMI1'
+_record = struct.Struct('<dI')
+_action = re.compile(br'^Action: *([^\r\n]*)', re.M)
+_action_id = re.compile(br'^ActionID: *([^\r\n]*)', re.M)
+
+class Recorder(object):
+    """
+    Write the data received by a Manager to a file (or file object
+    opened in binary mode).
+    """
+    def __init__(self, file):
+        if isinstance(file, string_types):
+            file = open(file, 'wb')
+        self.file = file
+        self._lock = threading.Lock()
+        self.file.write(magic)
+
+    def write(self, data, timestamp=None):
+        """
+        Record data received at timestamp (default is now).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self.file is None:
+                return
+            self.file.write(_record.pack(timestamp, len(data)))
+            self.file.write(data)
+
+    def connected(self):
+        """
+        Mark the start of a new connection.
+        """
+        self.write(b'')
+
+    def close(self):
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class Replay(object):
+    """
+    A recording written by a Recorder. The recording can be iterated
+    (see records, messages and events) or passed to Manager.replay.
+    With a speed the data is passed to the manager at the pace of the
+    recording divided by speed. The host is used for the events.
+    After close the recording can no longer be read.
+    """
+    def __init__(self, filename, speed=None, host=None):
+        self.speed = speed
+        self.host = host
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(magic)] != magic:
+            self._map.close()
+            raise ValueError('%s is not a manager recording' % filename)
+        self._cond = threading.Condition()
+        # responses to actions sent during replay
+        self._replies = []
+        self._records = None
+        # the next (due, data) to pass to the manager
+        self._next = None
+        # the data passed last ends within a message
+        self._partial = False
+        self._closed = False
+
+    def records(self):
+        """
+        Iterate over the (timestamp, data) records, an empty data marks
+        a new connection. A truncated last record is ignored.
+        """
+        pos = len(magic)
+        end = len(self._mapped())
+        while pos + _record.size <= end:
+            mm = self._mapped()
+            timestamp, size = _record.unpack_from(mm, pos)
+            pos += _record.size
+            if pos + size > end:
+                break
+            yield timestamp, mm[pos:pos + size]
+            pos += size
+
+    def _mapped(self):
+        mm = self._map
+        if mm is None:
+            raise ValueError('Replay is closed')
+        return mm
+
+    def messages(self):
+        """
+        Iterate over the messages of the recording as ManagerMsg.
+        """
+        framer = _Framer()
+        for timestamp, data in self.records():
+            if not data:
+                framer = _Framer()
+                continue
+            for frame in framer.feed(data):
+                yield ManagerMsg(frame)
+
+    def events(self):
+        """
+        Iterate over the events of the recording.
+        """
+        for message in self.messages():
+            if message.is_event():
+                yield Event(message, self.host)
+
+    # socket interface used by Manager.replay
+
+    def recv(self, bufsize):
+        """
+        Return the next data for the manager, waiting for its time of
+        reception when replaying at a speed. Responses to actions come
+        first, after a Logoff or at the end of the recording the
+        connection is closed.
+        """
+        with self._cond:
+            if self._records is None:
+                self._records = self._paced()
+            while not self._closed:
+                # replies are not inserted into a recorded message
+                if self._replies and not self._partial:
+                    break
+                if self._next is None:
+                    self._next = next(self._records, None)
+                    if self._next is None:
+                        break
+                due, data, complete = self._next
+                wait = 0 if due is None else due - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self._next = None
+                self._partial = not complete
+                return data
+            if self._replies:
+                return self._replies.pop(0)
+            return b''
+
+    def _paced(self):
+        """
+        Iterate over the data to pass to the manager with the time it
+        is due (None without speed) and a flag if it ends with a
+        complete message.
+        """
+        start = first = None
+        connections = 0
+        greeting = False
+        for timestamp, data in self.records():
+            if not data:
+                connections += 1
+                greeting = True
+                continue
+            complete = data.endswith(b'\n\r\n')
+            if greeting:
+                # each connection starts with a greeting line, the
+                # manager expects it only at the start
+                greeting = False
+                eol = data.find(b'\n') + 1
+                if connections > 1:
+                    data = data[eol:]
+                    if not data:
+                        continue
+                elif eol == len(data):
+                    complete = True
+            due = None
+            if self.speed:
+                if start is None:
+                    start, first = time.time(), timestamp
+                due = start + (timestamp - first) / self.speed
+            yield due, data, complete
+
+    def sendall(self, data):
+        """
+        Answer actions of the manager, there is no asterisk to execute
+        them.
+        """
+        replies = []
+        for action in data.split(b'\r\n\r\n'):
+            if not action.strip():
+                continue
+            m = _action_id.search(action)
+            action_id = m.group(1) if m else b''
+            m = _action.search(action)
+            if m and m.group(1).lower() == b'logoff':
+                reply = b'Response: Goodbye\r\n'
+            else:
+                reply = b'Response: Error\r\nMessage: Replay\r\n'
+            replies.append(reply + b'ActionID: ' + action_id + b'\r\n\r\n')
+        with self._cond:
+            self._replies.extend(replies)
+            if any(r.startswith(b'Response: Goodbye') for r in replies):
+                self._closed = True
+            self._cond.notify_all()
+
+    def shutdown(self, how):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        End the replay and unmap the recording.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            if self._map is not None:
+                self._map.close()
+                self._map = None
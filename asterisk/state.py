@@ -0,0 +1,820 @@
+#!/usr/bin/env python3
+# vim: set expandtab shiftwidth=4:
+
+"""
+Local State of Asterisk kept up to date from Manager Events
+
+The registries in this module keep a copy of some state of asterisk in
+memory, so that looking it up needs no round trip to the manager. Each
+registry registers callbacks for the events changing its state with a
+Manager and loads an initial snapshot with a list producing action.
+After a reconnect of the manager (see Manager(reconnect=True)) the
+snapshot is loaded again.
+
+   import asterisk.manager
+   from asterisk.state import ChannelRegistry, PeerRegistry, QueueRegistry
+
+   manager = asterisk.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+   channels = ChannelRegistry(manager)
+
+   channel = channels.by_name('SIP/100-00000001')
+   if channel:
+       print (channel.state_desc, channel.caller_id_num)
+   for channel in channels.by_caller_id('100'):
+       print (channel.name, channels.bridged(channel.uniqueid))
+
+   peers = PeerRegistry(manager, ttl = 300)
+   for peer in peers.reachable():
+       print (peer.key, peer.address)
+
+   def show(queues, name, event):
+       print (queues.state(name))
+   queues = QueueRegistry(manager)
+   queues.subscribe(show, 'support')
+
+Lookups read dicts without locking, updates are done by the event
+dispatching thread(s) of the manager.
+"""
+
+import threading
+import time
+import traceback
+
+from asterisk.manager import ManagerException
+
+class _Registry(object):
+    """
+    Base class of the registries. The handlers dict maps event names
+    to the names of methods updating the state with the event. The
+    snapshot method returns the events of a list producing action, for
+    each of them the load method is called.
+
+    Events dispatched while a snapshot is loaded are newer than the
+    snapshot: The objects they change (by key) are not updated from the
+    snapshot. Objects not in the snapshot are removed unless keep
+    returns True for their key. Snapshots are loaded one at a time, a
+    failed snapshot (an exception, e.g. for an Error response) keeps
+    the state.
+
+    With a ttl (in seconds) a lookup after the ttl has expired starts
+    loading a new snapshot in the background, meanwhile the current
+    state is returned.
+
+    Functions subscribed to the registry are called after each change.
+    """
+    handlers = {}
+
+    def __init__(self, manager, refresh=True, ttl=None):
+        self.manager = manager
+        self.objects = {}
+        self.ttl = ttl
+        # time of the last snapshot
+        self.refreshed = None
+        self._lock = threading.RLock()
+        # keys changed by events while a snapshot is loaded
+        self._changed = None
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
+        # (function, key) pairs, replaced on change
+        self._subscribers = ()
+        for name in self.handlers:
+            manager.register_event(name, self._event)
+        manager.register_reconnect(self._reconnected)
+        if refresh:
+            self.refresh()
+
+    def close(self):
+        """
+        Stop updating the registry.
+        """
+        for name in self.handlers:
+            self.manager.unregister_event(name, self._event)
+        self.manager.unregister_reconnect(self._reconnected)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __iter__(self):
+        return iter(list(self.objects.values()))
+
+    def __contains__(self, key):
+        return key in self.objects
+
+    def get(self, key, default=None):
+        self._check_ttl()
+        return self.objects.get(key, default)
+
+    def _check_ttl(self):
+        if ( self.ttl is None or self.refreshed is None
+           or time.time() - self.refreshed < self.ttl
+           ):
+            return
+        with self._lock:
+            if self._refresh_thread is None:
+                self._refresh_thread = threading.Thread \
+                    (target=self._refresh_background)
+                self._refresh_thread.setDaemon(True)
+                self._refresh_thread.start()
+
+    def _refresh_background(self):
+        # the current state is returned until a later lookup retries
+        try:
+            self.refresh()
+        except ManagerException:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._refresh_thread = None
+
+    def refresh(self):
+        """
+        Load a snapshot of the state from the manager. If the snapshot
+        fails the current state is kept and the exception is raised.
+        """
+        with self._refresh_lock:
+            with self._lock:
+                self._changed = set()
+            try:
+                events = self.snapshot()
+            finally:
+                with self._lock:
+                    changed, self._changed = self._changed, None
+            with self._lock:
+                seen = set()
+                for event in events:
+                    key = self.key(event)
+                    if key is None:
+                        continue
+                    seen.add(key)
+                    if key not in changed:
+                        self.load(event)
+                for key in list(self.objects):
+                    if ( key not in seen and key not in changed
+                       and not self.keep(key)
+                       ):
+                        self.remove(key)
+                self.refreshed = time.time()
+        self._notify(None, None)
+
+    def subscribe(self, function, key=None):
+        """
+        Call function(registry, key, event) after the object with the
+        given key (any object if key is None) was changed by an event.
+        After a snapshot was loaded it is called with key and event
+        None. Functions are called by the event dispatching thread.
+        """
+        with self._lock:
+            self._subscribers = self._subscribers + ((function, key),)
+
+    def unsubscribe(self, function, key=None):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            subscribers.remove((function, key))
+            self._subscribers = tuple(subscribers)
+
+    def _notify(self, key, event):
+        for function, k in self._subscribers:
+            if k is None or key is None or k == key:
+                function(self, key, event)
+
+    def _event(self, event, manager):
+        key = self.key(event)
+        with self._lock:
+            if self._changed is not None:
+                self._changed.add(key)
+            getattr(self, self.handlers[event.name])(event)
+        self._notify(key, event)
+
+    def _reconnected(self, manager):
+        # events were lost while disconnected, on failure keep the
+        # state and let the other hooks run
+        try:
+            self.refresh()
+        except ManagerException:
+            traceback.print_exc()
+
+    def key(self, event):
+        raise NotImplementedError
+
+    def snapshot(self):
+        raise NotImplementedError
+
+    def keep(self, key):
+        """
+        Return True to keep an object missing from the snapshot.
+        """
+        return False
+
+    def load(self, event):
+        raise NotImplementedError
+
+    def remove(self, key):
+        self.objects.pop(key, None)
+
+def _checked(events, action):
+    """
+    Return the EventList of a list producing action, raise
+    ManagerException if the action failed.
+    """
+    if events.error is not None:
+        raise ManagerException('%s failed: %s' % (action, events.error))
+    return events
+
+def _update(obj, fields, event):
+    """
+    Set the attributes of obj from the headers of event, fields is a
+    sequence of attribute names and header names or tuples of header
+    names (of different asterisk versions).
+    """
+    for attr, headers in fields:
+        if not isinstance(headers, tuple):
+            headers = (headers,)
+        for header in headers:
+            value = event.get_header(header)
+            if value is not None:
+                setattr(obj, attr, value)
+                break
+
+class Channel(object):
+    """
+    State of a channel, the attributes are taken from the headers of
+    the events of the channel.
+    """
+    fields = \
+        ( ('uniqueid',       'Uniqueid')
+        , ('name',           'Channel')
+        , ('state',          'ChannelState')
+        , ('state_desc',     'ChannelStateDesc')
+        , ('caller_id_num',  'CallerIDNum')
+        , ('caller_id_name', 'CallerIDName')
+        , ('account',        'AccountCode')
+        , ('context',        'Context')
+        , ('exten',          'Exten')
+        , ('priority',       'Priority')
+        , ('linkedid',       'Linkedid')
+        )
+    __slots__ = tuple(f[0] for f in fields) + ('bridge',)
+
+    def __init__(self, uniqueid):
+        for attr, header in self.fields:
+            setattr(self, attr, None)
+        self.uniqueid = uniqueid
+        self.bridge = None
+
+    def update(self, event):
+        _update(self, self.fields, event)
+
+    def __repr__(self):
+        return 'Channel(%s, %s)' % (self.uniqueid, self.name)
+
+class ChannelRegistry(_Registry):
+    """
+    The active channels of asterisk indexed by Uniqueid, with indexes
+    by channel name and CallerIDNum, and the bridges they are in.
+    The snapshot is taken with the Status action.
+    """
+    handlers = dict \
+        ( Newchannel  = '_update'
+        , Newstate    = '_update'
+        , NewCallerid = '_update'
+        , Rename      = '_rename'
+        , Hangup      = '_hangup'
+        , BridgeEnter = '_bridge_enter'
+        , BridgeLeave = '_bridge_leave'
+        )
+
+    def __init__(self, manager, refresh=True, ttl=None):
+        self._by_name = {}
+        self._by_caller_id = {}
+        # sets of Uniqueids indexed by BridgeUniqueid
+        self.bridges = {}
+        _Registry.__init__(self, manager, refresh, ttl)
+
+    def by_name(self, name):
+        """
+        Return the channel with the given name or None.
+        """
+        uniqueid = self._by_name.get(name)
+        return self.get(uniqueid)
+
+    def by_caller_id(self, number):
+        """
+        Return the list of channels with the given CallerIDNum.
+        """
+        self._check_ttl()
+        uniqueids = self._by_caller_id.get(number, ())
+        return [self.objects[u] for u in list(uniqueids) if u in self.objects]
+
+    def bridged(self, uniqueid):
+        """
+        Return the other channels in the bridge of a channel.
+        """
+        channel = self.objects.get(uniqueid)
+        if channel is None or channel.bridge is None:
+            return []
+        uniqueids = list(self.bridges.get(channel.bridge, ()))
+        return [self.objects[u] for u in uniqueids
+                if u != uniqueid and u in self.objects]
+
+    def key(self, event):
+        return event.get_header('Uniqueid')
+
+    def snapshot(self):
+        return _checked(self.manager.status_list(), 'Status')
+
+    def load(self, event):
+        self._update(event)
+        # before asterisk 12 there are no bridge events
+        bridge = event.get_header('BridgeID')
+        if bridge:
+            self._bridge_enter(event, bridge)
+        elif bridge is not None:
+            self._bridge_leave(event)
+
+    def remove(self, uniqueid):
+        channel = self.objects.pop(uniqueid, None)
+        if channel is None:
+            return
+        self._unindex(channel)
+        self._bridge_leave(None, channel=channel)
+
+    def _index(self, channel):
+        if channel.name:
+            self._by_name[channel.name] = channel.uniqueid
+        if channel.caller_id_num:
+            self._by_caller_id.setdefault \
+                (channel.caller_id_num, set()).add(channel.uniqueid)
+
+    def _unindex(self, channel):
+        if self._by_name.get(channel.name) == channel.uniqueid:
+            del self._by_name[channel.name]
+        uniqueids = self._by_caller_id.get(channel.caller_id_num)
+        if uniqueids is not None:
+            uniqueids.discard(channel.uniqueid)
+            if not uniqueids:
+                del self._by_caller_id[channel.caller_id_num]
+
+    def _update(self, event):
+        uniqueid = event.get_header('Uniqueid')
+        if uniqueid is None:
+            return
+        channel = self.objects.get(uniqueid)
+        if channel is None:
+            channel = Channel(uniqueid)
+        else:
+            self._unindex(channel)
+        channel.update(event)
+        self._index(channel)
+        self.objects[uniqueid] = channel
+
+    def _rename(self, event):
+        channel = self.objects.get(event.get_header('Uniqueid'))
+        if channel is None:
+            return
+        self._unindex(channel)
+        channel.name = event.get_header('Newname')
+        self._index(channel)
+
+    def _hangup(self, event):
+        self.remove(event.get_header('Uniqueid'))
+
+    def _bridge_enter(self, event, bridge=None):
+        channel = self.objects.get(event.get_header('Uniqueid'))
+        if channel is None:
+            return
+        bridge = bridge or event.get_header('BridgeUniqueid')
+        if channel.bridge is not None and channel.bridge != bridge:
+            self._bridge_leave(None, channel=channel)
+        channel.bridge = bridge
+        self.bridges.setdefault(bridge, set()).add(channel.uniqueid)
+
+    def _bridge_leave(self, event, channel=None):
+        if channel is None:
+            channel = self.objects.get(event.get_header('Uniqueid'))
+        if channel is None or channel.bridge is None:
+            return
+        uniqueids = self.bridges.get(channel.bridge)
+        if uniqueids is not None:
+            uniqueids.discard(channel.uniqueid)
+            if not uniqueids:
+                del self.bridges[channel.bridge]
+        channel.bridge = None
+
+# Status of peers as reported by the different events and list actions
+# of chan_sip and chan_pjsip
+_peer_status = \
+    { 'ok'           : 'reachable'
+    , 'reachable'    : 'reachable'
+    , 'not in use'   : 'reachable'
+    , 'in use'       : 'reachable'
+    , 'busy'         : 'reachable'
+    , 'ringing'      : 'reachable'
+    , 'ringinuse'    : 'reachable'
+    , 'on hold'      : 'reachable'
+    , 'lagged'       : 'lagged'
+    , 'unreachable'  : 'unreachable'
+    , 'unavailable'  : 'unreachable'
+    , 'unmonitored'  : 'unmonitored'
+    , 'registered'   : 'registered'
+    , 'unregistered' : 'unregistered'
+    , 'removed'      : 'unregistered'
+    }
+
+def _normalize_status(value):
+    """
+    Return the status of a peer for the given status header, e.g.
+    'OK (5 ms)' is 'reachable'.
+    """
+    if not value:
+        return 'unknown'
+    value = value.split('(')[0].strip().lower()
+    return _peer_status.get(value, 'unknown')
+
+class Peer(object):
+    """
+    State of a SIP peer or PJSIP endpoint. The status is one of
+    'reachable', 'lagged', 'unreachable', 'unmonitored', 'registered',
+    'unregistered' or 'unknown', status_text is the status as reported
+    by asterisk. For PJSIP endpoints contacts maps the URI of each
+    contact to its status.
+    """
+    __slots__ = \
+        ('key', 'technology', 'name', 'status', 'status_text', 'address'
+        , 'contacts'
+        )
+
+    def __init__(self, key):
+        self.key = key
+        self.technology, self.name = key.split('/', 1)
+        self.status = 'unknown'
+        self.status_text = None
+        self.address = None
+        self.contacts = {}
+
+    def __repr__(self):
+        return 'Peer(%s, %s)' % (self.key, self.status)
+
+class PeerRegistry(_Registry):
+    """
+    The SIP peers and PJSIP endpoints of asterisk indexed by
+    technology/name (e.g. 'SIP/100' or 'PJSIP/100') and by status. The
+    snapshot is taken with the list actions given (Sippeers and
+    PJSIPShowEndpoints by default), sent in parallel. If one of them
+    fails (e.g. Sippeers without chan_sip) the peers it loaded before
+    are kept, the snapshot fails only if all of them fail. Peers are
+    updated from PeerStatus and ContactStatus events. Use a ttl to poll
+    the peers, e.g. if qualify is not configured.
+    """
+    handlers = dict \
+        ( PeerStatus    = '_peer_status'
+        , ContactStatus = '_contact_status'
+        )
+    actions = ('Sippeers', 'PJSIPShowEndpoints')
+
+    def __init__(self, manager, refresh=True, ttl=None, actions=None):
+        if actions is not None:
+            self.actions = actions
+        self._by_status = {}
+        # the action that loaded each peer, peers of failed actions
+        self._sources = {}
+        self._kept = set()
+        _Registry.__init__(self, manager, refresh, ttl)
+
+    def by_status(self, status):
+        """
+        Return the list of peers with the given status.
+        """
+        self._check_ttl()
+        keys = list(self._by_status.get(status, ()))
+        return [self.objects[k] for k in keys if k in self.objects]
+
+    def reachable(self):
+        return self.by_status('reachable')
+
+    def key(self, event):
+        name = event.name
+        if name == 'PeerEntry':
+            return '%s/%s' % \
+                (event.get_header('Channeltype'), event.get_header('ObjectName'))
+        if name == 'EndpointList':
+            return 'PJSIP/' + event.get_header('ObjectName')
+        if name == 'PeerStatus':
+            return event.get_header('Peer')
+        if name == 'ContactStatus':
+            return 'PJSIP/' + event.get_header('EndpointName')
+        return None
+
+    def snapshot(self):
+        futures = [self.manager.send_list_action_async({'Action' : action})
+                   for action in self.actions]
+        events = []
+        sources = {}
+        errors = []
+        try:
+            for action, future in zip(self.actions, futures):
+                result = self.manager._wait(future, future.action_id)
+                if result.error is not None:
+                    errors.append((action, result.error))
+                    continue
+                for event in result:
+                    sources[self.key(event)] = action
+                events.extend(result)
+        finally:
+            # stop collecting the lists of failed actions
+            for future in futures:
+                future.cancel()
+        if errors and len(errors) == len(self.actions):
+            raise ManagerException \
+                ('; '.join('%s failed: %s' % e for e in errors))
+        failed = set(action for action, error in errors)
+        self._kept = set \
+            (k for k, action in self._sources.items() if action in failed)
+        self._sources.update(sources)
+        return events
+
+    def keep(self, key):
+        return key in self._kept
+
+    def load(self, event):
+        if event.name == 'PeerEntry':
+            address = event.get_header('IPaddress')
+            if address and address != '-none-':
+                address = '%s:%s' % (address, event.get_header('IPport'))
+            else:
+                address = None
+            self._set(self.key(event), event.get_header('Status'), address)
+        elif event.name == 'EndpointList':
+            self._set(self.key(event), event.get_header('DeviceState'))
+
+    def remove(self, key):
+        self._sources.pop(key, None)
+        peer = self.objects.pop(key, None)
+        if peer is not None:
+            self._unindex(peer)
+
+    def _unindex(self, peer):
+        keys = self._by_status.get(peer.status)
+        if keys is not None:
+            keys.discard(peer.key)
+            if not keys:
+                del self._by_status[peer.status]
+
+    def _peer(self, key):
+        peer = self.objects.get(key)
+        if peer is None:
+            peer = self.objects[key] = Peer(key)
+            self._by_status.setdefault(peer.status, set()).add(key)
+        return peer
+
+    def _set(self, key, text, address=None, status=None):
+        peer = self._peer(key)
+        self._unindex(peer)
+        peer.status_text = text
+        peer.status = status or _normalize_status(text)
+        if address:
+            peer.address = address
+        self._by_status.setdefault(peer.status, set()).add(key)
+
+    def _peer_status(self, event):
+        address = event.get_header('Address')
+        self._set(self.key(event), event.get_header('PeerStatus'), address)
+
+    def _contact_status(self, event):
+        peer = self._peer(self.key(event))
+        text = event.get_header('ContactStatus')
+        uri = event.get_header('URI')
+        status = _normalize_status(text)
+        if status == 'unregistered':
+            peer.contacts.pop(uri, None)
+        elif text not in ('Created', 'Updated'):
+            peer.contacts[uri] = status
+        elif uri not in peer.contacts:
+            peer.contacts[uri] = 'unknown'
+        # the best status of the contacts
+        for status in 'reachable', 'lagged', 'unknown', 'unreachable':
+            if status in peer.contacts.values():
+                break
+        else:
+            status = 'unregistered'
+        self._set(peer.key, text, uri, status)
+
+class QueueMember(object):
+    """
+    State of a member (agent) of a queue, in_call is the Uniqueid of
+    the caller the member is connected to.
+    """
+    fields = \
+        ( ('interface',       ('Interface', 'Location', 'Member'))
+        , ('name',            ('MemberName', 'Name'))
+        , ('state_interface', 'StateInterface')
+        , ('membership',      'Membership')
+        , ('penalty',         'Penalty')
+        , ('calls_taken',     'CallsTaken')
+        , ('last_call',       'LastCall')
+        , ('status',          'Status')
+        , ('paused',          'Paused')
+        )
+    __slots__ = tuple(f[0] for f in fields) + ('in_call',)
+
+    def __init__(self):
+        for attr, header in self.fields:
+            setattr(self, attr, None)
+        self.in_call = None
+
+    def update(self, event):
+        _update(self, self.fields, event)
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __repr__(self):
+        return 'QueueMember(%s, %s)' % (self.interface, self.status)
+
+class QueueCaller(object):
+    """
+    A caller waiting in a queue.
+    """
+    fields = \
+        ( ('uniqueid',       'Uniqueid')
+        , ('channel',        'Channel')
+        , ('caller_id_num',  'CallerIDNum')
+        , ('caller_id_name', 'CallerIDName')
+        )
+    __slots__ = tuple(f[0] for f in fields) + ('joined',)
+
+    def __init__(self, event):
+        for attr, header in self.fields:
+            setattr(self, attr, None)
+        _update(self, self.fields, event)
+        wait = event.get_header('Wait')
+        self.joined = time.time() - int(wait or 0)
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __repr__(self):
+        return 'QueueCaller(%s, %s)' % (self.uniqueid, self.channel)
+
+class Queue(object):
+    """
+    State of a queue: params are the headers of the QueueParams event
+    (e.g. Strategy, Calls, Completed, Abandoned), members are indexed
+    by interface, callers are in the order of their position.
+    """
+    __slots__ = ('name', 'params', 'members', 'callers')
+
+    def __init__(self, name):
+        self.name = name
+        self.params = {}
+        self.members = {}
+        self.callers = []
+
+    def as_dict(self):
+        """
+        Return a copy of the state as plain dicts and lists.
+        """
+        return dict \
+            ( name    = self.name
+            , params  = dict(self.params)
+            , members = [m.as_dict() for m in list(self.members.values())]
+            , callers = [c.as_dict() for c in list(self.callers)]
+            )
+
+    def __repr__(self):
+        return 'Queue(%s)' % self.name
+
+class QueueRegistry(_Registry):
+    """
+    The queues of asterisk with their members and waiting callers,
+    indexed by queue name. The snapshot is taken with the QueueStatus
+    action, queues are updated from QueueMember*, QueueCaller* and
+    Agent* events. The state method returns a copy that is not changed
+    by later events, e.g. for a dashboard; use subscribe for being
+    notified of changes.
+    """
+    handlers = dict \
+        ( QueueMemberStatus  = '_member'
+        , QueueMemberAdded   = '_member'
+        , QueueMemberPause   = '_member'
+        , QueueMemberPaused  = '_member'
+        , QueueMemberRemoved = '_member_removed'
+        , QueueCallerJoin    = '_caller_join'
+        , Join               = '_caller_join'
+        , QueueCallerLeave   = '_caller_leave'
+        , Leave              = '_caller_leave'
+        , QueueCallerAbandon = '_caller_abandon'
+        , AgentConnect       = '_agent_connect'
+        , AgentComplete      = '_agent_complete'
+        )
+
+    def __init__(self, manager, refresh=True, ttl=None):
+        self._loaded = set()
+        _Registry.__init__(self, manager, refresh, ttl)
+
+    def state(self, name=None):
+        """
+        Return a copy of the state of the named queue (None if there is
+        no such queue), or of all queues as a dict indexed by name.
+        """
+        self._check_ttl()
+        with self._lock:
+            if name is not None:
+                queue = self.objects.get(name)
+                return queue and queue.as_dict()
+            return dict((q.name, q.as_dict()) for q in self.objects.values())
+
+    def key(self, event):
+        return event.get_header('Queue')
+
+    def snapshot(self):
+        self._loaded = set()
+        return _checked \
+            ( self.manager.send_list_action({'Action' : 'QueueStatus'})
+            , 'QueueStatus'
+            )
+
+    def load(self, event):
+        name = self.key(event)
+        if name not in self._loaded:
+            # replace the queue, its members and callers may be gone
+            self._loaded.add(name)
+            self.objects[name] = Queue(name)
+        queue = self.objects[name]
+        if event.name == 'QueueParams':
+            queue.params = dict(event.headers)
+            queue.params.pop('Event', None)
+            queue.params.pop('ActionID', None)
+        elif event.name == 'QueueMember':
+            self._member(event)
+        elif event.name == 'QueueEntry':
+            queue.callers.append(QueueCaller(event))
+
+    def _queue(self, event):
+        name = self.key(event)
+        queue = self.objects.get(name)
+        if queue is None:
+            queue = self.objects[name] = Queue(name)
+        return queue
+
+    def _member(self, event):
+        queue = self._queue(event)
+        member = QueueMember()
+        member.update(event)
+        if member.interface in queue.members:
+            member = queue.members[member.interface]
+            member.update(event)
+        queue.members[member.interface] = member
+
+    def _member_removed(self, event):
+        member = QueueMember()
+        member.update(event)
+        self._queue(event).members.pop(member.interface, None)
+
+    def _count(self, queue, event):
+        count = event.get_header('Count')
+        if count is not None:
+            queue.params['Calls'] = count
+
+    def _caller_join(self, event):
+        queue = self._queue(event)
+        caller = QueueCaller(event)
+        position = int(event.get_header('Position') or 0) or None
+        callers = [c for c in queue.callers if c.uniqueid != caller.uniqueid]
+        if position is None:
+            position = len(callers) + 1
+        callers.insert(position - 1, caller)
+        queue.callers = callers
+        self._count(queue, event)
+
+    def _caller_leave(self, event):
+        queue = self._queue(event)
+        uniqueid = event.get_header('Uniqueid')
+        queue.callers = [c for c in queue.callers if c.uniqueid != uniqueid]
+        self._count(queue, event)
+
+    def _increment(self, queue, param):
+        queue.params[param] = str(int(queue.params.get(param) or 0) + 1)
+
+    def _caller_abandon(self, event):
+        queue = self._queue(event)
+        self._increment(queue, 'Abandoned')
+        self._caller_leave(event)
+
+    def _agent(self, event):
+        queue = self._queue(event)
+        member = QueueMember()
+        member.update(event)
+        return queue, queue.members.get(member.interface)
+
+    def _agent_connect(self, event):
+        queue, member = self._agent(event)
+        if member is not None:
+            member.in_call = event.get_header('Uniqueid')
+
+    def _agent_complete(self, event):
+        queue, member = self._agent(event)
+        self._increment(queue, 'Completed')
+        if member is not None:
+            member.in_call = None
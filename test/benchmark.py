@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+""" Benchmarks for asterisk.manager and asterisk.agi, run with
+
+    python3 -m test.benchmark [--quick] [--json results.json]
+                              [--compare baseline.json] [name ...]
+
+    parse    -- frame parsing compares the chunk based _Framer and
+                single pass ManagerMsg parser with the line based
+                implementation used before (kept here as a reference)
+                on an event storm of Newexten and VarSet events as seen
+                when running dialplan with many channels.
+    events   -- creating events for filtering by name and the memory
+                per event waiting in the event queue.
+    dispatch -- events per second through Manager.event_dispatch, sent
+                by AsteriskEmu with a CallGenerator.
+    actions  -- round trip time of send_action and the throughput of
+                pipelined and batched actions against AsteriskEmu.
+    agi      -- round trip time of an AGI command over a socket pair
+                with a forked process answering as asterisk.
+
+    Everything runs offline with fixed sizes, timings are the best of
+    several runs. With --json the results are written as JSON, with
+    --compare they are checked against the results of an earlier run:
+    Rates (*_per_s) dropping or times and sizes (*_us, *_per_event)
+    growing by more than --tolerance (default 20%) are reported as
+    regressions and the exit status is 1.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from   collections import OrderedDict
+from   concurrent.futures import wait
+from   io import BytesIO
+from   asterisk.agi import AGI
+from   asterisk.astemu import AsteriskEmu, CallGenerator, Event as EmuEvent
+from   asterisk.manager import Manager, ManagerMsg, Event, _Framer, _EventQueue
+
+EOL = '\r\n'
+
+def event_storm(n):
+    """ Return the bytes of n events as sent by asterisk.
+    """
+    ev = []
+    for k in range(n // 2):
+        uid = '1325950970.%d' % (k % 1000)
+        ev.append \
+            ( 'Event: Newexten\r\n'
+              'Privilege: dialplan,all\r\n'
+              'Channel: Local/102@from-queue-a8ca;2\r\n'
+              'Context: macro-dial-one\r\n'
+              'Extension: zap2dahdi\r\n'
+              'Priority: %d\r\n'
+              'Application: Set\r\n'
+              'AppData: ITER=%d\r\n'
+              'Uniqueid: %s\r\n'
+              '\r\n'
+              'Event: VarSet\r\n'
+              'Privilege: dialplan,all\r\n'
+              'Channel: Local/102@from-queue-a8ca;2\r\n'
+              'Variable: ITER\r\n'
+              'Value: %d\r\n'
+              'Uniqueid: %s\r\n'
+              '\r\n'
+            % (k % 20, k, uid, k, uid)
+            )
+    return ('Asterisk Call Manager/1.1\r\n' + ''.join(ev)).encode('utf-8')
+
+def legacy_frames(data):
+    """ The line based framing of Manager._receive_data before it was
+        replaced by _Framer, reading from a file object.
+    """
+    f = BytesIO(data)
+    title = None
+    multiline = False
+    wait_for_marker = False
+    while True:
+        lines = []
+        for line in f:
+            line = line.decode('utf-8')
+            if not title and '/' in line and not ':' in line:
+                title = line.split('/')[0].strip()
+                lines.append ('Response: Generated Header\r\n')
+                lines.append (line)
+                break
+            if line == EOL and not wait_for_marker :
+                multiline = False
+                if lines:
+                    break
+                continue
+            lines.append(line)
+            if not line.endswith('\r\n') or ':' not in line:
+                multiline = True
+            if not multiline and line.startswith('Response') and \
+                line.split(':', 1)[1].strip() == 'Follows':
+                wait_for_marker = True
+            if multiline and line.startswith('--END COMMAND--'):
+                wait_for_marker = False
+                multiline = False
+        else:
+            return
+        yield lines
+
+def legacy_parse(response):
+    """ The line based ManagerMsg.parse before the single pass parser.
+    """
+    headers = {}
+    multiheaders = {}
+    data = []
+    for n, line in enumerate (response):
+        if not line.endswith ('\r\n'):
+            data.extend(response[n:])
+            break
+        try:
+            k, v = (x.strip() for x in line.split(':',1))
+            if k not in multiheaders:
+                multiheaders[k]=[]
+            headers[k] = v
+            multiheaders[k].append(v)
+        except ValueError:
+            data.extend(response[n:])
+            break
+    return headers, multiheaders, ''.join(data)
+
+def bench_legacy(data):
+    n = 0
+    for lines in legacy_frames(data):
+        legacy_parse(lines)
+        n += 1
+    return n
+
+def bench_framer(data, chunksize=65536):
+    n = 0
+    framer = _Framer()
+    for pos in range(0, len(data), chunksize):
+        for frame in framer.feed(data[pos:pos + chunksize]):
+            ManagerMsg(frame).headers
+            n += 1
+    return n
+
+def bench_dispatch_filter(frames):
+    """ Create events and look at their name only, as done for events
+        nobody has registered a callback for.
+    """
+    n = 0
+    for frame in frames:
+        if Event(ManagerMsg(frame)).name == 'Hangup':
+            n += 1
+    return n
+
+def event_memory(frames):
+    """ Bytes allocated per event waiting in the event queue (not
+        counting the frame text).
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = _EventQueue()
+    for f in frames:
+        queue.put(Event(ManagerMsg(f)))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(frames)
+
+def timeit(fn, *args, **kw):
+    repeat = kw.pop('repeat', 3)
+    best = None
+    for k in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def bench_parse(n=100000):
+    data = event_storm(n)
+    t_old, n_old = timeit(bench_legacy, data)
+    t_new, n_new = timeit(bench_framer, data)
+    assert n_old == n_new
+    return dict \
+        ( frames         = n_new
+        , legacy_per_s   = n_old / t_old
+        , framer_per_s   = n_new / t_new
+        , speedup        = t_old / t_new
+        )
+
+def bench_events(n=100000):
+    # skip the greeting
+    frames = _Framer().feed(event_storm(n))[1:]
+    t, r = timeit(bench_dispatch_filter, frames)
+    return dict \
+        ( events         = len(frames)
+        , filter_per_s   = len(frames) / t
+        , bytes_per_event = event_memory(frames)
+        )
+
+def dispatch_run(n):
+    """ Time from login until n generated events were dispatched.
+    """
+    emu = AsteriskEmu({}, generator = CallGenerator(rate = 0, count = n))
+    manager = Manager()
+    try:
+        manager.connect('localhost', port = emu.port)
+        done = threading.Event()
+        count = [0]
+        def callback(event, manager):
+            count[0] += 1
+            if count[0] == n:
+                done.set()
+        manager.register_event('*', callback)
+        start = time.perf_counter()
+        manager.login('bench', 'bench')
+        if not done.wait(120):
+            raise RuntimeError('Only %d of %d events dispatched' % (count[0], n))
+        return time.perf_counter() - start
+    finally:
+        manager.close()
+        emu.close()
+
+def bench_dispatch(n=100000):
+    t = min(dispatch_run(n) for k in range(3))
+    return dict(events = n, dispatch_per_s = n / t)
+
+def bench_actions(n=5000):
+    pong = EmuEvent(Response = ('Success',), Ping = ('Pong',))
+    emu = AsteriskEmu(dict(Ping = (pong,)))
+    manager = Manager()
+    try:
+        manager.connect('localhost', port = emu.port)
+        rtt = []
+        for k in range(n // 5):
+            start = time.perf_counter()
+            manager.ping()
+            rtt.append(time.perf_counter() - start)
+        rtt.sort()
+        def pipelined():
+            wait([manager.ping_async() for k in range(n)])
+        def batched():
+            with manager.batch():
+                futures = [manager.ping_async() for k in range(n)]
+            wait(futures)
+        t_pipe = timeit(pipelined)[0]
+        t_batch = timeit(batched)[0]
+    finally:
+        manager.close()
+        emu.close()
+    return dict \
+        ( actions           = n
+        , rtt_mean_us       = 1e6 * sum(rtt) / len(rtt)
+        , rtt_p50_us        = 1e6 * rtt[len(rtt) // 2]
+        , rtt_p99_us        = 1e6 * rtt[len(rtt) * 99 // 100]
+        , pipelined_per_s   = n / t_pipe
+        , batched_per_s     = n / t_batch
+        )
+
+def agi_responder(sock):
+    """ Answer every AGI command with success, like asterisk would.
+    """
+    f = sock.makefile('rw')
+    f.write('agi_request: benchmark\nagi_channel: SIP/1-00000001\n\n')
+    f.flush()
+    for line in f:
+        f.write('200 result=0\n')
+        f.flush()
+
+def bench_agi(n=20000):
+    parent, child = socket.socketpair()
+    pid = os.fork()
+    if not pid:
+        parent.close()
+        try:
+            agi_responder(child)
+        finally:
+            os._exit(0)
+    child.close()
+    devnull = open(os.devnull, 'w')
+    stdin = parent.makefile('r')
+    stdout = parent.makefile('w')
+    try:
+        agi = AGI(stdin, stdout, devnull)
+        def commands():
+            for k in range(n):
+                agi.noop()
+        t = timeit(commands)[0]
+    finally:
+        stdout.close()
+        stdin.close()
+        parent.close()
+        devnull.close()
+        os.waitpid(pid, 0)
+    return dict(commands = n, rtt_us = 1e6 * t / n, commands_per_s = n / t)
+
+# name, function, size for --quick
+benchmarks = OrderedDict \
+    (( ('parse',    (bench_parse,    10000))
+     , ('events',   (bench_events,   10000))
+     , ('dispatch', (bench_dispatch, 10000))
+     , ('actions',  (bench_actions,  1000))
+     , ('agi',      (bench_agi,      2000))
+    ))
+
+def regressions(results, baseline, tolerance):
+    """ Compare results with a baseline, returns a list of messages.
+    """
+    found = []
+    for name, values in results.items():
+        for key, value in values.items():
+            old = baseline.get(name, {}).get(key)
+            if not old:
+                continue
+            if key.endswith('_per_s'):
+                change = (old - value) / old
+            elif key.endswith('_us') or key.endswith('_per_event'):
+                change = (value - old) / old
+            else:
+                continue
+            if change > tolerance:
+                found.append \
+                    ( '%s.%s: %.6g (baseline %.6g, %.0f%% worse)'
+                    % (name, key, value, old, 100 * change)
+                    )
+    return found
+
+def main(argv=None):
+    cmd = argparse.ArgumentParser(description = 'pyst benchmarks')
+    # the empty default of nargs='*' is checked against choices, too
+    cmd.add_argument('names', nargs = '*', choices = [[]] + list(benchmarks),
+        help = 'Benchmarks to run, default all')
+    cmd.add_argument('--quick', action = 'store_true',
+        help = 'Run with small sizes, e.g. to check that all benchmarks work')
+    cmd.add_argument('--json', help = 'Write the results to this file')
+    cmd.add_argument('--compare', help = 'Results of an earlier run')
+    cmd.add_argument('--tolerance', type = float, default = 0.2,
+        help = 'Relative change reported as regression, default %(default)s')
+    args = cmd.parse_args(argv)
+    results = OrderedDict()
+    for name in args.names or benchmarks:
+        fn, quick = benchmarks[name]
+        r = fn(quick) if args.quick else fn()
+        results[name] = r
+        print('%s:' % name)
+        for key, value in r.items():
+            if isinstance(value, float):
+                print('  %-18s %14.2f' % (key, value))
+            else:
+                print('  %-18s %14d' % (key, value))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump \
+                ( dict
+                    ( python   = platform.python_version()
+                    , platform = platform.platform()
+                    , time     = time.time()
+                    , quick    = args.quick
+                    , results  = results
+                    )
+                , f, indent = 2
+                )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        found = regressions(results, baseline, args.tolerance)
+        for msg in found:
+            print('Regression: %s' % msg)
+        if found:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,29 @@ import sys
 import os
 import socket
 import unittest
+import threading
+import time
+import asyncio
+import tempfile
+from   concurrent.futures import wait, Future
 from   subprocess import Popen
-from   asterisk.manager import Manager
+from   asterisk.manager import Manager, ManagerMsg, ManagerTimeoutException
+from   asterisk.manager import _Framer, Event as ManagerEvent
+from   asterisk.manager import _EventFilter, _EventTable, _unsubscribed
+from   asterisk.manager import _EventQueue, ManagerException
+from   asterisk.manager import ManagerSocketException, EventList
+from   asterisk.pool import ManagerPool
+from   asterisk.metrics import Metrics
+from   asterisk.record import Recorder, Replay
+from   asterisk.cli import run_commands, parse_table
+from   asterisk.originate import OriginateEngine, _channel_trunk
+from   asterisk.state import ChannelRegistry, PeerRegistry, QueueRegistry
 from   asterisk.compat import Queue, string_types
-from   asterisk.astemu import Event, AsteriskEmu
-from   asterisk.agi import AGI, AGIDBError
+from   asterisk.asyncmanager import AsyncManager
+from   asterisk.astemu import Event, AsteriskEmu, CallGenerator
+from   asterisk.astemu import EventListAnswer
+from   asterisk.agi import AGI, AGIDBError, AGISIGHUPHangup, FastAGIServer
+from   asterisk.asyncagi import AsyncFastAGIServer
 
 class Test_Manager(unittest.TestCase):
     """ Test the asterisk management interface.
@@ -22,10 +40,12 @@ class Test_Manager(unittest.TestCase):
         if self.manager:
             self.manager.close()
             self.manager = None
-        self.astemu.close()
+        if self.astemu:
+            self.astemu.close()
 
     def setUp(self):
         self.manager  = None
+        self.astemu   = None
         self.childpid = None
         self.events   = []
         self.evcount  = 0
@@ -57,6 +77,11 @@ class Test_Manager(unittest.TestCase):
                 self.assertEqual(sorted(r_event.multiheaders[k]),
                     sorted(list(v)))
 
+    def make_event(self, name, **headers):
+        headers = [('Event', name)] + sorted(headers.items())
+        text = ''.join('%s: %s\r\n' % kv for kv in headers)
+        return ManagerEvent(ManagerMsg(text))
+
     def test_login(self):
         self.run_manager({})
         r = self.manager.login('account', 'geheim')
@@ -88,6 +113,63 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
         self.assertEqual(self.events, [])
         self.compare_result(r, events['Command'][0])
 
+    def test_run_commands(self):
+        events = dict \
+            ( Command =
+                ( Event
+                    ( Response  = ('Follows',)
+                    , Privilege = ('Command',)
+                    , CONTENT   =
+"""Channel              Location             State   Application(Data)
+SIP/100-00000001     s@from-internal:1    Up      Dial(SIP/200,30)
+SIP/200-00000002     (None)               Ringing AppDial((Outgoing Line))
+2 active channels
+1 active call
+372 calls processed
+--END COMMAND--\r
+"""
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        commands = ['core show channels', 'core show channels']
+        tables = run_commands(self.manager, commands, timeout = 5)
+        self.assertEqual(len(tables), 2)
+        table = tables[1]
+        self.assertEqual(table.command, 'core show channels')
+        self.assertEqual \
+            (table.columns, ['Channel', 'Location', 'State', 'Application(Data)'])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table[0]['Location'], 's@from-internal:1')
+        self.assertEqual(table[1]['State'], 'Ringing')
+        self.assertEqual(table[1]['Application(Data)'], 'AppDial((Outgoing Line))')
+        self.assertEqual(table.footer[0], '2 active channels')
+        self.assertEqual(len(table.footer), 3)
+
+    def test_parse_table(self):
+        text = \
+            ( 'Response: Follows\r\nPrivilege: Command\r\n'
+              'Name/username             Host            Dyn Port     Status\n'
+              'provider/provider-account-1 192.0.2.1         5060     OK (10 ms)\n'
+              '100/100                   (Unspecified)    D  0        UNKNOWN\n'
+              '2 sip peers [Monitored: 1 online, 1 offline]\n'
+              '--END COMMAND--\r\n'
+            )
+        table = parse_table('sip show peers', ManagerMsg(text))
+        self.assertEqual(len(table), 2)
+        # the first value overflows into the column of Host
+        self.assertEqual(table[0]['Name/username'], 'provider/provider-account-1')
+        self.assertEqual(table[0]['Host'], '192.0.2.1')
+        self.assertEqual(table[0]['Dyn'], '')
+        self.assertEqual(table[0]['Status'], 'OK (10 ms)')
+        self.assertEqual(table[1]['Dyn'], 'D')
+        self.assertEqual(table[1]['Port'], '0')
+        self.assertEqual \
+            (table.footer, ['2 sip peers [Monitored: 1 online, 1 offline]'])
+        error = ManagerMsg('Response: Error\r\nMessage: No such command\r\n')
+        self.assertEqual(parse_table('sip show peers', error), [])
+
     def test_redirect(self):
         d = dict
         events = dict \
@@ -224,6 +306,680 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
             n = self.queue.get()
             self.compare_result(self.events[n], events['Originate'][n+1])
 
+    def test_concurrent_actions(self):
+        events = dict \
+            ( Ping =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Ping      = ('Pong',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        results = {}
+        def ping(n):
+            aid = 'ping-%d' % n
+            r = self.manager.send_action({'Action' : 'Ping'}, ActionID = aid)
+            results[aid] = r.get_header('ActionID')
+        threads = [threading.Thread(target=ping, args=(n,)) for n in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 20)
+        for aid, r_aid in results.items():
+            self.assertEqual(aid, r_aid)
+        self.assertEqual(self.manager._pending, {})
+
+    def test_pipelined_actions(self):
+        events = dict \
+            ( Hangup =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Message   = ('Channel Hungup',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        channels = ['lcr/%d' % n for n in range(100)]
+        futures  = [self.manager.hangup_async(c) for c in channels]
+        done, not_done = wait(futures, timeout=10)
+        self.assertEqual(len(done), 100)
+        for f in futures:
+            r = f.result()
+            self.assertEqual(r.get_header('ActionID'), f.action_id)
+            self.compare_result(r, events['Hangup'][0])
+        self.assertEqual(self.manager._pending, {})
+
+    status_events = dict \
+        ( Status =
+            ( Event
+                ( Response  = ('Success',)
+                , EventList = ('start',)
+                , Message   = ('Channel status will follow',)
+                )
+            , Event
+                ( Event     = ('Status',)
+                , Channel   = ('lcr/556',)
+                , Uniqueid  = ('1332366541.556',)
+                , ActionID  = ('',)
+                )
+            , Event
+                ( Event     = ('Newexten',)
+                , Channel   = ('lcr/557',)
+                , Uniqueid  = ('1332366541.558',)
+                )
+            , Event
+                ( Event     = ('Status',)
+                , Channel   = ('lcr/558',)
+                , Uniqueid  = ('1332366541.559',)
+                , ActionID  = ('',)
+                )
+            , Event
+                ( Event     = ('StatusComplete',)
+                , EventList = ('Complete',)
+                , ListItems = ('2',)
+                , ActionID  = ('',)
+                )
+            )
+        )
+
+    def test_list_action(self):
+        self.run_manager(self.status_events)
+        r = self.manager.status_list()
+        self.compare_result(r.response, self.status_events['Status'][0])
+        self.assertEqual([e.name for e in r], ['Status', 'Status'])
+        self.assertEqual \
+            ([e['Channel'] for e in r], ['lcr/556', 'lcr/558'])
+        self.assertEqual(r.complete['ListItems'], '2')
+        # events without our ActionID are dispatched as usual
+        self.assertEqual(self.queue.get(timeout=5), 0)
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0].name, 'Newexten')
+        self.assertEqual(self.manager._collectors, {})
+        self.assertEqual(r.error, None)
+
+    def test_list_action_error(self):
+        events = dict \
+            ( Status =
+                (Event(Response = ('Error',), Message = ('Permission denied',)),)
+            )
+        self.run_manager(events)
+        r = self.manager.status_list()
+        self.assertEqual(list(r), [])
+        self.assertEqual(r.error, 'Permission denied')
+
+    def test_list_stream(self):
+        self.run_manager(self.status_events)
+        stream = self.manager.iter_list_action \
+            ({'Action' : 'Status'}, maxsize = 1)
+        channels = []
+        for e in stream:
+            # a slow consumer
+            self.assertEqual(stream._collector.queue.qsize(), 0)
+            time.sleep(0.1)
+            channels.append(e['Channel'])
+        self.assertEqual(channels, ['lcr/556', 'lcr/558'])
+        self.compare_result(stream.response, self.status_events['Status'][0])
+        self.assertEqual(stream.complete.name, 'StatusComplete')
+        self.assertEqual(self.manager._collectors, {})
+        # abandon a stream early
+        stream = self.manager.iter_list_action({'Action' : 'Status'})
+        self.assertEqual(next(stream)['Channel'], 'lcr/556')
+        stream.close()
+        self.assertEqual(list(stream), [])
+        r = self.manager.status_list()
+        self.assertEqual(len(r), 2)
+        for k in range(3):
+            self.queue.get(timeout=5)
+        self.assertEqual([e.name for e in self.events], ['Newexten'] * 3)
+        # a stream left by a with statement or abandoned does not block
+        # the message thread
+        self.manager.timeout = 5
+        with self.manager.iter_list_action \
+            ({'Action' : 'Status'}, maxsize = 1) as stream:
+            self.assertEqual(next(stream)['Channel'], 'lcr/556')
+            time.sleep(0.1)
+        self.assertEqual(len(self.manager.status_list()), 2)
+        stream = self.manager.iter_list_action \
+            ({'Action' : 'Status'}, maxsize = 1)
+        time.sleep(0.1)
+        del stream
+        self.assertEqual(len(self.manager.status_list()), 2)
+
+    def test_framer(self):
+        data = \
+            ( b'Asterisk Call Manager/1.1\r\n'
+              b'Response: Follows\r\nPrivilege: Command\r\nActionID: 1\r\n'
+              b'Channel   Location\n\r\n1 active channel\n'
+              b'--END COMMAND--\r\n\r\n\r\n'
+              b'Event: AgentCalled\r\nVariable: a=1\r\nVariable: b=2\r\n\r\n'
+              b'Event: VarSet\r\nValue: \xc3\xa4\r\n\r\n'
+            )
+        for size in 1, 2, 5, 17, len(data):
+            framer = _Framer()
+            frames = []
+            for pos in range(0, len(data), size):
+                frames.extend(framer.feed(data[pos:pos + size]))
+            self.assertEqual(framer.title, 'Asterisk Call Manager')
+            self.assertEqual(framer.version, '1.1')
+            msgs = [ManagerMsg(f) for f in frames]
+            self.assertEqual(len(msgs), 4)
+            self.assertEqual(msgs[0]['Response'], 'Generated Header')
+            self.assertEqual(msgs[1]['Response'], 'Follows')
+            self.assertEqual \
+                ( msgs[1].data
+                , 'Channel   Location\n\r\n1 active channel\n'
+                  '--END COMMAND--\r\n'
+                )
+            self.assertEqual \
+                (msgs[2].multiheaders['Variable'], ['a=1', 'b=2'])
+            self.assertEqual(msgs[3]['Value'], '\xe4')
+
+    def test_lazy_parse(self):
+        msg = ManagerMsg('Event: Newexten\r\nChannel: SIP/1\r\n\r\n')
+        self.assertTrue(msg.is_event())
+        ev = ManagerEvent(msg)
+        self.assertEqual(ev.name, 'Newexten')
+        self.assertIsNone(msg._headers)
+        self.assertEqual(ev['Channel'], 'SIP/1')
+        self.assertEqual(msg._headers, dict(Event='Newexten', Channel='SIP/1'))
+        self.assertRaises(AttributeError, setattr, ev, 'foo', 1)
+        self.assertFalse(ManagerMsg('Response: Success\r\n').is_event())
+
+    def test_unsubscribed(self):
+        newexten = 'Event: Newexten\r\nChannel: SIP/1\r\n'
+        events = _EventTable()
+        events.register('VarSet', self.handler)
+        events.register('Newexten', self.handler)
+        events.unregister('Newexten', self.handler)
+        self.assertTrue(_unsubscribed(newexten, events, {}))
+        self.assertFalse(_unsubscribed('Event: VarSet', events, {}))
+        self.assertFalse \
+            (_unsubscribed('Response: Success\r\n', _EventTable(), {}))
+        # events might belong to an outstanding list action
+        self.assertFalse(_unsubscribed(newexten, events, {'1': None}))
+        events.register('New*', self.handler)
+        self.assertFalse(_unsubscribed(newexten, events, {}))
+
+    def test_event_filter_actions(self):
+        f = _EventFilter()
+        self.assertEqual \
+            (f.update(set()), [{'Action':'Events', 'EventMask':'off'}])
+        self.assertEqual(f.update(set()), [])
+        self.assertEqual \
+            ( f.update(set(['Hangup']))
+            , [ {'Action':'Events', 'EventMask':'on'}
+              , {'Action':'Filter', 'Operation':'Add', 'Filter':'Event: Hangup'}
+              ]
+            )
+        self.assertEqual(f.update(set(['Hangup'])), [])
+        self.assertEqual \
+            ( f.update(set(['Hangup', '*']))
+            , [{'Action':'Filter', 'Operation':'Add', 'Filter':'.*'}]
+            )
+        self.assertEqual(f.update(set(['Newexten'])), [])
+        self.assertEqual \
+            ( _EventFilter().update(set(['Queue*', 'Agent[CD]*']))
+            , [{'Action':'Filter', 'Operation':'Add', 'Filter':'.*'}]
+            )
+        self.assertEqual \
+            ( _EventFilter().update(set(['Queue*']))
+            , [{'Action':'Filter', 'Operation':'Add', 'Filter':'Event: Queue'}]
+            )
+
+    def test_event_table(self):
+        calls = []
+        def callback(tag, stop=False):
+            def f(event, manager):
+                calls.append(tag)
+                return stop
+            return f
+        event = self.make_event
+        manager = Manager()
+        wildcard = callback('*')
+        manager.register_event('*', wildcard)
+        manager.register_event('QueueMember*', callback('glob'))
+        manager.register_event('QueueMemberAdded', callback('name'))
+        manager.register_event \
+            ('Hangup', callback('pstn', True), {'Context':'from-pstn'})
+        manager.register_event \
+            ('Hangup', callback('cause'), lambda e: e['Cause'] == '16')
+        manager._dispatch(event('QueueMemberAdded'))
+        self.assertEqual(calls, ['glob', 'name', '*'])
+        lookup = manager._events.lookup('QueueMemberAdded')
+        self.assertTrue(manager._events.lookup('QueueMemberAdded') is lookup)
+        del calls[:]
+        manager._dispatch(event('Hangup', Context='default', Cause='16'))
+        manager._dispatch(event('Hangup', Context='from-pstn', Cause='16'))
+        manager._dispatch(event('Newexten'))
+        self.assertEqual(calls, ['cause', '*', 'pstn', '*'])
+        manager.unregister_event('*', wildcard)
+        self.assertEqual(manager._events.lookup('Newexten'), ())
+        self.assertRaises \
+            (ValueError, manager.unregister_event, '*', wildcard)
+
+    def test_event_filter(self):
+        success = Event(Response = ('Success',))
+        events = dict \
+            ( Login =
+                ( self.default_events['Login'][0]
+                , Event(Event = ('Newexten',), Channel = ('SIP/1',))
+                , Event(Event = ('VarSet',), Channel = ('SIP/2',))
+                )
+            , Filter = (success,)
+            )
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager(event_filter = True)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.register_event ('VarSet', self.handler)
+        self.manager.login('account', 'geheim')
+        self.queue.get(timeout = 5)
+        self.assertEqual([e.name for e in self.events], ['VarSet'])
+        self.assertEqual(self.manager._filter.added, set(['Event: VarSet']))
+
+    def test_dispatch_workers(self):
+        newexten = []
+        for n in range(30):
+            newexten.append \
+                ( Event
+                    ( Event    = ('Newexten',)
+                    , Uniqueid = ('1325950970.%d' % (n % 3),)
+                    , Priority = (str(n),)
+                    )
+                )
+        events = dict(Login = [self.default_events['Login'][0]] + newexten)
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager(dispatch_workers = 3)
+        def handler(event, manager):
+            if event['Uniqueid'] == '1325950970.0':
+                # slow callback must not reorder events of the channel
+                time.sleep(0.01)
+            self.handler(event, manager)
+        self.manager.register_event('Newexten', handler)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        for n in range(30):
+            self.queue.get(timeout = 5)
+        by_channel = {}
+        for e in self.events:
+            by_channel.setdefault(e['Uniqueid'], []).append(int(e['Priority']))
+        self.assertEqual(len(by_channel), 3)
+        for priorities in by_channel.values():
+            self.assertEqual(priorities, sorted(priorities))
+        # workers count the event after the callback returned
+        self.manager.close()
+        stats = self.manager.dispatch_stats()
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(sum(s['dispatched'] for s in stats), 30)
+
+    def test_event_queue_overload(self):
+        event = self.make_event
+        q = _EventQueue(3, 'drop_oldest')
+        for n in range(5):
+            q.put(event('Newexten', Priority=str(n)))
+        q.put(None)
+        self.assertEqual \
+            ([q.get()['Priority'] for n in range(3)], ['2', '3', '4'])
+        self.assertEqual(q.get(), None)
+        self.assertEqual \
+            (q.stats(), dict(queued=0, max_queued=4, dropped=2, coalesced=0))
+
+        q = _EventQueue(2, 'drop_priority', dict(Hangup=10, VarSet=-1))
+        for name in 'Newexten', 'Hangup', 'VarSet', 'Newchannel':
+            q.put(event(name))
+        self.assertEqual \
+            ([q.get().name for n in range(2)], ['Hangup', 'Newchannel'])
+        self.assertEqual(q.dropped, 2)
+
+        q = _EventQueue(3, 'coalesce')
+        q.put(event('Newstate', Uniqueid='1', ChannelState='4'))
+        q.put(event('Newstate', Uniqueid='2', ChannelState='4'))
+        q.put(event('Newstate', Uniqueid='1', ChannelState='5'))
+        q.put(event('Newstate', Uniqueid='1', ChannelState='6'))
+        self.assertEqual \
+            ( [(e['Uniqueid'], e['ChannelState']) for e in q.events()]
+            , [('1', '4'), ('2', '4'), ('1', '6')]
+            )
+        self.assertEqual((q.coalesced, q.dropped), (1, 0))
+        q.put(event('Newstate', Uniqueid='2', ChannelState='6'))
+        self.assertEqual((q.coalesced, q.dropped), (2, 0))
+        q.put(event('Hangup', Uniqueid='3'))
+        self.assertEqual((q.coalesced, q.dropped), (2, 1))
+        q.put(event('Newstate', Uniqueid='1', ChannelState='7'))
+        self.assertEqual \
+            ( [(e.name, e['Uniqueid']) for e in q.events()]
+            , [('Newstate', '2'), ('Newstate', '1'), ('Hangup', '3')]
+            )
+        self.assertEqual(q.get()['ChannelState'], '6')
+        self.assertEqual(q.get()['ChannelState'], '7')
+
+        self.assertRaises(ValueError, Manager, overload='panic')
+
+    def test_event_queue_full(self):
+        # each event put into a large full queue takes constant time
+        names = ['Newexten', 'VarSet', 'Hangup', 'Newstate']
+        events = [self.make_event \
+            (names[n % 4], Uniqueid=str(n % 5000), Priority=str(n))
+            for n in range(40000)]
+        for policy in 'drop_oldest', 'drop_priority', 'coalesce':
+            q = _EventQueue(10000, policy, dict(Hangup=10, VarSet=-1))
+            start = time.time()
+            for ev in events:
+                q.put(ev)
+            self.assertTrue(time.time() - start < 2, policy)
+            self.assertEqual(q.qsize(), 10000)
+            self.assertEqual(len(q.events()), 10000)
+            stats = q.stats()
+            self.assertEqual \
+                (stats['dropped'] + stats['coalesced'] + 10000, 40000)
+            n = 0
+            while q.qsize():
+                q.get()
+                n += 1
+            self.assertEqual(n, 10000)
+        # no Hangup was dropped
+        q = _EventQueue(10000, 'drop_priority', dict(Hangup=10, VarSet=-1))
+        for ev in events[:20000]:
+            q.put(ev)
+        self.assertEqual \
+            (len([e for e in q.events() if e.name == 'Hangup']), 5000)
+
+    def test_event_queue_block(self):
+        q = _EventQueue(1)
+        q.put(self.make_event('Newexten'))
+        t = threading.Thread(target=q.put, args=(self.make_event('Hangup'),))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(q.get().name, 'Newexten')
+        t.join(5)
+        self.assertEqual(q.get().name, 'Hangup')
+
+    def test_reconnect(self):
+        events = dict \
+            ( Status =
+                ( None
+                , Event(Response = ('Success',), Message = ('Status',))
+                )
+            , Ping = (Event(Response = ('Success',), Ping = ('Pong',)),)
+            )
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager(reconnect = True, reconnect_delay = 0.05)
+        reconnected = Queue()
+        self.manager.register_reconnect(reconnected.put)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        # never answered, not replayed
+        hangup = self.manager.hangup_async('SIP/1')
+        # drops the connection, answered after reconnect
+        status = self.manager.status_async()
+        self.assertTrue(reconnected.get(timeout = 5) is self.manager)
+        self.assertEqual(status.result(5)['Message'], 'Status')
+        self.assertRaises(ManagerSocketException, hangup.result, 5)
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(self.manager._credentials, ('account', 'geheim'))
+        # while the session is resumed actions wait
+        with self.manager._session:
+            self.manager._ready = False
+        pings = Queue()
+        t = threading.Thread \
+            (target=lambda: pings.put(self.manager.ping()['Ping']))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        with self.manager._session:
+            self.manager._ready = True
+            self.manager._session.notify_all()
+        self.assertEqual(pings.get(timeout = 5), 'Pong')
+        with self.manager._session:
+            self.manager._ready = False
+        self.manager.timeout = 0.1
+        self.assertRaises(ManagerTimeoutException, self.manager.ping)
+        with self.manager._session:
+            self.manager._ready = True
+
+    def test_reconnect_batch(self):
+        events = dict \
+            ( Originate =
+                ( Event(Response = ('Success',), Message = ('Originated',))
+                , Event(Event = ('Newchannel',), Channel = ('SIP/9',))
+                )
+            , Ping = (Event(Response = ('Success',), Ping = ('Pong',)),)
+            )
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager \
+            (reconnect = True, reconnect_delay = 0.05, timeout = 5)
+        self.manager.register_event ('*', self.handler)
+        reconnected = Queue()
+        self.manager.register_reconnect(reconnected.put)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        # actions buffered when the connection is lost fail and are
+        # not written to the next connection
+        self.manager.write_delay = 60
+        delayed = self.manager.originate_async('SIP/9', '100')
+        with self.manager.batch():
+            batched = self.manager.originate_async('SIP/9', '100')
+            self.manager._sock.shutdown(socket.SHUT_RDWR)
+            reconnected.get(timeout = 5)
+        self.manager.write_delay = 0
+        self.manager.flush()
+        for future in batched, delayed:
+            self.assertRaises(ManagerSocketException, future.result, 5)
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(self.events, [])
+
+    def count_writes(self):
+        """ Record the writes of the manager to its socket.
+        """
+        writes = []
+        sock = self.manager._sock
+        class Socket(object):
+            def sendall(self, data):
+                writes.append(data)
+                sock.sendall(data)
+            def __getattr__(self, name):
+                return getattr(sock, name)
+        self.manager._sock = Socket()
+        return writes
+
+    def test_batch(self):
+        pong = Event(Response = ('Success',), Ping = ('Pong',))
+        events = dict(Ping = (pong,))
+        self.run_manager(events)
+        writes = self.count_writes()
+        with self.manager.batch():
+            futures = [self.manager.ping_async() for k in range(3)]
+            with self.manager.batch():
+                futures.append(self.manager.ping_async())
+            self.assertEqual(writes, [])
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0].count(b'Action: Ping'), 4)
+        for f in futures:
+            self.assertEqual(f.result(5)['Ping'], 'Pong')
+        # waiting for a response inside a batch writes it
+        with self.manager.batch():
+            self.manager.ping_async()
+            self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(len(writes), 2)
+        self.manager.write_budget = 1
+        with self.manager.batch():
+            self.manager.ping_async()
+            self.manager.ping_async()
+            self.assertEqual(len(writes), 4)
+
+    def test_write_delay(self):
+        pong = Event(Response = ('Success',), Ping = ('Pong',))
+        events = dict(Ping = (pong,))
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager(write_delay = 0.5)
+        self.manager.connect('localhost', port = self.astemu.port)
+        writes = self.count_writes()
+        futures = [self.manager.ping_async() for k in range(3)]
+        self.assertEqual(writes, [])
+        for f in futures:
+            self.assertEqual(f.result(5)['Ping'], 'Pong')
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.manager.ping()['Ping'], 'Pong')
+        self.assertEqual(len(writes), 2)
+
+    def test_metrics(self):
+        events = dict \
+            ( Ping =
+                ( Event(Response = ('Success',), Ping = ('Pong',))
+                , Event(Event = ('Hangup',), Channel = ('SIP/1',))
+                )
+            )
+        metrics = Metrics()
+        self.astemu = AsteriskEmu (events)
+        self.manager = Manager(metrics = metrics)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.register_event('Hangup', self.handler)
+        self.manager.ping()
+        self.manager.ping()
+        self.assertRaises \
+            ( ManagerTimeoutException
+            , self.manager.send_action, {'Action' : 'Unknown'}, timeout=0.1
+            )
+        self.close()
+        d = metrics.as_dict()
+        self.assertEqual(d['counters']['actions_total']['Ping'], 2)
+        self.assertEqual(d['counters']['action_errors_total'], {'Unknown': 1})
+        self.assertEqual(d['counters']['events_total'], {'Hangup': 2})
+        self.assertTrue(d['counters']['bytes_received_total'] > 0)
+        rtt = d['histograms']['action_rtt_seconds']['Ping']
+        self.assertEqual(rtt['count'], 2)
+        self.assertEqual(rtt['buckets'][-1], (float('inf'), 2))
+        self.assertEqual(d['histograms']['callback_seconds']['Hangup']['count'], 2)
+        self.assertEqual \
+            (d['histograms']['event_queue_seconds']['Hangup']['count'], 2)
+        self.assertEqual(d['gauges']['event_queue_depth'], 0)
+        text = metrics.prometheus()
+        self.assertTrue('# TYPE asterisk_manager_actions_total counter' in text)
+        self.assertTrue \
+            ('asterisk_manager_actions_total{action="Ping"} 2\n' in text)
+        self.assertTrue \
+            ( 'asterisk_manager_action_rtt_seconds_bucket'
+              '{action="Ping",le="+Inf"} 2\n' in text
+            )
+        self.assertTrue('asterisk_manager_pending_actions 0\n' in text)
+        self.assertEqual(d['counters']['events_dropped_total'], 0)
+        self.assertTrue \
+            ('# TYPE asterisk_manager_events_dropped_total counter' in text)
+        self.assertTrue('asterisk_manager_events_dropped_total 0\n' in text)
+
+    def test_record_replay(self):
+        events = dict \
+            ( Ping =
+                ( Event(Response = ('Success',), Ping = ('Pong',))
+                , Event(Event = ('Hangup',), Channel = ('SIP/1',))
+                , Event(Event = ('Newchannel',), Channel = ('SIP/2',))
+                )
+            )
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.astemu = AsteriskEmu (events)
+        recorder = Recorder(path)
+        self.manager = Manager(recorder = recorder)
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.ping()
+        self.manager.ping()
+        self.close()
+        recorder.close()
+
+        replay = Replay(path, host = 'recorded')
+        self.assertEqual(replay.records().__next__()[1], b'')
+        self.assertEqual \
+            ( [e.name for e in replay.events()]
+            , ['Hangup', 'Newchannel', 'Hangup', 'Newchannel']
+            )
+        self.assertEqual(next(replay.events()).host, 'recorded')
+        replay.close()
+        self.assertTrue(replay._map is None)
+        self.assertRaises(ValueError, list, replay.events())
+
+        # replay through a manager at maximum speed
+        self.manager = Manager()
+        self.manager.register_event('Hangup', self.handler)
+        replay = Replay(path)
+        r = self.manager.replay(replay)
+        self.assertTrue('Asterisk Call Manager' in r.data)
+        self.manager.event_dispatch_thread.join(5)
+        # the manager closed the replay at its end
+        self.assertTrue(replay._map is None)
+        self.assertEqual([e['Channel'] for e in self.events], ['SIP/1'] * 2)
+        self.close()
+
+        # actions get an error during a slow replay, logoff ends it
+        self.manager = Manager()
+        self.manager.replay(Replay(path, speed = 0.001))
+        r = self.manager.send_action({'Action' : 'Ping', 'ActionID' : 'x'})
+        self.assertEqual(r.get_header('Response'), 'Error')
+        self.close()
+
+    def test_emu_clients(self):
+        events = dict(Ping = (Event(Response = ('Success',), Ping = ('Pong',)),))
+        self.run_manager(events)
+        managers = []
+        for n in range(5):
+            m = Manager()
+            m.connect('localhost', port = self.port)
+            managers.append(m)
+        # all clients are served at the same time
+        futures = [m.ping_async() for m in managers + [self.manager]]
+        for f in futures:
+            self.assertEqual(f.result(5)['Ping'], 'Pong')
+        for m in managers:
+            m.close()
+
+    def test_emu_generator(self):
+        self.astemu = AsteriskEmu \
+            ({}, generator = CallGenerator(rate = 0, count = 400, concurrent = 10))
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.register_event('*', self.handler)
+        done = threading.Event()
+        def hangup(event, manager):
+            if len(self.events) == 400:
+                done.set()
+        # callbacks for '*' are called in order of registration
+        self.manager.register_event('*', hangup)
+        self.manager.login('account', 'geheim')
+        self.assertTrue(done.wait(5))
+        names = [e.name for e in self.events]
+        self.assertEqual(names.count('Newchannel'), 100)
+        self.assertEqual(names.count('Hangup'), 100)
+        states = {}
+        for e in self.events:
+            states.setdefault(e['Uniqueid'], []).append(e.get_header('ChannelStateDesc'))
+        self.assertEqual(len(states), 100)
+        for s in states.values():
+            self.assertEqual(s, ['Down', 'Ringing', 'Up', None])
+
+    def test_emu_event_list(self):
+        events = dict \
+            (Status = EventListAnswer('Status', 1000, Channel = 'SIP/%(n)d'))
+        self.run_manager(events)
+        r = self.manager.status_list()
+        self.assertEqual(len(r), 1000)
+        self.assertEqual(r[999]['Channel'], 'SIP/999')
+        self.assertEqual(r.complete['ListItems'], '1000')
+
+    def test_action_timeout(self):
+        self.run_manager({})
+        self.assertRaises \
+            ( ManagerTimeoutException
+            , self.manager.send_action, {'Action' : 'Unknown'}, timeout=0.2
+            )
+        self.assertEqual(self.manager._pending, {})
+        # connection is still usable after a timeout
+        r = self.manager.login('account', 'geheim')
+        self.compare_result(r, self.default_events['Login'][0])
+
     def test_misc_events(self):
         d = dict
         # Events from SF bug 3470641 
@@ -533,6 +1289,105 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
             n = self.queue.get()
             self.compare_result(self.events[n], events['Login'][n+1])
 
+class Test_AsyncManager(unittest.TestCase):
+    """ Test the asyncio version of the management interface.
+    """
+
+    default_events = AsteriskEmu.default_events
+    compare_result = Test_Manager.compare_result
+
+    def setUp(self):
+        self.astemu = None
+        self.events = []
+
+    def tearDown(self):
+        if self.astemu:
+            self.astemu.close()
+
+    async def handler(self, event, manager):
+        self.events.append(event)
+
+    def run_manager(self, chatscript, coroutine):
+        self.astemu = AsteriskEmu (chatscript)
+        async def run():
+            manager = AsyncManager(timeout = 5)
+            await manager.connect('localhost', port = self.astemu.port)
+            manager.register_event ('*', self.handler)
+            try:
+                await coroutine(manager)
+            finally:
+                await manager.close()
+        asyncio.run(run())
+
+    def test_login(self):
+        async def login(manager):
+            r = await manager.login('account', 'geheim')
+            self.compare_result(r, self.default_events['Login'][0])
+        self.run_manager({}, login)
+        self.assertEqual(self.events, [])
+
+    def test_list_action(self):
+        events = Test_Manager.status_events
+        async def status(manager):
+            r1, r2 = await asyncio.gather \
+                (manager.status_list(), manager.status_list())
+            for r in r1, r2:
+                self.assertEqual \
+                    ([e['Channel'] for e in r], ['lcr/556', 'lcr/558'])
+                self.assertEqual(r.complete.name, 'StatusComplete')
+        self.run_manager(events, status)
+        self.assertEqual([e.name for e in self.events], ['Newexten'] * 2)
+
+    def test_list_stream(self):
+        events = Test_Manager.status_events
+        async def status(manager):
+            stream = manager.iter_list_action \
+                ({'Action' : 'Status'}, maxsize = 1)
+            channels = []
+            async for e in stream:
+                await asyncio.sleep(0.05)
+                channels.append(e['Channel'])
+            self.assertEqual(channels, ['lcr/556', 'lcr/558'])
+            self.assertEqual(stream.complete.name, 'StatusComplete')
+            # an abandoned stream does not stop reading
+            stream = manager.iter_list_action \
+                ({'Action' : 'Status'}, maxsize = 1)
+            await asyncio.sleep(0.1)
+            del stream
+            self.assertEqual(len(await manager.status_list()), 2)
+        self.run_manager(events, status)
+
+    def test_pipelined_events(self):
+        events = dict \
+            ( Originate =
+                ( Event
+                    ( Response  = ('Success',)
+                    , Message   = ('Originate successfully queued',)
+                    )
+                , Event
+                    ( Event            = ('Newchannel',)
+                    , Channel          = ('lcr/557',)
+                    , Uniqueid         = ('1332366541.558',)
+                    )
+                , Event
+                    ( Event            = ('Hangup',)
+                    , Channel          = ('lcr/557',)
+                    , Uniqueid         = ('1332366541.558',)
+                    )
+                )
+            )
+        async def originate(manager):
+            rs = await asyncio.gather \
+                (*(manager.originate('lcr/%d' % n, '1') for n in range(10)))
+            for r in rs:
+                self.compare_result(r, events['Originate'][0])
+        self.run_manager(events, originate)
+        self.assertEqual(len(self.events), 20)
+        self.assertEqual \
+            ( [e.name for e in self.events[:2]]
+            , ['Newchannel', 'Hangup']
+            )
+
 class AGI_Emu(object):
     """ Test AGI: behave like an asterisk counterpart for testing AGI
         Note that we can't test some side effects like produced by
@@ -812,10 +1667,681 @@ class Test_AGI(unittest.TestCase):
         self.agi.database_deltree('foo')
         self.assertRaises(AGIDBError, self.agi.database_deltree, 'foo')
 
+class Test_FastAGI(unittest.TestCase):
+    """ Test the FastAGI server with a client talking like asterisk.
+    """
+
+    env = 'agi_network: yes\nagi_network_script: test?x=1\nagi_channel: SIP/1\n\n'
+
+    def start(self, handler, **kw):
+        self.server = FastAGIServer(handler, host = 'localhost', port = 0, **kw)
+        t = threading.Thread(target = self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        def stop():
+            self.server.shutdown()
+            t.join(5)
+        self.addCleanup(stop)
+
+    def call(self, results):
+        """ Connect like asterisk, answer the commands with results.
+            Returns the commands.
+        """
+        sock = socket.create_connection(('localhost', self.server.port))
+        f = sock.makefile('rw')
+        sock.close()
+        f.write(self.env)
+        f.flush()
+        commands = []
+        for result in results:
+            line = f.readline()
+            if not line:
+                break
+            commands.append(line.strip())
+            f.write(result)
+            f.flush()
+        while f.readline():
+            pass
+        f.close()
+        return commands
+
+    def test_threads(self):
+        seen = Queue()
+        def handler(agi):
+            seen.put(agi.env['agi_network_script'])
+            agi.answer()
+            try:
+                agi.noop()
+                agi.noop()
+            except AGISIGHUPHangup:
+                seen.put('hangup')
+                raise
+        self.start(handler, threads = 2)
+        commands = self.call \
+            (['200 result=0\n', 'HANGUP\n200 result=0\n', '200 result=0\n'])
+        self.assertEqual(commands, ['ANSWER', 'NOOP'])
+        self.assertEqual(seen.get(timeout = 5), 'test?x=1')
+        self.assertEqual(seen.get(timeout = 5), 'hangup')
+        # the pool keeps serving
+        self.assertEqual(self.call(['200 result=0\n'] * 3), ['ANSWER', 'NOOP', 'NOOP'])
+
+    def test_prefork(self):
+        def handler(agi):
+            agi.verbose(str(os.getpid()))
+        self.start(handler, threads = 1, processes = 2)
+        commands = self.call(['200 result=1\n'])
+        self.assertEqual(len(commands), 1)
+        pid = int(commands[0].split('"')[1])
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(len(self.server.children), 2)
+        self.assertTrue(pid in self.server.children)
+
+    def test_async(self):
+        seen = []
+        async def handler(agi):
+            seen.append(agi.env['agi_network_script'])
+            await agi.answer()
+            seen.append(await agi.get_data('enter-number', 1000, 4))
+            seen.append(await agi.get_variable('NOTSET'))
+            await agi.goto_on_exit('ctx', 's', 1)
+            try:
+                await agi.noop()
+            except AGISIGHUPHangup:
+                seen.append('hangup')
+                raise
+        async def run():
+            server = AsyncFastAGIServer(handler, host = 'localhost', port = 0)
+            await server.start()
+            reader, writer = await asyncio.open_connection \
+                ('localhost', server.port)
+            writer.write(self.env.encode('utf-8'))
+            results = \
+                [ '200 result=0\n'
+                , '200 result=1234\n'
+                , '200 result=0\n'
+                , '200 result=0\n'
+                , '200 result=0\n'
+                , 'HANGUP\n200 result=0\n'
+                , '200 result=0\n'
+                ]
+            commands = []
+            for result in results:
+                line = await reader.readline()
+                if not line:
+                    break
+                commands.append(line.decode('utf-8').strip())
+                writer.write(result.encode('utf-8'))
+            self.assertEqual(await reader.read(), b'')
+            writer.close()
+            await server.close()
+            return commands
+        commands = asyncio.run(run())
+        self.assertEqual \
+            ( commands
+            , [ 'ANSWER', 'GET DATA enter-number 1000 4'
+              , 'GET VARIABLE "NOTSET"', 'SET CONTEXT ctx'
+              , 'SET EXTENSION s', 'set priority 1'
+              ]
+            )
+        self.assertEqual(seen, ['test?x=1', '1234', '', 'hangup'])
+
+class Test_State(unittest.TestCase):
+    """ Test the registries of asterisk state.
+    """
+
+    default_events = AsteriskEmu.default_events
+
+    def setUp(self):
+        self.astemu = None
+        self.manager = None
+        self.queue = Queue()
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def run_manager(self, chatscript):
+        self.astemu = AsteriskEmu (chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+
+    def test_channels(self):
+        d = dict
+        def status(uniqueid, channel, callerid, bridge=''):
+            return Event \
+                ( Event        = ('Status',)
+                , Channel      = (channel,)
+                , Uniqueid     = (uniqueid,)
+                , CallerIDNum  = (callerid,)
+                , ChannelState = ('6',)
+                , BridgeID     = (bridge,)
+                , ActionID     = ('',)
+                )
+        events = dict \
+            ( Status =
+                ( Event(Response = ('Success',), EventList = ('start',))
+                , status('1.1', 'SIP/100-1', '100', 'b1')
+                , status('1.2', 'SIP/200-2', '200', 'b1')
+                , status('1.3', 'SIP/100-3', '100')
+                , Event(Event = ('StatusComplete',), ActionID = ('',))
+                )
+            , Ping =
+                ( Event(Response = ('Success',), Ping = ('Pong',))
+                , Event
+                    ( Event        = ('Newchannel',)
+                    , Channel      = ('SIP/300-4',)
+                    , Uniqueid     = ('1.4',)
+                    , CallerIDNum  = ('300',)
+                    , ChannelState = ('0',)
+                    )
+                , Event
+                    ( Event        = ('Newstate',)
+                    , Channel      = ('SIP/300-4',)
+                    , Uniqueid     = ('1.4',)
+                    , CallerIDNum  = ('300',)
+                    , ChannelState = ('6',)
+                    , ChannelStateDesc = ('Up',)
+                    )
+                , Event
+                    ( Event    = ('Rename',)
+                    , Channel  = ('SIP/100-3',)
+                    , Newname  = ('SIP/100-3<MASQ>',)
+                    , Uniqueid = ('1.3',)
+                    )
+                , Event
+                    ( Event          = ('BridgeEnter',)
+                    , BridgeUniqueid = ('b2',)
+                    , Uniqueid       = ('1.4',)
+                    )
+                , Event
+                    ( Event          = ('BridgeEnter',)
+                    , BridgeUniqueid = ('b2',)
+                    , Uniqueid       = ('1.3',)
+                    )
+                , Event(Event = ('Hangup',), Uniqueid = ('1.1',))
+                )
+            )
+        self.run_manager(events)
+        channels = ChannelRegistry(self.manager)
+        self.assertEqual(len(channels), 3)
+        self.assertEqual(channels.by_name('SIP/200-2').uniqueid, '1.2')
+        self.assertEqual \
+            ( sorted(c.uniqueid for c in channels.by_caller_id('100'))
+            , ['1.1', '1.3']
+            )
+        self.assertEqual \
+            ([c.name for c in channels.bridged('1.1')], ['SIP/200-2'])
+        self.manager.register_event \
+            ('Hangup', lambda ev, m: self.queue.put(ev))
+        self.manager.ping()
+        self.queue.get(timeout = 5)
+        self.assertFalse('1.1' in channels)
+        self.assertEqual(channels.bridged('1.2'), [])
+        self.assertEqual(channels.get('1.4').state_desc, 'Up')
+        self.assertEqual(channels.by_caller_id('300')[0].name, 'SIP/300-4')
+        self.assertEqual(channels.by_name('SIP/100-3'), None)
+        self.assertEqual(channels.by_name('SIP/100-3<MASQ>').uniqueid, '1.3')
+        self.assertEqual \
+            ([c.uniqueid for c in channels.bridged('1.3')], ['1.4'])
+        self.assertEqual \
+            (channels.bridges, dict(b1 = set(['1.2']), b2 = set(['1.3', '1.4'])))
+        # refresh removes channels not in the snapshot
+        channels.refresh()
+        self.assertEqual(sorted(channels.objects), ['1.1', '1.2', '1.3'])
+        self.assertEqual(channels.by_caller_id('300'), [])
+        self.assertEqual(channels.bridges, dict(b1 = set(['1.1', '1.2'])))
+        # a failed refresh keeps the state
+        def fail():
+            raise ManagerTimeoutException('Timeout')
+        channels.snapshot = fail
+        self.assertRaises(ManagerTimeoutException, channels.refresh)
+        self.assertEqual(sorted(channels.objects), ['1.1', '1.2', '1.3'])
+        self.assertEqual(channels.by_name('SIP/200-2').uniqueid, '1.2')
+        self.assertEqual(channels._changed, None)
+        # so does an Error response
+        del channels.snapshot
+        status_list = self.manager.status_list
+        self.manager.status_list = lambda: EventList(ManagerMsg \
+            (['Response: Error\r\n', 'Message: Permission denied\r\n']))
+        self.assertRaises(ManagerException, channels.refresh)
+        self.assertEqual(sorted(channels.objects), ['1.1', '1.2', '1.3'])
+        # refreshes do not overlap, a failed background refresh allows
+        # the next one
+        def slow():
+            time.sleep(0.1)
+            return status_list()
+        self.manager.status_list = slow
+        t = threading.Thread(target=channels.refresh)
+        t.start()
+        channels.refresh()
+        t.join(5)
+        self.assertEqual(sorted(channels.objects), ['1.1', '1.2', '1.3'])
+        def slow_fail():
+            time.sleep(0.1)
+            fail()
+        channels.snapshot = slow_fail
+        channels.ttl = 0
+        for k in range(2):
+            channels.get('1.1')
+            t = channels._refresh_thread
+            self.assertTrue(t is not None)
+            t.join(5)
+            self.assertEqual(channels._refresh_thread, None)
+        channels.close()
+
+    def test_peers(self):
+        def peer(name, status, address):
+            return Event \
+                ( Event       = ('PeerEntry',)
+                , Channeltype = ('SIP',)
+                , ObjectName  = (name,)
+                , IPaddress   = (address,)
+                , IPport      = ('5060',)
+                , Status      = (status,)
+                , ActionID    = ('',)
+                )
+        events = dict \
+            ( Sippeers =
+                ( Event(Response = ('Success',), EventList = ('start',))
+                , peer('100', 'OK (5 ms)', '10.0.0.1')
+                , peer('101', 'UNREACHABLE', '10.0.0.2')
+                , peer('102', 'Unmonitored', '-none-')
+                , Event(Event = ('PeerlistComplete',), ActionID = ('',))
+                )
+            , PJSIPShowEndpoints =
+                ( Event(Response = ('Success',), EventList = ('start',))
+                , Event
+                    ( Event       = ('EndpointList',)
+                    , ObjectName  = ('200',)
+                    , DeviceState = ('Unavailable',)
+                    , ActionID    = ('',)
+                    )
+                , Event(Event = ('EndpointListComplete',), ActionID = ('',))
+                )
+            , Ping =
+                ( Event(Response = ('Success',), Ping = ('Pong',))
+                , Event
+                    ( Event      = ('PeerStatus',)
+                    , Peer       = ('SIP/100',)
+                    , PeerStatus = ('Unreachable',)
+                    )
+                , Event
+                    ( Event         = ('ContactStatus',)
+                    , EndpointName  = ('200',)
+                    , URI           = ('sip:200@10.0.0.3:5060',)
+                    , ContactStatus = ('Reachable',)
+                    )
+                )
+            )
+        self.run_manager(events)
+        peers = PeerRegistry(self.manager, ttl = 3600)
+        self.assertEqual(len(peers), 4)
+        self.assertEqual([p.key for p in peers.reachable()], ['SIP/100'])
+        self.assertEqual(peers.get('SIP/100').address, '10.0.0.1:5060')
+        self.assertEqual \
+            ( sorted(p.key for p in peers.by_status('unreachable'))
+            , ['PJSIP/200', 'SIP/101']
+            )
+        self.assertEqual(peers.get('SIP/102').address, None)
+        self.manager.register_event \
+            ('ContactStatus', lambda ev, m: self.queue.put(ev))
+        self.manager.ping()
+        self.queue.get(timeout = 5)
+        self.assertEqual([p.key for p in peers.reachable()], ['PJSIP/200'])
+        self.assertEqual \
+            ( peers.get('PJSIP/200').contacts
+            , {'sip:200@10.0.0.3:5060' : 'reachable'}
+            )
+        # an expired ttl reloads the snapshot in the background
+        refreshed = peers.refreshed
+        peers.ttl = 0
+        peers.get('SIP/100')
+        peers.ttl = None
+        for k in range(500):
+            if peers.refreshed > refreshed:
+                break
+            time.sleep(0.01)
+        self.assertTrue(peers.refreshed > refreshed)
+        self.assertEqual([p.key for p in peers.reachable()], ['SIP/100'])
+        # the peers of a failed action are kept
+        send = self.manager.send_list_action_async
+        def send_list_action_async(cdict):
+            future = send(cdict)
+            if cdict['Action'] != 'Sippeers':
+                return future
+            error = Future()
+            error.action_id = future.action_id
+            error.set_result(EventList(ManagerMsg \
+                (['Response: Error\r\n', 'Message: Invalid/unknown\r\n'])))
+            return error
+        self.manager.send_list_action_async = send_list_action_async
+        peers.refresh()
+        self.assertEqual(len(peers), 4)
+        peers.actions = ('Sippeers',)
+        self.assertRaises(ManagerException, peers.refresh)
+        self.assertEqual(len(peers), 4)
+
+    def test_peers_timeout(self):
+        events = dict \
+            ( Sippeers =
+                ( Event(Response = ('Success',), EventList = ('start',))
+                , Event(Event = ('PeerlistComplete',), ActionID = ('',))
+                )
+            , PJSIPShowEndpoints =
+                (Event(Response = ('Success',), EventList = ('start',)),)
+            )
+        self.run_manager(events)
+        self.manager.timeout = 0.2
+        self.assertRaises \
+            (ManagerTimeoutException, PeerRegistry, self.manager)
+        # no collector is left to keep the events
+        self.assertEqual(self.manager._pending, {})
+        self.assertEqual(self.manager._collectors, {})
+
+    def test_queues(self):
+        def member(interface, status, event='QueueMember'):
+            return Event \
+                ( Event          = (event,)
+                , Queue          = ('support',)
+                , Name           = ('Agent %s' % interface,)
+                , Location       = (interface,)
+                , StateInterface = (interface,)
+                , Status         = (status,)
+                , Paused         = ('0',)
+                , ActionID       = ('',)
+                )
+        def caller(event, uniqueid, **kw):
+            return Event \
+                ( Event    = (event,)
+                , Queue    = ('support',)
+                , Uniqueid = (uniqueid,)
+                , Channel  = ('SIP/c-%s' % uniqueid,)
+                , **dict((k, (v,)) for k, v in kw.items())
+                )
+        events = dict \
+            ( QueueStatus =
+                ( Event(Response = ('Success',), EventList = ('start',))
+                , Event
+                    ( Event     = ('QueueParams',)
+                    , Queue     = ('support',)
+                    , Strategy  = ('ringall',)
+                    , Calls     = ('1',)
+                    , Completed = ('7',)
+                    , ActionID  = ('',)
+                    )
+                , member('SIP/100', '1')
+                , member('SIP/101', '5')
+                , Event
+                    ( Event    = ('QueueEntry',)
+                    , Queue    = ('support',)
+                    , Position = ('1',)
+                    , Uniqueid = ('1.1',)
+                    , Channel  = ('SIP/c-1.1',)
+                    , Wait     = ('12',)
+                    , ActionID = ('',)
+                    )
+                , Event(Event = ('QueueStatusComplete',), ActionID = ('',))
+                )
+            , Ping =
+                ( Event(Response = ('Success',), Ping = ('Pong',))
+                , caller('QueueCallerJoin', '1.2', Position = '2', Count = '2')
+                , caller('QueueCallerLeave', '1.1', Count = '1')
+                , caller('AgentConnect', '1.1', Interface = 'SIP/100')
+                , Event
+                    ( Event      = ('QueueMemberStatus',)
+                    , Queue      = ('support',)
+                    , MemberName = ('Agent SIP/100',)
+                    , Interface  = ('SIP/100',)
+                    , Status     = ('2',)
+                    )
+                , caller('AgentComplete', '1.1', Interface = 'SIP/100')
+                , Event
+                    ( Event     = ('QueueMemberRemoved',)
+                    , Queue     = ('support',)
+                    , Interface = ('SIP/101',)
+                    )
+                )
+            )
+        self.run_manager(events)
+        queues = QueueRegistry(self.manager)
+        state = queues.state('support')
+        self.assertEqual(state['params']['Strategy'], 'ringall')
+        self.assertEqual \
+            ( sorted((m['interface'], m['status']) for m in state['members'])
+            , [('SIP/100', '1'), ('SIP/101', '5')]
+            )
+        self.assertEqual([c['uniqueid'] for c in state['callers']], ['1.1'])
+        changes = []
+        def changed(registry, key, event):
+            changes.append(event.name)
+            if event.name == 'QueueMemberRemoved':
+                self.queue.put(event)
+        queues.subscribe(changed, 'support')
+        self.manager.ping()
+        self.queue.get(timeout = 5)
+        self.assertEqual \
+            ( changes
+            , [ 'QueueCallerJoin', 'QueueCallerLeave', 'AgentConnect'
+              , 'QueueMemberStatus', 'AgentComplete', 'QueueMemberRemoved'
+              ]
+            )
+        # the copy returned earlier is unchanged
+        self.assertEqual(len(state['members']), 2)
+        state = queues.state()['support']
+        self.assertEqual([c['uniqueid'] for c in state['callers']], ['1.2'])
+        self.assertEqual(state['params']['Calls'], '1')
+        self.assertEqual(state['params']['Completed'], '8')
+        self.assertEqual(len(state['members']), 1)
+        self.assertEqual(state['members'][0]['status'], '2')
+        self.assertEqual(state['members'][0]['in_call'], None)
+        queues.unsubscribe(changed, 'support')
+        queues.close()
+
+class Test_Originate(unittest.TestCase):
+    """ Test mass origination with the OriginateEngine.
+    """
+
+    def setUp(self):
+        self.astemu = None
+        self.manager = None
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def run_engine(self, chatscript, **kw):
+        self.astemu = AsteriskEmu (chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port = self.astemu.port)
+        self.manager.login('account', 'geheim')
+        engine = OriginateEngine(self.manager, **kw)
+        self.addCleanup(engine.close)
+        return engine
+
+    def test_channel_trunk(self):
+        self.assertEqual(_channel_trunk('SIP/provider/0123'), 'SIP/provider')
+        self.assertEqual(_channel_trunk('PJSIP/0123@prov'), 'PJSIP/prov')
+        self.assertEqual(_channel_trunk('SIP/100'), 'SIP/100')
+
+    def test_originate(self):
+        events = dict \
+            ( Originate =
+                ( Event
+                    ( Response = ('Success',)
+                    , Message  = ('Originate successfully queued',)
+                    )
+                , Event
+                    ( Event    = ('OriginateResponse',)
+                    , Response = ('Success',)
+                    , Channel  = ('SIP/a-00000001',)
+                    , Reason   = ('4',)
+                    , ActionID = ('',)
+                    )
+                )
+            )
+        engine = self.run_engine(events, max_in_flight = 2, rate = 20)
+        jobs = []
+        for n in range(6):
+            trunk = 'ab'[n % 2]
+            jobs.append(engine.submit('SIP/%s/%d' % (trunk, n), 's', 'out'))
+        self.assertTrue(engine.wait(5))
+        self.assertEqual([j.status for j in jobs], ['success'] * 6)
+        self.assertEqual(set(j.reason for j in jobs), set(['4']))
+        self.assertEqual(jobs[0].future.result(timeout = 1), jobs[0])
+        self.assertEqual(jobs[0].cdict['Async'], 'yes')
+        self.assertEqual(len(set(j.action_id for j in jobs)), 6)
+        for trunk in 'SIP/a', 'SIP/b':
+            sent = sorted(j.sent for j in jobs if j.trunk == trunk)
+            for t1, t2 in zip(sent, sent[1:]):
+                self.assertTrue(t2 - t1 >= 0.045)
+        stats = engine.stats()
+        self.assertEqual(stats['submitted'], 6)
+        self.assertEqual(stats['success'], 6)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['trunks']['SIP/a'], dict(sent = 3, success = 3))
+        self.assertTrue(stats['throughput'] > 0)
+
+    def test_originate_error(self):
+        events = dict \
+            ( Originate =
+                ( Event
+                    ( Response = ('Error',)
+                    , Message  = ('Originate failed',)
+                    )
+                ,
+                )
+            )
+        engine = self.run_engine(events)
+        job = engine.submit('SIP/a/1', 's', 'out')
+        job.future.result(timeout = 5)
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(job.reason, 'Originate failed')
+        engine.close()
+        self.assertRaises(ManagerException, engine.submit, 'SIP/a/2', 's')
+
+    def test_originate_unlocked(self):
+        events = dict \
+            ( Originate =
+                ( Event(Response = ('Success',), Message = ('Queued',))
+                , Event
+                    ( Event    = ('OriginateResponse',)
+                    , Response = ('Failure',)
+                    , Reason   = ('5',)
+                    , ActionID = ('',)
+                    )
+                )
+            )
+        engine = self.run_engine(events)
+        # sending does not hold the lock of the engine, e.g. while
+        # waiting for a resumed session; neither do the callbacks of
+        # the futures of the jobs
+        send = self.manager.send_action_async
+        def send_action_async(cdict):
+            t = threading.Thread(target=engine.stats)
+            t.start()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            return send(cdict)
+        self.manager.send_action_async = send_action_async
+        stats = Queue()
+        job = engine.submit('SIP/a/1', 's', 'out')
+        job.future.add_done_callback \
+            (lambda f: threading.Thread \
+                (target=lambda: stats.put(engine.stats())).start())
+        self.assertEqual(stats.get(timeout = 5)['failure'], 1)
+        self.assertEqual(job.status, 'failure')
+        self.assertEqual(job.reason, '5')
+        self.assertTrue(engine.wait(5))
+
+class Test_ManagerPool(unittest.TestCase):
+    """ Test connections to several emulated managers.
+    """
+
+    default_events = AsteriskEmu.default_events
+
+    def setUp(self):
+        self.emus = []
+        self.pool = None
+        self.queue = Queue()
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.close()
+        for emu in self.emus:
+            emu.close()
+
+    def handler(self, event, pool):
+        self.queue.put(event)
+
+    def test_pool(self):
+        for node in 'node1', 'node2':
+            events = dict \
+                ( Login =
+                    ( self.default_events['Login'][0]
+                    , Event
+                        ( Event   = ('Hangup',)
+                        , Channel = ('SIP/%s-00000001' % node,)
+                        )
+                    , Event(Event = ('VarSet',), Channel = ('SIP/x',))
+                    )
+                , Command =
+                    ( Event
+                        ( Response = ('Follows',)
+                        , CONTENT  = '%s\n--END COMMAND--' % node
+                        )
+                    ,
+                    )
+                , Ping = (Event(Response = ('Success',), Ping = ('Pong',)),)
+                )
+            self.emus.append(AsteriskEmu(events))
+        route = {'SIP/node1-': 'node1', 'SIP/node2-': 'node2'}
+        self.pool = ManagerPool(route = route, timeout = 5)
+        self.pool.register_event('Hangup', self.handler)
+        for node, emu in zip(('node1', 'node2'), self.emus):
+            self.pool.connect('localhost', 'account', 'geheim', emu.port, node)
+        events = [self.queue.get(timeout = 5) for k in range(2)]
+        self.assertEqual \
+            ( sorted((e.host, e['Channel']) for e in events)
+            , [('node1', 'SIP/node1-00000001'), ('node2', 'SIP/node2-00000001')]
+            )
+        # VarSet has no callback
+        self.assertTrue(self.queue.empty())
+
+        r = self.pool.broadcast('command', 'core show channels count')
+        self.assertEqual(sorted(r), ['node1', 'node2'])
+        for node in r:
+            self.assertEqual(r[node].data, '%s\n--END COMMAND--\r\n' % node)
+
+        self.assertEqual(self.pool.host_for('SIP/node2-00000001'), 'node2')
+        self.assertRaises(ManagerException, self.pool.host_for, 'IAX2/x')
+        r = self.pool['SIP/node1-00000001'].ping()
+        self.assertEqual(r['Ping'], 'Pong')
+        future = self.pool['node2'].ping_async()
+        self.assertEqual(future.result(5)['Ping'], 'Pong')
+        self.assertEqual(self.pool['node2'].host, 'node2')
+        # methods that must run in the event loop are not offered
+        for name in ( 'send_action_nowait', 'iter_list_action'
+                    , 'register_event', '_send', 'register_event_async'
+                    ):
+            self.assertRaises \
+                (AttributeError, getattr, self.pool['node2'], name)
+        r = self.pool.send_action('node2', {'Action':'Ping'})
+        self.assertEqual(r['Ping'], 'Pong')
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest (unittest.makeSuite (Test_Manager))
+    suite.addTest (unittest.makeSuite (Test_AsyncManager))
+    suite.addTest (unittest.makeSuite (Test_ManagerPool))
+    suite.addTest (unittest.makeSuite (Test_State))
+    suite.addTest (unittest.makeSuite (Test_Originate))
     suite.addTest (unittest.makeSuite (Test_AGI))
+    suite.addTest (unittest.makeSuite (Test_FastAGI))
     return suite
 
 if __name__ == '__main__':